@@ -1,313 +1,534 @@
-import sqlite3
+import json
+import math
+import os
 import time
 from collections import defaultdict
 from datetime import datetime
 
-from flask import Flask, jsonify
+from flask import Flask, Response, jsonify, request, stream_with_context
+
+import detector_health
+import history
+import schema
+import status_codec
+import storage
+import timeline
+from geo_index import GridIndex
 
 app = Flask(__name__)
 DB_PATH = "/data/detectors.db"
 
-def predict_next_change(light_id, current_state):
-    """Predict next change using duration of same type of recent transition"""
-    # If current state is not valid, return default values
-    if current_state not in ('RED', 'GREEN'):
-        print(f"[PREDICT] Light {light_id}: Invalid current state '{current_state}', using defaults")
-        return ('UNKNOWN', 0, 0.0)
-    
-    print(f"\n[PREDICT] Starting prediction for Light {light_id}, current state: {current_state}")
-    
-    # Define default durations for each state transition
-    # These values are based on typical traffic light patterns
-    DEFAULT_DURATIONS = {
-        'RED': {'next': 'GREEN', 'duration': 30},
-        'GREEN': {'next': 'RED', 'duration': 15}
-    }
-    
-    # Define the expected next state based on current state
-    expected_next_state = 'GREEN' if current_state == 'RED' else 'RED'
-    
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-    
-    try:
-        # Get last transition of the same type
-        cursor.execute("""
-            SELECT previous_state, next_state, duration, last_updated
-            FROM state_durations
-            WHERE light_id = ? AND previous_state = ? AND next_state = ?
-            ORDER BY last_updated DESC
-            LIMIT 1
-        """, (light_id, current_state, expected_next_state))
-        
-        last_transition = cursor.fetchone()
-        
-        # If no specific transition found, try any transition from current state
-        if not last_transition:
-            cursor.execute("""
-                SELECT previous_state, next_state, duration, last_updated
-                FROM state_durations
-                WHERE light_id = ? AND previous_state = ?
-                ORDER BY last_updated DESC
-                LIMIT 1
-            """, (light_id, current_state))
-            
-            last_transition = cursor.fetchone()
-        
-        if last_transition:
-            # Use duration from same type transition
-            predicted_duration = float(last_transition['duration'])
-            next_state = last_transition['next_state']
-            
-            print(f"[PREDICT] Found transition data: {current_state}->{next_state}, duration={predicted_duration:.2f}s, updated={last_transition['last_updated']}")
-            
-            # Check if we have stale timestamps (from 2019 or earlier)
-            current_year = datetime.now().year
-            
-            # Get the most recent timestamp when this state started
-            cursor.execute('''
-                SELECT timestamp 
-                FROM traffic_light_states
-                WHERE light_id = ? AND state = ?
-                ORDER BY timestamp DESC
-                LIMIT 1
-            ''', (light_id, current_state))
-            
-            result = cursor.fetchone()
-            
-            if result and result['timestamp']:
-                # Debug the timestamp value
-                print(f"[PREDICT] Raw timestamp from DB: {result['timestamp']} (type: {type(result['timestamp']).__name__})")
-                
-                # Convert timestamp to seconds since epoch
-                try:
-                    # Handle both integer timestamps and ISO format strings
-                    current_time = time.time()
-                    print(f"[PREDICT] Current time: {current_time} ({datetime.fromtimestamp(current_time).isoformat()})")
-                    
-                    timestamp_year = None
-                    if isinstance(result['timestamp'], int):
-                        current_state_start = result['timestamp']
-                        # Check if timestamp is from a reasonable time period
-                        timestamp_year = datetime.fromtimestamp(current_state_start).year
-                        print(f"[PREDICT] Timestamp is integer: {current_state_start} (year: {timestamp_year})")
-                    else:
-                        # Try parsing as ISO format
-                        # Try parsing as float/int string
-                        current_state_start = float(result['timestamp'])
-                        timestamp_year = datetime.fromtimestamp(current_state_start).year
-                        print(f"[PREDICT] Parsed numeric timestamp: {current_state_start} (year: {timestamp_year})")
-                    
-                    # Check if timestamp is too old (more than 1 day old)
-                    if timestamp_year < current_year - 1 or current_time - current_state_start > 86400:
-                        print(f"[PREDICT] Timestamp is too old ({timestamp_year}), updating to current time")
-                    
-                        # Instead of using defaults, update the timestamp to current time
-                        # This fixes the old timestamp issue by creating a new record with current time
-                        try:
-                            update_cursor = conn.cursor()
-                            # Insert a new state record with current timestamp
-                            update_cursor.execute("""
-                                INSERT INTO traffic_light_states (light_id, state, timestamp)
-                                VALUES (?, ?, ?)
-                            """, (light_id, current_state, int(current_time)))
-                            conn.commit()
-                            print(f"[PREDICT] Updated timestamp for light {light_id} to current time")
-                        
-                            # Now use a small portion of the predicted duration as time remaining
-                            # This assumes the light just changed to this state
-                            time_remaining = predicted_duration * 0.9  # Assume we're at the start of the cycle
-                            confidence = 0.7  # Medium confidence for updated timestamps
-                        except Exception as update_error:
-                            print(f"[PREDICT] Error updating timestamp: {update_error}")
-                            time_remaining = predicted_duration * 0.5  # Fallback to halfway through cycle
-                            confidence = 0.5  # Lower confidence for default predictions
-                    else:
-                        # Normal calculation for recent timestamps
-                        current_state_duration = current_time - current_state_start
-                        print(f"[PREDICT] Current state duration: {current_state_duration:.2f}s")
-                        print(f"[PREDICT] Predicted total duration: {predicted_duration:.2f}s")
-                        
-                        # If current duration is already longer than predicted, use a small remaining time
-                        if current_state_duration >= predicted_duration:
-                            # The light should change soon - use a small value (3 seconds)
-                            time_remaining = 3.0
-                            confidence = 0.8
-                            print(f"[PREDICT] Current duration ({current_state_duration:.2f}s) exceeds predicted ({predicted_duration:.2f}s), expecting change soon")
-                        else:
-                            time_remaining = max(0, predicted_duration - current_state_duration)
-                            confidence = 1.0  # Full confidence for recent timestamps
-                    
-                    print(f"[PREDICT] Light {light_id} ({current_state}): Next={next_state}, "
-                          f"Remaining={time_remaining:.2f}s, Confidence={confidence:.2f}")
-                    
-                    # Query for all recent state changes for this light for debugging
-                    cursor.execute('''
-                        SELECT state, timestamp
-                        FROM traffic_light_states
-                        WHERE light_id = ?
-                        ORDER BY timestamp DESC
-                        LIMIT 5
-                    ''', (light_id,))
-                    
-                    recent_states = cursor.fetchall()
-                    print(f"[PREDICT] Recent state changes for light {light_id}:")
-                    for i, state in enumerate(recent_states):
-                        print(f"  {i+1}. {state['state']} at {state['timestamp']}")
-                
-                    return (next_state, time_remaining, confidence)
-                except (ValueError, TypeError) as e:
-                    print(f"[PREDICT] Error parsing timestamp for light {light_id}: {e}")
-                    import traceback
-                    traceback.print_exc()
-            else:
-                print(f"[PREDICT] No timestamp found for current state of light {light_id}")
-                
-                # Check if there are any state records at all
-                cursor.execute('''
-                    SELECT COUNT(*) as count
-                    FROM traffic_light_states
-                    WHERE light_id = ?
-                ''', (light_id,))
-                
-                count = cursor.fetchone()['count']
-                print(f"[PREDICT] Total state records for light {light_id}: {count}")
-        else:
-            print(f"[PREDICT] No transition data found for light {light_id} with state {current_state}")
-            
-            # Check if there are any transitions at all
-            cursor.execute('''
-                SELECT COUNT(*) as count
-                FROM state_durations
-                WHERE light_id = ?
-            ''', (light_id,))
-            
-            count = cursor.fetchone()['count']
-            print(f"[PREDICT] Total transition records for light {light_id}: {count}")
-            
-            if count > 0:
-                # Show available transitions
-                cursor.execute('''
-                    SELECT previous_state, next_state, duration, last_updated
-                    FROM state_durations
-                    WHERE light_id = ?
-                    ORDER BY last_updated DESC
-                ''', (light_id,))
-                
-                transitions = cursor.fetchall()
-                print(f"[PREDICT] Available transitions for light {light_id}:")
-                for t in transitions:
-                    print(f"  {t['previous_state']}->{t['next_state']}: {t['duration']:.2f}s (updated: {t['last_updated']})")
-        
-        # Fallback to defaults if no transitions found or timestamp issues
-        print(f"[PREDICT] Light {light_id}: Using default prediction values")
-        
-        # Use the predefined defaults
-        next_state = DEFAULT_DURATIONS[current_state]['next']
-        default_duration = DEFAULT_DURATIONS[current_state]['duration']
-        
-        # Create a new timestamp record to establish history
+# Concurrent requests per worker; the SQLite read-only pool is sized to match
+API_THREADS = int(os.environ.get('API_THREADS', 4))
+
+# The MQTT listener applies schema migrations at startup, so the API only
+# verifies the schema version once per worker instead of on every request.
+
+# How long a starting worker waits for the listener to create the schema
+SCHEMA_WAIT_SECONDS = int(os.environ.get('API_SCHEMA_WAIT_SECONDS', 30))
+
+# Static per-light metadata (name, parsed coordinates), warmed once per worker
+_light_info = {}
+_light_info_loaded_at = 0
+LIGHT_INFO_TTL = 300  # Reload topology every 5 minutes, like the listener's config cache
+LIGHT_INFO_MISS_INTERVAL = 5  # Shortest time between reloads triggered by unknown light ids
+
+# Last frame time per detector from the listener's detector_health flushes
+_detector_last_seen = {}
+_detector_last_seen_loaded_at = 0
+DETECTOR_HEALTH_TTL = 5
+# Lights whose detectors have been silent this long are reported as stale
+DETECTOR_STALE_SECONDS = int(os.environ.get('DETECTOR_STALE_SECONDS', detector_health.STALE_AFTER))
+
+# Spatial index over light coordinates, rebuilt with the metadata cache
+_geo_index = GridIndex()
+
+# Binary encoder for status responses, caches pre-encoded static light fields
+_status_encoder = status_codec.StatusEncoder()
+
+# Short names accepted in the ?format= query parameter
+RESPONSE_FORMATS = {
+    'json': status_codec.JSON_MIMETYPE,
+    'protobuf': status_codec.PROTOBUF_MIMETYPE,
+    'msgpack': status_codec.MSGPACK_MIMETYPE,
+}
+
+# Limits for spatial queries
+MAX_NEARBY_RADIUS_M = 5000
+MAX_SPATIAL_RESULTS = 500
+
+# Page size for history requests; the maximum is a hard cap on rows read per request
+HISTORY_DEFAULT_LIMIT = 1000
+HISTORY_MAX_LIMIT = int(os.environ.get('API_HISTORY_MAX_ROWS', 10000))
+HISTORY_DEFAULT_RANGE = 3600  # Last hour when no start is given
+
+# Finished timeline buckets, cached per worker
+_timeline_cache = timeline.TimelineCache()
+
+# Upper bound on lights x buckets in one timeline response
+MAX_TIMELINE_BUCKETS = 50000
+
+# Storage opened read-only per worker after fork (STORAGE_BACKEND selects it)
+_store = None
+
+def check_schema(wait_seconds=SCHEMA_WAIT_SECONDS):
+    """Verify that all schema migrations are applied, waiting for the listener to apply them"""
+    deadline = time.time() + wait_seconds
+    while True:
         try:
-            current_time = time.time()
-            cursor.execute("""
-                INSERT INTO traffic_light_states (light_id, state, timestamp)
-                VALUES (?, ?, ?)
-            """, (light_id, current_state, int(current_time)))
-            
-            # Also create a default duration record
-            cursor.execute("""
-                INSERT OR REPLACE INTO state_durations 
-                (light_id, previous_state, next_state, duration, last_updated)
-                VALUES (?, ?, ?, ?, ?)
-            """, (light_id, current_state, next_state, default_duration, 
-                 datetime.now().isoformat()))
-                 
-            conn.commit()
-            print(f"[PREDICT] Created new timestamp and duration records for light {light_id}")
-        except Exception as e:
-            print(f"[PREDICT] Error creating timestamp record: {e}")
-            
-        return (next_state, default_duration, 0.5)
-    
-    except Exception as e:
-        print(f"[PREDICT] Error predicting next change for light {light_id}: {e}")
-        import traceback
-        traceback.print_exc()
-        # Return safe defaults
-        next_state = 'GREEN' if current_state == 'RED' else 'RED'
-        return (next_state, 45, 0.3)
+            version = _store.schema_version()
+        except storage.OperationalError:
+            # Database file not created yet
+            version = 0
+
+        if version >= schema.LATEST_VERSION:
+            print(f"[STARTUP] Schema check passed for {DB_PATH} (version {version})")
+            return
+
+        if time.time() >= deadline:
+            raise RuntimeError(f"Database schema is at version {version}, expected {schema.LATEST_VERSION}")
+
+        print(f"[STARTUP] Waiting for schema version {schema.LATEST_VERSION}, found {version}")
+        time.sleep(1)
+
+def load_light_info():
+    """Load static traffic light metadata with coordinates parsed once and index them"""
+    global _light_info_loaded_at
+    rows = _store.lights()
+    detectors = defaultdict(list)
+    for light_id, detector_id in _store.light_detectors():
+        detectors[light_id].append(detector_id)
+
+    info = {}
+    for light_id, name, location, _ in rows:
+        try:
+            latitude, longitude = (float(part.strip()) for part in location.split(','))
+        except (AttributeError, ValueError):
+            print(f"[STARTUP] Light {light_id}: invalid location '{location}'")
+            latitude, longitude = None, None
+        info[light_id] = {'name': name, 'latitude': latitude, 'longitude': longitude,
+                          'detectors': tuple(detectors[light_id])}
+
+    _light_info.clear()
+    _light_info.update(info)
+    _geo_index.build((light_id, light['latitude'], light['longitude']) for light_id, light in info.items())
+    _status_encoder.clear()
+    _light_info_loaded_at = time.time()
+    return info
+
+def refresh_light_info():
+    """Reload the metadata cache and spatial index once the TTL has expired"""
+    if time.time() - _light_info_loaded_at > LIGHT_INFO_TTL:
+        load_light_info()
+
+def get_light_info(light_id):
+    """Get static metadata for a light.
+
+    A miss reloads the cache at most once per LIGHT_INFO_MISS_INTERVAL, so
+    lights added since the last load appear within seconds and requests for
+    unknown ids cannot force a reload each. Returns None for a light that is
+    not loaded yet.
+    """
+    if light_id not in _light_info and time.time() - _light_info_loaded_at > LIGHT_INFO_MISS_INTERVAL:
+        load_light_info()
+    return _light_info.get(light_id)
+
+def get_detector_last_seen():
+    """Last frame time per detector, re-read at most every DETECTOR_HEALTH_TTL seconds"""
+    global _detector_last_seen_loaded_at
+    if time.time() - _detector_last_seen_loaded_at > DETECTOR_HEALTH_TTL:
+        last_seen = _store.detector_last_seen()
+        _detector_last_seen.clear()
+        _detector_last_seen.update(last_seen)
+        _detector_last_seen_loaded_at = time.time()
+    return _detector_last_seen
+
+def get_light_last_seen(info):
+    """Most recent frame from any of a light's detectors, None if none ever reported"""
+    last_seen = get_detector_last_seen()
+    seen = [last_seen[detector_id] for detector_id in info['detectors'] if detector_id in last_seen]
+    return max(seen) if seen else None
+
+def get_current_states(light_ids):
+    """Get the precomputed current state and next change of each light"""
+    return _store.get_light_current(light_ids)
+
+def format_light_status(light_id, eta, now):
+    """Build the API representation of a light from its precomputed next change.
+
+    Lights whose detectors stopped reporting keep their last state but are
+    marked stale, without a countdown. Until the listener first flushes
+    detector health there is no evidence either way, so the light is not
+    stale and its last recorded transition stands in for last_seen.
+    """
+    info = get_light_info(light_id)
+    last_seen = get_light_last_seen(info)
+    stale = last_seen is not None and now - last_seen > DETECTOR_STALE_SECONDS
+    if last_seen is None:
+        last_seen = eta.state_since
+    if stale:
+        next_state, time_remaining, confidence, interval = None, None, 0.0, None
+    else:
+        next_state, time_remaining, confidence, interval = eta.predict(now)
     
-    finally:
-        conn.close()
+    return {
+        "light_id": light_id,
+        "current_status": eta.state,
+        "time_to_next_change_seconds": time_remaining,
+        "predicted_next_status": next_state,
+        "prediction_confidence": confidence,
+        "prediction_interval_seconds": [round(bound, 1) for bound in interval] if interval else None,
+        "location": {
+            "latitude": info['latitude'],
+            "longitude": info['longitude']
+        },
+        "name": info['name'],
+        "stale": stale,
+        "last_seen": round(last_seen, 1) if last_seen is not None else None
+    }
+
+def init_worker():
+    """Prepare per-process state. Called in every server worker after fork."""
+    global _store
+    started = time.perf_counter()
+    _store = storage.open_storage(db_path=DB_PATH, readonly=True, pool_size=API_THREADS)
+    check_schema()
+    load_light_info()
+    print(f"[STARTUP] Worker {os.getpid()} ready with {len(_light_info)} lights cached "
+          f"in {(time.perf_counter() - started) * 1000:.0f} ms")
+
+# Upper bound on predicted changes per /predict request
+MAX_PREDICTED_CHANGES = 20
+
+def get_cycle_model(light_id):
+    """Load a light's cycle model with a primary key lookup, or None if not learned yet"""
+    return _store.get_cycle_model(light_id)
 
 def get_intersection_status(intersection_id):
-    """Get current status of an intersection from the database"""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-    
-    # Ensure the table exists
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS traffic_light_states (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            light_id INTEGER NOT NULL,
-            state TEXT CHECK(state IN ('RED', 'GREEN')) NOT NULL,
-            timestamp DATETIME NOT NULL,
-            FOREIGN KEY (light_id) REFERENCES traffic_lights(light_id)
-        )
-    """)
-    
-    # Get latest states for all lights in the intersection
-    cursor.execute("""
-        SELECT tl.light_id, tl.name, tl.location, tls.state, tls.timestamp 
-        FROM traffic_lights tl
-        JOIN (
-            SELECT light_id, MAX(rowid) as max_rowid
-            FROM traffic_light_states
-            GROUP BY light_id
-        ) latest ON tl.light_id = latest.light_id
-        JOIN traffic_light_states tls ON tls.rowid = latest.max_rowid
-        WHERE tl.intersection_id = ?
-    """, (intersection_id,))
-    
-    lights = [dict(row) for row in cursor.fetchall()]
-    conn.close()
-    
-    if not lights:
+    """Get current status of an intersection from the precomputed intersection_current
+    and light_current rows"""
+    current = _store.intersection_current(intersection_id)
+    if current is None:
         return None
+    aggregate, lights = current
     
-    # Format response
-    traffic_lights = []
-    for light in lights:
-        # Make a single prediction call per light
-        next_state, time_remaining, confidence = predict_next_change(light['light_id'], light['state'])
-        
-        traffic_lights.append({
-            "light_id": light['light_id'],
-            "current_status": light['state'],
-            "time_to_next_change_seconds": time_remaining,
-            "predicted_next_status": next_state,
-            "prediction_confidence": confidence,
-            "location": {
-                "latitude": float(light['location'].split(',')[0].strip()),
-                "longitude": float(light['location'].split(',')[1].strip())
-            },
-            "name": light['name']
-        })
+    now = time.time()
+    # Lights imported since the metadata was loaded are left out until it is reloaded
+    traffic_lights = [format_light_status(light_id, eta, now) for light_id, eta in lights
+                      if get_light_info(light_id)]
+    overall_state, red_lights, green_lights, last_change = aggregate
     
     return {
         "intersection_id": intersection_id,
         "timestamp": datetime.now().isoformat(),
+        "overall_state": overall_state,
+        "red_lights": red_lights,
+        "green_lights": green_lights,
+        "last_change": last_change,
         "traffic_lights": traffic_lights
     }
 
+def status_response(status):
+    """Serialize a status dict in the format negotiated with the client.
+
+    JSON is the default; clients can ask for protobuf or MessagePack with the
+    Accept header or the ?format= query parameter.
+    """
+    available = status_codec.available_mimetypes()
+    requested = request.args.get('format')
+    if requested:
+        mimetype = RESPONSE_FORMATS.get(requested)
+        if mimetype not in available:
+            return jsonify({"error": f"Unsupported format '{requested}'"}), 406
+    else:
+        mimetype = request.accept_mimetypes.best_match(available, default=status_codec.JSON_MIMETYPE)
+
+    if mimetype == status_codec.JSON_MIMETYPE:
+        response = jsonify(status)
+    else:
+        response = Response(_status_encoder.encode(status, mimetype), mimetype=mimetype)
+    response.vary.add('Accept')
+    return response
+
 @app.route('/status/<intersection_id>')
 def get_status(intersection_id):
     status = get_intersection_status(intersection_id)
     if not status:
         return jsonify({"error": "Intersection not found"}), 404
-    return jsonify(status)
+    return status_response(status)
+
+def get_nearby_status(latitude, longitude, radius_m):
+    """Get status of lights within radius_m meters of a point, nearest first"""
+    refresh_light_info()
+    nearby = _geo_index.within_radius(latitude, longitude, radius_m)[:MAX_SPATIAL_RESULTS]
+    states = get_current_states([light_id for light_id, _ in nearby])
+    
+    now = time.time()
+    traffic_lights = []
+    for light_id, distance in nearby:
+        if light_id not in states:
+            continue
+        light = format_light_status(light_id, states[light_id], now)
+        light["distance_meters"] = round(distance, 1)
+        traffic_lights.append(light)
+    
+    return {
+        "center": {"latitude": latitude, "longitude": longitude},
+        "radius_meters": radius_m,
+        "timestamp": datetime.now().isoformat(),
+        "traffic_lights": traffic_lights
+    }
+
+def get_bbox_status(min_lat, min_lon, max_lat, max_lon):
+    """Get status of lights inside a bounding box"""
+    refresh_light_info()
+    inside = _geo_index.within_bbox(min_lat, min_lon, max_lat, max_lon)[:MAX_SPATIAL_RESULTS]
+    states = get_current_states([light_id for light_id, _, _ in inside])
+    now = time.time()
+    
+    return {
+        "bbox": {"min_lat": min_lat, "min_lon": min_lon, "max_lat": max_lat, "max_lon": max_lon},
+        "timestamp": datetime.now().isoformat(),
+        "traffic_lights": [
+            format_light_status(light_id, states[light_id], now)
+            for light_id, _, _ in inside if light_id in states
+        ]
+    }
+
+def parse_float_args(*names, **defaults):
+    """Parse required float query parameters, returning (values, error)"""
+    values = []
+    for name in names:
+        raw = request.args.get(name, defaults.get(name))
+        if raw is None:
+            return None, f"Missing query parameter '{name}'"
+        try:
+            value = float(raw)
+        except (TypeError, ValueError):
+            return None, f"Query parameter '{name}' must be a number"
+        if not math.isfinite(value):
+            return None, f"Query parameter '{name}' must be finite"
+        values.append(value)
+    return values, None
+
+@app.route('/lights/nearby')
+def get_nearby():
+    values, error = parse_float_args('lat', 'lon', 'radius', radius=200)
+    if error:
+        return jsonify({"error": error}), 400
+    latitude, longitude, radius_m = values
+    if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+        return jsonify({"error": "Coordinates out of range"}), 400
+    if not (0 < radius_m <= MAX_NEARBY_RADIUS_M):
+        return jsonify({"error": f"Radius must be between 0 and {MAX_NEARBY_RADIUS_M} meters"}), 400
+    return status_response(get_nearby_status(latitude, longitude, radius_m))
+
+@app.route('/lights/bbox')
+def get_bbox():
+    values, error = parse_float_args('min_lat', 'min_lon', 'max_lat', 'max_lon')
+    if error:
+        return jsonify({"error": error}), 400
+    min_lat, min_lon, max_lat, max_lon = values
+    if min_lat > max_lat or min_lon > max_lon:
+        return jsonify({"error": "Bounding box minimum must not exceed maximum"}), 400
+    return status_response(get_bbox_status(min_lat, min_lon, max_lat, max_lon))
+
+def parse_history_args():
+    """Parse start/end/limit/cursor query parameters, returning (args, error)"""
+    try:
+        end = int(request.args.get('end', time.time()))
+        start = int(request.args.get('start', end - HISTORY_DEFAULT_RANGE))
+        limit = int(request.args.get('limit', HISTORY_DEFAULT_LIMIT))
+    except ValueError:
+        return None, "start, end and limit must be integers (epoch seconds for start/end)"
+
+    if start >= end:
+        return None, "start must be before end"
+    if not (1 <= limit <= HISTORY_MAX_LIMIT):
+        return None, f"limit must be between 1 and {HISTORY_MAX_LIMIT}"
+
+    cursor = request.args.get('cursor')
+    if cursor:
+        try:
+            cursor = history.decode_cursor(cursor)
+        except history.InvalidCursor as e:
+            return None, str(e)
+
+    return {'start': start, 'end': end, 'limit': limit, 'cursor': cursor}, None
+
+def history_response(light_ids, start, end, limit, cursor, **header):
+    """Stream history rows as a JSON document with a cursor for the next page"""
+    def generate():
+        yield json.dumps({**header, "start": start, "end": end})[:-1] + ', "transitions": ['
+
+        count = 0
+        last = None
+        # One extra row tells whether another page exists
+        rows = _store.history(light_ids, start, end, limit + 1, cursor)
+        for row in rows:
+            if count == limit:
+                break
+            light_id, row_id, state, timestamp = row
+            prefix = ', ' if count else ''
+            yield prefix + json.dumps({"light_id": light_id, "state": state, "timestamp": timestamp})
+            count += 1
+            last = row
+        else:
+            last = None
+        # Release the connection the rows were streamed from
+        rows.close()
+
+        next_cursor = history.encode_cursor(last[0], last[3], last[1]) if last else None
+        yield '], ' + json.dumps({"count": count, "next_cursor": next_cursor})[1:]
+
+    return Response(stream_with_context(generate()), mimetype='application/json')
+
+@app.route('/history/lights/<int:light_id>')
+def get_light_history(light_id):
+    args, error = parse_history_args()
+    if error:
+        return jsonify({"error": error}), 400
+    if args['cursor'] and args['cursor'][0] != light_id:
+        return jsonify({"error": "Cursor belongs to a different light"}), 400
+    if not get_light_info(light_id):
+        return jsonify({"error": "Traffic light not found"}), 404
+    return history_response([light_id], light_id=light_id, **args)
+
+@app.route('/history/intersections/<intersection_id>')
+def get_intersection_history(intersection_id):
+    args, error = parse_history_args()
+    if error:
+        return jsonify({"error": error}), 400
+    light_ids = _store.intersection_lights(intersection_id)
+    if not light_ids:
+        return jsonify({"error": "Intersection not found"}), 404
+    return history_response(light_ids, intersection_id=intersection_id, **args)
+
+def timeline_response(light_ids, **header):
+    """Build per-light occupancy buckets for the requested range and resolution"""
+    resolution = request.args.get('resolution', 'hour')
+    if resolution not in timeline.RESOLUTIONS:
+        return jsonify({"error": f"resolution must be one of: {', '.join(timeline.RESOLUTIONS)}"}), 400
+    bucket_seconds = timeline.RESOLUTIONS[resolution]
+
+    try:
+        end = int(request.args.get('end', time.time()))
+        start = int(request.args.get('start', end - 24 * 3600))
+    except ValueError:
+        return jsonify({"error": "start and end must be epoch seconds"}), 400
+    if start >= end:
+        return jsonify({"error": "start must be before end"}), 400
+
+    bucket_count = -(-(end - timeline.align(start, bucket_seconds)) // bucket_seconds)
+    if bucket_count * len(light_ids) > MAX_TIMELINE_BUCKETS:
+        return jsonify({"error": "Range too large for this resolution, use a coarser resolution"}), 400
+
+    lights = []
+    for light_id in light_ids:
+        info = get_light_info(light_id)
+        if info is None:
+            continue
+        buckets = []
+        for bucket, red, green, covered in _timeline_cache.occupancy(_store, light_id, start, end, bucket_seconds):
+            if covered:
+                buckets.append([bucket, round(100 * green / covered, 1), round(100 * red / covered, 1)])
+            else:
+                buckets.append([bucket, None, None])
+        lights.append({"light_id": light_id, "name": info['name'], "buckets": buckets})
+
+    return jsonify({
+        **header,
+        "start": timeline.align(start, bucket_seconds),
+        "end": end,
+        "resolution": resolution,
+        "bucket_seconds": bucket_seconds,
+        "bucket_fields": ["bucket_start", "green_percent", "red_percent"],
+        "lights": lights
+    })
+
+@app.route('/timeline/lights/<int:light_id>')
+def get_light_timeline(light_id):
+    if not get_light_info(light_id):
+        return jsonify({"error": "Traffic light not found"}), 404
+    return timeline_response([light_id], light_id=light_id)
+
+@app.route('/timeline/intersections/<intersection_id>')
+def get_intersection_timeline(intersection_id):
+    light_ids = _store.intersection_lights(intersection_id)
+    if not light_ids:
+        return jsonify({"error": "Intersection not found"}), 404
+    return timeline_response(light_ids, intersection_id=intersection_id)
+
+@app.route('/predict/lights/<int:light_id>')
+def get_light_predictions(light_id):
+    try:
+        count = int(request.args.get('count', 5))
+    except ValueError:
+        return jsonify({"error": "count must be an integer"}), 400
+    if not (1 <= count <= MAX_PREDICTED_CHANGES):
+        return jsonify({"error": f"count must be between 1 and {MAX_PREDICTED_CHANGES}"}), 400
+
+    model = get_cycle_model(light_id)
+    if not model or not model.is_locked:
+        return jsonify({"error": "No cycle model learned for this light yet"}), 404
+
+    now = time.time()
+    return jsonify({
+        "light_id": light_id,
+        "timestamp": int(now),
+        "cycle_length_seconds": round(model.cycle_length, 2),
+        "red_duration_seconds": round(model.red_duration, 2),
+        "current_status": model.state_at(now),
+        "prediction_confidence": round(model.confidence, 2),
+        "changes": [
+            {"timestamp": round(change_at, 1), "status": state}
+            for change_at, state in model.next_changes(now, count)
+        ]
+    })
+
+def format_detector_health(row, now):
+    health = detector_health.DetectorHealth.from_row(row)
+    return {
+        "detector_id": health.detector_id,
+        "status": health.status(now, DETECTOR_STALE_SECONDS),
+        "last_seen": round(health.last_seen, 1),
+        "seconds_since_seen": round(now - health.last_seen, 1),
+        "first_seen": round(health.first_seen, 1),
+        "frames": health.frames,
+        "lost_frames": health.lost,
+        "restarts": health.restarts,
+        "frame_rate": round(health.frame_rate, 3) if health.frame_rate else None,
+        "loss_rate": round(health.loss_rate, 4),
+        "clock_offset_seconds": round(health.clock_offset, 1) if health.clock_offset is not None else None,
+        "latency_seconds": round(health.latency, 2) if health.latency is not None else None,
+    }
+
+@app.route('/health/detectors')
+def get_detectors_health():
+    now = time.time()
+    detectors = [format_detector_health(row, now) for row in _store.load_detector_health()]
+    counts = defaultdict(int)
+    for detector in detectors:
+        counts[detector["status"]] += 1
+    return jsonify({
+        "timestamp": datetime.now().isoformat(),
+        "stale_after_seconds": DETECTOR_STALE_SECONDS,
+        "summary": counts,
+        "detectors": detectors
+    })
+
+@app.route('/health/detectors/<int:detector_id>')
+def get_detector_health(detector_id):
+    rows = _store.load_detector_health(detector_id)
+    if not rows:
+        return jsonify({"error": "Detector has not reported"}), 404
+    return jsonify(format_detector_health(rows[0], time.time()))
+
+@app.route('/metrics/db-pool')
+def get_db_pool_metrics():
+    return jsonify(_store.pool_stats())
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=6000)
+    # Development server only; production runs under gunicorn (see gunicorn.conf.py)
+    init_worker()
+    app.run(host='0.0.0.0', port=6000, threaded=True)
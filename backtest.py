@@ -0,0 +1,327 @@
+#!/usr/bin/env python3
+"""Backtest next-change predictors against the recorded state history.
+
+Each light's state changes are replayed in time order. While a state is
+active the predictor is asked, every --step seconds, how long until the next
+change; the answer is compared with when the change actually happened. Only
+then is the completed state fed to the predictor, so every prediction uses
+past data only.
+
+    python3 backtest.py                                    # all built-in predictors
+    python3 backtest.py --predictor ema --per-light
+    python3 backtest.py --predictor ema --sweep alpha=0.1,0.2,0.3,0.5 --sweep min_duration=3,5,8
+    python3 backtest.py --predictor mymodule:MyPredictor   # custom predictor class
+
+The built-in predictors run the listener's models and LightEta (see
+LightEtaPredictor), so they evaluate the code that ships. A predictor class is
+built with keyword parameters (from --param/--sweep) and creates one instance
+per light. It implements:
+
+    observe(state, started_at, ended_at)   a completed state of this light
+    predict(state, since, now)             seconds until `state` (active since
+                                           `since`) changes at time `now`
+"""
+import argparse
+import importlib
+import itertools
+import sqlite3
+import time
+from collections import defaultdict
+
+import numpy as np
+
+import duration_profiles
+import light_eta
+from cycle_model import CycleModel
+from duration_profiles import DurationProfile
+from duration_stats import DurationStats
+from light_eta import LightEta
+from retrain_durations import load_history
+
+DB_PATH = "/data/detectors.db"
+
+# Seconds between prediction samples while a state is active
+SAMPLE_STEP = 5
+
+# States longer than this are gaps in the data (detector offline), not signal phases
+MAX_GAP = 600
+
+
+class LightEtaPredictor:
+    """The listener's per-light models, fed and queried the way production does.
+
+    Each state change is recorded as the listener records a transition: the
+    cycle model is updated, and the duration of the state that ended goes
+    into the EMA (light_eta.next_ema), the duration statistics and the
+    time-of-day profile, or resets the EMA to the default when it is out of
+    range. The estimate for the new state is made once, with
+    LightEta.estimate(), and every prediction is LightEta.predict().
+    Subclasses only choose which models the estimate gets.
+    """
+
+    use_profile = True
+    use_cycle = True
+
+    def __init__(self, alpha=light_eta.EMA_ALPHA, min_duration=light_eta.MIN_DURATION,
+                 max_duration=light_eta.MAX_DURATION, min_samples=duration_profiles.MIN_SAMPLES):
+        self.alpha = alpha
+        self.min_duration = min_duration
+        self.max_duration = max_duration
+        self.min_samples = int(min_samples)
+        self.ema = {}
+        self.stats = defaultdict(DurationStats)
+        self.profiles = defaultdict(DurationProfile)
+        self.cycle = CycleModel()
+        self.last_change = None  # (state, since) of the latest recorded transition
+        self.eta = None
+
+    def record(self, state, changed_at):
+        """A transition into `state`, handled as in the listener's save_telemetry()"""
+        self.cycle.update(state, changed_at)
+        if self.last_change is not None:
+            prev_state, prev_since = self.last_change
+            duration = changed_at - prev_since
+            if self.min_duration <= duration <= self.max_duration:
+                self.ema[prev_state] = light_eta.next_ema(self.ema.get(prev_state), duration, self.alpha)
+                self.stats[prev_state].add(duration)
+                self.profiles[prev_state].add(prev_since, duration)
+            else:
+                self.ema[prev_state] = light_eta.DEFAULT_DURATIONS[prev_state]
+        self.last_change = (state, changed_at)
+        self.eta = self.estimate(state, changed_at)
+
+    def estimate(self, state, since):
+        profile = self.profiles.get(state) if self.use_profile else None
+        return LightEta.estimate(
+            state, since,
+            ema_duration=self.ema.get(state),
+            profile_duration=profile.expected(since, self.min_samples) if profile else None,
+            stats=self.stats.get(state),
+            cycle=self.cycle if self.use_cycle else None,
+        )
+
+    def _enter(self, state, since):
+        # The first state of a replay was entered before the history starts
+        if self.last_change != (state, since):
+            self.record(state, since)
+
+    def observe(self, state, started_at, ended_at):
+        self._enter(state, started_at)
+        self.record(light_eta.NEXT_STATE[state], ended_at)
+
+    def predict(self, state, since, now):
+        self._enter(state, since)
+        return self.eta.predict(now)[1]
+
+
+class EmaPredictor(LightEtaPredictor):
+    """LightEta from the EMA alone"""
+    use_profile = False
+    use_cycle = False
+
+
+class MedianPredictor(EmaPredictor):
+    """Candidate: the P² median of the duration statistics in place of the profile"""
+
+    def estimate(self, state, since):
+        stats = self.stats.get(state)
+        if not stats or not stats.count:
+            return super().estimate(state, since)
+        return LightEta.estimate(state, since, ema_duration=self.ema.get(state),
+                                 profile_duration=stats.quantile(0.5), stats=stats)
+
+
+class ProfilePredictor(LightEtaPredictor):
+    """LightEta from the time-of-day profile, falling back to the EMA"""
+    use_cycle = False
+
+
+class CyclePredictor(LightEtaPredictor):
+    """Every model the listener uses: the production estimate"""
+
+
+PREDICTORS = {
+    'ema': EmaPredictor,
+    'median': MedianPredictor,
+    'profile': ProfilePredictor,
+    'cycle': CyclePredictor,
+}
+
+
+def resolve_predictor(name):
+    """Built-in predictor name or a `module:Class` path"""
+    if name in PREDICTORS:
+        return PREDICTORS[name]
+    if ':' not in name:
+        raise ValueError(f"Unknown predictor '{name}' (built-in: {', '.join(PREDICTORS)})")
+    module_name, class_name = name.split(':', 1)
+    return getattr(importlib.import_module(module_name), class_name)
+
+
+def load_segments(conn, since=None, until=None, light_ids=None):
+    """Completed states per light as lists of (state, started_at, ended_at)"""
+    lights, states, timestamps = load_history(conn, since)
+    segments = defaultdict(list)
+    current = None
+    for light_id, is_green, ts in zip(lights.tolist(), states.tolist(), timestamps.tolist()):
+        if until is not None and ts > until:
+            continue
+        if light_ids and light_id not in light_ids:
+            continue
+        state = 'GREEN' if is_green else 'RED'
+        if current and current[0] == light_id:
+            if current[1] == state:
+                continue
+            segments[light_id].append((current[1], current[2], ts))
+        current = (light_id, state, ts)
+    return segments
+
+
+def load_intersections(conn):
+    return dict(conn.execute("SELECT light_id, intersection_id FROM traffic_lights").fetchall())
+
+
+def run_backtest(predictor_class, params, segments, step=SAMPLE_STEP, max_gap=MAX_GAP):
+    """Replay all lights and return (errors per light, predictions, seconds spent predicting).
+
+    Errors are predicted minus actual remaining seconds; positive means the
+    change came earlier than predicted.
+    """
+    errors = {}
+    predictions = 0
+    predict_time = 0.0
+    clock = time.perf_counter
+
+    for light_id, light_segments in segments.items():
+        predictor = predictor_class(**params)
+        light_errors = []
+        for state, started_at, ended_at in light_segments:
+            if ended_at - started_at <= max_gap:
+                samples = range(started_at, ended_at, step)
+                predicted = []
+                started = clock()
+                for now in samples:
+                    predicted.append(predictor.predict(state, started_at, now))
+                predict_time += clock() - started
+                predictions += len(predicted)
+                light_errors.extend(p - (ended_at - now) for p, now in zip(predicted, samples))
+            predictor.observe(state, started_at, ended_at)
+        errors[light_id] = np.array(light_errors, dtype=np.float64)
+
+    return errors, predictions, predict_time
+
+
+def summarize(errors):
+    """(samples, MAE, bias, P50, P90, P95 absolute error) for an array of errors"""
+    if len(errors) == 0:
+        return (0, float('nan'), float('nan'), float('nan'), float('nan'), float('nan'))
+    absolute = np.abs(errors)
+    p50, p90, p95 = np.percentile(absolute, [50, 90, 95])
+    return (len(errors), absolute.mean(), errors.mean(), p50, p90, p95)
+
+
+HEADER = f"{'Samples':>8} {'MAE':>7} {'Bias':>7} {'P50':>7} {'P90':>7} {'P95':>7}"
+
+
+def format_summary(summary):
+    samples, mae, bias, p50, p90, p95 = summary
+    return f"{samples:>8} {mae:>7.2f} {bias:>+7.2f} {p50:>7.2f} {p90:>7.2f} {p95:>7.2f}"
+
+
+def print_breakdown(errors, intersections, per_light):
+    grouped = defaultdict(list)
+    for light_id, light_errors in errors.items():
+        grouped[intersections.get(light_id, 'UNKNOWN')].append(light_id)
+
+    print(f"  {'Intersection':<20} {'Light':>6} {HEADER}")
+    for intersection_id in sorted(grouped):
+        light_ids = sorted(grouped[intersection_id])
+        combined = np.concatenate([errors[light_id] for light_id in light_ids])
+        print(f"  {intersection_id:<20} {'all':>6} {format_summary(summarize(combined))}")
+        if per_light:
+            for light_id in light_ids:
+                print(f"  {'':<20} {light_id:>6} {format_summary(summarize(errors[light_id]))}")
+
+
+def parse_params(pairs):
+    params = {}
+    for pair in pairs:
+        key, _, value = pair.partition('=')
+        if not value:
+            raise ValueError(f"Expected key=value, got '{pair}'")
+        params[key] = float(value)
+    return params
+
+
+def parse_sweep(pairs):
+    """Grid of parameter dicts from key=v1,v2,... arguments"""
+    axes = []
+    for pair in pairs:
+        key, _, values = pair.partition('=')
+        if not values:
+            raise ValueError(f"Expected key=v1,v2,..., got '{pair}'")
+        axes.append([(key, float(value)) for value in values.split(',')])
+    return [dict(combination) for combination in itertools.product(*axes)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Backtest next-change predictors against recorded history.")
+    parser.add_argument("--db", default=DB_PATH, help=f"Database path (default {DB_PATH})")
+    parser.add_argument("--predictor", action="append",
+                        help=f"Predictor to evaluate: {', '.join(PREDICTORS)} or module:Class (repeatable)")
+    parser.add_argument("--param", action="append", default=[], help="Predictor parameter key=value")
+    parser.add_argument("--sweep", action="append", default=[],
+                        help="Parameter grid axis key=v1,v2,... (repeatable)")
+    parser.add_argument("--since", type=int, help="Start of the replayed period (epoch seconds)")
+    parser.add_argument("--until", type=int, help="End of the replayed period (epoch seconds)")
+    parser.add_argument("--light", type=int, action="append", help="Only replay these lights")
+    parser.add_argument("--step", type=int, default=SAMPLE_STEP, help=f"Seconds between samples (default {SAMPLE_STEP})")
+    parser.add_argument("--max-gap", type=int, default=MAX_GAP,
+                        help=f"Skip states longer than this as data gaps (default {MAX_GAP})")
+    parser.add_argument("--per-light", action="store_true", help="Report every light, not only intersections")
+    args = parser.parse_args()
+
+    try:
+        predictors = [(name, resolve_predictor(name)) for name in (args.predictor or list(PREDICTORS))]
+        base_params = parse_params(args.param)
+        grid = parse_sweep(args.sweep) if args.sweep else [{}]
+    except (ValueError, ImportError, AttributeError) as e:
+        parser.error(str(e))
+
+    conn = sqlite3.connect(args.db)
+    try:
+        segments = load_segments(conn, args.since, args.until, set(args.light or ()))
+        intersections = load_intersections(conn)
+    finally:
+        conn.close()
+
+    states = sum(len(light_segments) for light_segments in segments.values())
+    print(f"Replaying {states} completed states of {len(segments)} lights, sampling every {args.step}s\n")
+
+    results = []
+    for name, predictor_class in predictors:
+        for overrides in grid:
+            params = {**base_params, **overrides}
+            try:
+                errors, predictions, predict_time = run_backtest(
+                    predictor_class, params, segments, args.step, args.max_gap)
+            except TypeError as e:
+                print(f"[ERROR] {name} {params}: {e}")
+                continue
+            label = name + (' ' + ' '.join(f"{k}={v:g}" for k, v in params.items()) if params else '')
+            combined = np.concatenate(list(errors.values())) if errors else np.empty(0)
+            rate = predictions / predict_time if predict_time > 0 else float('inf')
+            results.append((label, summarize(combined), rate))
+
+            if not args.sweep:
+                print(f"{label}: {predictions} predictions, {rate:,.0f} predictions/s")
+                print_breakdown(errors, intersections, args.per_light)
+                print()
+
+    print(f"{'Predictor':<40} {HEADER} {'Pred/s':>10}")
+    for label, summary, rate in sorted(results, key=lambda result: result[1][1]):
+        print(f"{label:<40} {format_summary(summary)} {rate:>10,.0f}")
+
+
+if __name__ == "__main__":
+    main()
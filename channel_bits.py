@@ -0,0 +1,56 @@
+"""Channel bitmaps of any width.
+
+Detectors report which lamp channels are lit as a bitmap, bit i for channel
+i. Older firmware sends up to 32 channels in `mqtt_msg_t.channels`; large
+junction controllers send `channel_bits`, a little-endian byte string of any
+length, so one message covers every signal head of a controller.
+
+Bitmaps are handled as Python ints, which have no width limit, so testing a
+light's channel stays a single `&` against a precomputed `1 << channel` mask.
+"""
+
+# Width of the legacy int32 channels field
+LEGACY_WIDTH = 32
+_LEGACY_MASK = (1 << LEGACY_WIDTH) - 1
+
+# SQLite integers are signed 64-bit; wider bitmaps are stored as blobs
+_SQLITE_MAX = (1 << 63) - 1
+
+
+def from_message(message):
+    """Bitmap of an mqtt_msg_t, preferring channel_bits when present"""
+    if message.channel_bits:
+        return int.from_bytes(message.channel_bits, 'little')
+    # int32 on the wire: channel 31 arrives as the sign bit
+    return message.channels & _LEGACY_MASK
+
+
+def to_message(message, channels):
+    """Set a bitmap on an mqtt_msg_t, using the legacy field when it fits"""
+    if channels >> LEGACY_WIDTH:
+        message.channel_bits = to_bytes(channels)
+    else:
+        message.channels = channels - (1 << LEGACY_WIDTH) if channels >> (LEGACY_WIDTH - 1) else channels
+
+
+def to_bytes(channels):
+    return channels.to_bytes(max(1, (channels.bit_length() + 7) // 8), 'little')
+
+
+def db_value(channels):
+    """Value for telemetry.channels: an integer, or little-endian bytes when too wide"""
+    return channels if channels <= _SQLITE_MAX else to_bytes(channels)
+
+
+def from_db(value):
+    return int.from_bytes(value, 'little') if isinstance(value, bytes) else value
+
+
+def active_channels(channels):
+    """Indexes of lit channels, lowest first"""
+    active = []
+    while channels:
+        low = channels & -channels
+        active.append(low.bit_length() - 1)
+        channels ^= low
+    return active
@@ -0,0 +1,145 @@
+"""Per-light signal cycle model learned from state transitions.
+
+A fixed-time signal repeats RED then GREEN with a constant cycle length C.
+The model keeps C, the RED part of the cycle R and an anchor: the start time
+of a recent RED phase. Any instant maps to a position in the cycle with
+``(t - anchor) % C``, so the current phase and the next N change times are a
+constant-time modular computation with no history reads.
+
+The model is updated incrementally from each recorded transition. Intervals
+between RED starts that span several cycles (because transitions were missed)
+are divided by the number of cycles they cover, and intervals that don't fit
+the learned cycle are counted as misses instead of corrupting it.
+"""
+
+# Plausible cycle lengths for a traffic signal, in seconds
+MIN_CYCLE = 10
+MAX_CYCLE = 600
+
+# Smoothing factor for cycle and red duration updates
+ALPHA = 0.2
+
+# Relative error within which an interval is accepted as k whole cycles
+CYCLE_TOLERANCE = 0.15
+
+# Samples required before the model is used for predictions
+MIN_SAMPLES = 3
+
+# Consecutive rejected intervals after which the model relearns from scratch
+MAX_MISSES = 5
+
+
+class CycleModel:
+    __slots__ = ('cycle_length', 'red_duration', 'phase_anchor', 'residual',
+                 'samples', 'misses', 'last_red_start')
+
+    def __init__(self, cycle_length=0.0, red_duration=0.0, phase_anchor=0.0, residual=0.0,
+                 samples=0, misses=0, last_red_start=None):
+        self.cycle_length = cycle_length
+        self.red_duration = red_duration
+        self.phase_anchor = phase_anchor
+        self.residual = residual
+        self.samples = samples
+        self.misses = misses
+        self.last_red_start = last_red_start
+
+    @classmethod
+    def from_row(cls, row):
+        """Build a model from a cycle_models row (without the light_id column)"""
+        return cls(*row)
+
+    def to_row(self):
+        return (self.cycle_length, self.red_duration, self.phase_anchor, self.residual,
+                self.samples, self.misses, self.last_red_start)
+
+    @property
+    def is_locked(self):
+        """True once the model has enough consistent samples to predict from"""
+        return (self.samples >= MIN_SAMPLES and self.cycle_length > 0
+                and 0 < self.red_duration < self.cycle_length
+                and self.residual <= CYCLE_TOLERANCE * self.cycle_length)
+
+    @property
+    def confidence(self):
+        """Prediction confidence from the typical phase error relative to the cycle"""
+        if not self.is_locked:
+            return 0.0
+        return max(0.5, 1.0 - 2 * self.residual / self.cycle_length)
+
+    def _phase(self, timestamp):
+        return (timestamp - self.phase_anchor) % self.cycle_length
+
+    def update(self, state, timestamp):
+        """Update the model with a transition into `state` at `timestamp`"""
+        if state == 'RED':
+            self._update_red_start(timestamp)
+        elif state == 'GREEN' and self.cycle_length > 0:
+            # Measure the red part from the phase so a missed RED start doesn't matter
+            red = self._phase(timestamp)
+            if 0 < red < self.cycle_length:
+                self.red_duration = red if self.red_duration <= 0 else (
+                    self.red_duration + ALPHA * (red - self.red_duration))
+
+    def _restart(self, interval, timestamp):
+        """Seed the model with a single cycle observation"""
+        valid = MIN_CYCLE <= interval <= MAX_CYCLE
+        self.cycle_length = float(interval) if valid else 0.0
+        self.red_duration = 0.0
+        self.phase_anchor = float(timestamp)
+        self.residual = 0.0
+        self.samples = 1 if valid else 0
+        self.misses = 0
+
+    def _update_red_start(self, timestamp):
+        previous = self.last_red_start
+        self.last_red_start = timestamp
+        if previous is None or timestamp <= previous:
+            return
+
+        interval = timestamp - previous
+        if self.cycle_length <= 0:
+            self._restart(interval, timestamp)
+            return
+
+        # Intervals spanning k cycles mean k - 1 cycles were missed
+        cycles = max(1, round(interval / self.cycle_length))
+        observed = interval / cycles
+        if abs(observed - self.cycle_length) > CYCLE_TOLERANCE * self.cycle_length:
+            self.misses += 1
+            if self.misses >= MAX_MISSES:
+                # The signal plan changed; start over from this interval
+                self._restart(interval, timestamp)
+            return
+
+        # Phase error of this RED start against the current model, wrapped to +-C/2
+        error = self._phase(timestamp)
+        if error > self.cycle_length / 2:
+            error -= self.cycle_length
+        self.residual += ALPHA * (abs(error) - self.residual)
+
+        self.cycle_length += ALPHA * (observed - self.cycle_length)
+        self.phase_anchor = float(timestamp)
+        self.samples += 1
+        self.misses = 0
+
+    def state_at(self, timestamp):
+        """Predicted state at a given time"""
+        return 'RED' if self._phase(timestamp) < self.red_duration else 'GREEN'
+
+    def next_changes(self, now, count=1):
+        """Predict the next `count` changes after `now` as (timestamp, new_state) tuples"""
+        phase = self._phase(now)
+        green_duration = self.cycle_length - self.red_duration
+        if phase < self.red_duration:
+            change_at, next_state = now + (self.red_duration - phase), 'GREEN'
+        else:
+            change_at, next_state = now + (self.cycle_length - phase), 'RED'
+
+        changes = []
+        for _ in range(count):
+            changes.append((change_at, next_state))
+            if next_state == 'GREEN':
+                change_at, next_state = change_at + green_duration, 'RED'
+            else:
+                change_at, next_state = change_at + self.red_duration, 'GREEN'
+        return changes
@@ -0,0 +1,163 @@
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+
+class PoolTimeout(Exception):
+    """Raised when no connection slot becomes free within the checkout timeout"""
+
+
+class ReadOnlyPool:
+    """Per-thread read-only SQLite connections with bounded concurrency.
+
+    Each thread keeps one connection opened with a ``mode=ro`` URI, a shared
+    page cache and ``query_only`` set, so sqlite3's statement cache keeps
+    prepared statements alive across requests. A semaphore sized by worker
+    concurrency bounds how many connections are in use at once and every
+    checkout records how long it waited for a slot.
+
+    Connections are health-checked after being idle and are recycled when the
+    database file is replaced (e.g. by a migration that swaps the file).
+    """
+
+    def __init__(self, db_path, size, checkout_timeout=10.0, health_check_interval=30.0,
+                 swap_check_interval=1.0, cached_statements=256):
+        self.db_path = db_path
+        self.size = size
+        self.checkout_timeout = checkout_timeout
+        self.health_check_interval = health_check_interval
+        self.swap_check_interval = swap_check_interval
+        self.cached_statements = cached_statements
+
+        self._slots = threading.BoundedSemaphore(size)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+        # Bumped whenever the database file changes identity; connections
+        # opened under an older generation are reopened on next checkout
+        self._generation = 0
+        self._file_id = self._stat_file()
+        self._last_swap_check = time.monotonic()
+
+        self._stats = {
+            'checkouts': 0,
+            'waited_checkouts': 0,
+            'total_wait_ms': 0.0,
+            'max_wait_ms': 0.0,
+            'timeouts': 0,
+            'connects': 0,
+            'health_check_failures': 0,
+            'recycled_after_swap': 0,
+        }
+
+    def _stat_file(self):
+        try:
+            st = os.stat(self.db_path)
+        except OSError:
+            return None
+        return (st.st_dev, st.st_ino)
+
+    def _check_for_swap(self):
+        """Detect a replaced database file, at most once per swap_check_interval"""
+        now = time.monotonic()
+        if now - self._last_swap_check < self.swap_check_interval:
+            return
+
+        with self._lock:
+            if now - self._last_swap_check < self.swap_check_interval:
+                return
+            self._last_swap_check = now
+            file_id = self._stat_file()
+            if file_id != self._file_id:
+                print(f"[POOL] Database file {self.db_path} changed, recycling connections")
+                self._file_id = file_id
+                self._generation += 1
+
+    def _connect(self):
+        uri = f"file:{self.db_path}?mode=ro&cache=shared"
+        conn = sqlite3.connect(uri, uri=True, timeout=5.0, cached_statements=self.cached_statements)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA query_only = 1")
+
+        with self._lock:
+            self._stats['connects'] += 1
+        return conn
+
+    def _close_thread_connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            try:
+                conn.close()
+            except sqlite3.Error:
+                pass
+        self._local.conn = None
+
+    def _thread_connection(self):
+        """Return this thread's connection, reopening it if stale or unhealthy"""
+        self._check_for_swap()
+        conn = getattr(self._local, 'conn', None)
+        now = time.monotonic()
+
+        if conn is not None and self._local.generation != self._generation:
+            with self._lock:
+                self._stats['recycled_after_swap'] += 1
+            self._close_thread_connection()
+            conn = None
+
+        if conn is not None and now - self._local.checked_at > self.health_check_interval:
+            try:
+                conn.execute("SELECT 1").fetchone()
+                self._local.checked_at = now
+            except sqlite3.Error as e:
+                print(f"[POOL] Health check failed, reconnecting: {e}")
+                with self._lock:
+                    self._stats['health_check_failures'] += 1
+                self._close_thread_connection()
+                conn = None
+
+        if conn is None:
+            conn = self._connect()
+            self._local.conn = conn
+            self._local.generation = self._generation
+            self._local.checked_at = now
+
+        return conn
+
+    @contextmanager
+    def connection(self):
+        """Check out this thread's read-only connection"""
+        start = time.monotonic()
+        if not self._slots.acquire(timeout=self.checkout_timeout):
+            with self._lock:
+                self._stats['timeouts'] += 1
+            raise PoolTimeout(f"No database connection available within {self.checkout_timeout}s")
+
+        wait_ms = (time.monotonic() - start) * 1000
+        with self._lock:
+            self._stats['checkouts'] += 1
+            self._stats['total_wait_ms'] += wait_ms
+            self._stats['max_wait_ms'] = max(self._stats['max_wait_ms'], wait_ms)
+            if wait_ms >= 1.0:
+                self._stats['waited_checkouts'] += 1
+
+        try:
+            conn = self._thread_connection()
+            try:
+                yield conn
+            except sqlite3.DatabaseError:
+                # Don't reuse a connection that may be in a broken state
+                self._close_thread_connection()
+                raise
+        finally:
+            self._slots.release()
+
+    def stats(self):
+        """Snapshot of checkout and connection metrics"""
+        with self._lock:
+            stats = dict(self._stats)
+        stats['size'] = self.size
+        stats['generation'] = self._generation
+        stats['avg_wait_ms'] = stats['total_wait_ms'] / stats['checkouts'] if stats['checkouts'] else 0.0
+        return stats
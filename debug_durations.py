@@ -1,7 +1,6 @@
 #!/usr/bin/env python3
 import sqlite3
 import time
-from datetime import datetime, timedelta
 
 DB_PATH = "/data/detectors.db"
 
@@ -51,19 +50,8 @@ def fix_unreasonable_durations():
                     prev_id = state_id
                     continue
                 
-                # Calculate duration
+                # Calculate duration (timestamps are integer epoch seconds)
                 try:
-                    # Ensure timestamps are numeric
-                    if isinstance(prev_timestamp, str) and not prev_timestamp.isdigit():
-                        prev_timestamp = int(datetime.fromisoformat(prev_timestamp).timestamp())
-                    else:
-                        prev_timestamp = int(float(prev_timestamp))
-                        
-                    if isinstance(timestamp, str) and not timestamp.isdigit():
-                        timestamp = int(datetime.fromisoformat(timestamp).timestamp())
-                    else:
-                        timestamp = int(float(timestamp))
-                    
                     duration = timestamp - prev_timestamp
                     
                     # Check if duration is unreasonable
@@ -152,7 +140,7 @@ def fix_unreasonable_durations():
                         INSERT OR REPLACE INTO state_durations
                         (light_id, previous_state, next_state, duration, last_updated)
                         VALUES (?, ?, ?, ?, ?)
-                    """, (light_id, 'RED', 'GREEN', avg_red_to_green, datetime.now().isoformat()))
+                    """, (light_id, 'RED', 'GREEN', avg_red_to_green, int(time.time())))
                 
                 if green_to_red_durations:
                     avg_green_to_red = sum(green_to_red_durations) / len(green_to_red_durations)
@@ -163,7 +151,7 @@ def fix_unreasonable_durations():
                         INSERT OR REPLACE INTO state_durations
                         (light_id, previous_state, next_state, duration, last_updated)
                         VALUES (?, ?, ?, ?, ?)
-                    """, (light_id, 'GREEN', 'RED', avg_green_to_red, datetime.now().isoformat()))
+                    """, (light_id, 'GREEN', 'RED', avg_green_to_red, int(time.time())))
         
         # Commit all changes
         conn.commit()
@@ -0,0 +1,116 @@
+"""Per-detector liveness and link quality.
+
+The listener keeps one DetectorHealth per detector and feeds it every frame,
+using the counter and device timestamp carried in mqtt_msg_t:
+
+- frame rate: EMA of the interval between frames
+- loss: gaps in the counter (frames sent but never received); a counter that
+  goes backwards is a device restart, not loss
+- clock offset: server time minus device time, taken as the smallest
+  difference seen, since transport delay can only add to it
+- latency: EMA of how much a frame's difference exceeds that offset
+
+Updates are O(1). The listener flushes the trackers to the detector_health
+table periodically, where the API reads them.
+
+With a shared subscription each listener instance only sees part of a
+detector's frames, so counter gaps are expected; such trackers are created
+with count_gaps=False and their flushes are merged in the table instead.
+"""
+
+# Weight of the newest frame in the moving averages
+EMA_ALPHA = 0.1
+
+# A counter jump larger than this is treated as a restart rather than loss
+MAX_COUNTER_GAP = 10000
+
+# Seconds without frames after which a detector is considered dead
+STALE_AFTER = 60
+
+# Thresholds for reporting a live detector as degraded
+LOSSY_RATE = 0.05
+LAGGING_LATENCY = 5.0
+
+# detector_health columns in the order of to_row()/from_row()
+COLUMNS = ('detector_id', 'first_seen', 'last_seen', 'frames', 'lost', 'restarts', 'last_counter',
+           'frame_interval', 'loss_rate', 'clock_offset', 'latency')
+
+
+def status(last_seen, loss_rate, latency, now, stale_after=STALE_AFTER):
+    """'stale', 'lossy', 'lagging' or 'ok'"""
+    if last_seen is None or now - last_seen > stale_after:
+        return 'stale'
+    if loss_rate >= LOSSY_RATE:
+        return 'lossy'
+    if latency is not None and latency >= LAGGING_LATENCY:
+        return 'lagging'
+    return 'ok'
+
+
+class DetectorHealth:
+    __slots__ = ('detector_id', 'first_seen', 'last_seen', 'frames', 'lost', 'restarts', 'last_counter',
+                 'frame_interval', 'loss_rate', 'clock_offset', 'latency', 'count_gaps')
+
+    def __init__(self, detector_id, first_seen=None, last_seen=None, frames=0, lost=0, restarts=0,
+                 last_counter=None, frame_interval=None, loss_rate=0.0, clock_offset=None, latency=None,
+                 count_gaps=True):
+        self.detector_id = detector_id
+        self.first_seen = first_seen
+        self.last_seen = last_seen
+        self.frames = frames
+        self.lost = lost
+        self.restarts = restarts
+        self.last_counter = last_counter
+        self.frame_interval = frame_interval
+        self.loss_rate = loss_rate
+        self.clock_offset = clock_offset
+        self.latency = latency
+        self.count_gaps = count_gaps
+
+    @classmethod
+    def from_row(cls, row, count_gaps=True):
+        return cls(*row, count_gaps=count_gaps)
+
+    def to_row(self):
+        return (self.detector_id, self.first_seen, self.last_seen, self.frames, self.lost, self.restarts,
+                self.last_counter, self.frame_interval, self.loss_rate, self.clock_offset, self.latency)
+
+    def update(self, counter, device_time, now):
+        """Record a frame received at server time `now`"""
+        if self.first_seen is None:
+            self.first_seen = now
+        if self.last_seen is not None and now > self.last_seen:
+            interval = now - self.last_seen
+            self.frame_interval = (interval if self.frame_interval is None
+                                   else EMA_ALPHA * interval + (1 - EMA_ALPHA) * self.frame_interval)
+        self.last_seen = now
+        self.frames += 1
+
+        missed = 0
+        if self.last_counter is not None:
+            gap = counter - self.last_counter
+            if 0 < gap <= MAX_COUNTER_GAP:
+                missed = gap - 1 if self.count_gaps else 0
+            elif gap != 0:
+                # Device restarted; its clock may have changed too
+                self.restarts += 1
+                self.clock_offset = None
+        self.last_counter = counter
+        self.lost += missed
+        # Fraction of frames lost, averaged per received frame
+        self.loss_rate = EMA_ALPHA * (missed / (missed + 1)) + (1 - EMA_ALPHA) * self.loss_rate
+
+        if device_time:
+            delta = now - device_time
+            if self.clock_offset is None or delta < self.clock_offset:
+                self.clock_offset = delta
+            delay = delta - self.clock_offset
+            self.latency = delay if self.latency is None else EMA_ALPHA * delay + (1 - EMA_ALPHA) * self.latency
+
+    @property
+    def frame_rate(self):
+        """Frames per second, None until two frames were seen"""
+        return 1.0 / self.frame_interval if self.frame_interval else None
+
+    def status(self, now, stale_after=STALE_AFTER):
+        return status(self.last_seen, self.loss_rate, self.latency, now, stale_after)
@@ -8,7 +8,7 @@ def display_traffic_lights():
     cursor = conn.cursor()
 
     cursor.execute("""
-        SELECT tl.light_id, tl.name, tl.location, tlc.detector_id, tlc.channel_mask, tlc.signal_color
+        SELECT tl.light_id, tl.name, tl.location, tlc.detector_id, tlc.channel, tlc.signal_color
         FROM traffic_lights tl
         JOIN traffic_light_channels tlc ON tl.light_id = tlc.light_id
         ORDER BY tl.light_id, tlc.signal_color
@@ -23,13 +23,13 @@ def display_traffic_lights():
 
     print("Configured Traffic Lights:")
     current_id = None
-    for light_id, name, location, detector_id, channel_mask, signal_color in traffic_lights:
+    for light_id, name, location, detector_id, channel, signal_color in traffic_lights:
         if light_id != current_id:
             print(f"\nTraffic Light ID: {light_id}")
             print(f"  Name: {name}")
             print(f"  Location: {location}")
             current_id = light_id
-        print(f"  {signal_color} Signal - Channel: {detector_id}.{channel_mask}")
+        print(f"  {signal_color} Signal - Channel: {detector_id}.{channel}")
 
 if __name__ == "__main__":
     display_traffic_lights()
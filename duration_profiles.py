@@ -0,0 +1,74 @@
+"""Time-of-day and weekday duration profiles for one transition type.
+
+Signal plans change between rush hour, midday and night, so durations are
+averaged separately per time bucket. A profile is a dense array of 240
+buckets at three levels of detail, all updated on every transition:
+
+    0..167    weekday * 24 + hour          (Monday 00:00 is bucket 0)
+    168..215  168 + day_type * 24 + hour   (day_type 0 = weekday, 1 = weekend)
+    216..239  216 + hour                   (hour of day across all days)
+
+Lookup takes the finest bucket with enough samples, so a lightly used hour
+falls back to the weekday/weekend average and then to the plain hourly one.
+Buckets are local time; set TZ in the container to the city's time zone.
+"""
+import time
+from array import array
+
+HOURS = 24
+DAY_TYPE_OFFSET = 7 * HOURS
+HOURLY_OFFSET = DAY_TYPE_OFFSET + 2 * HOURS
+BUCKETS = HOURLY_OFFSET + HOURS
+
+# Samples a bucket needs before it is used instead of a coarser one
+MIN_SAMPLES = 5
+
+# Buckets average their first WINDOW samples, then weight new ones by 1/WINDOW,
+# so a changed signal plan replaces the old durations within a few weeks
+WINDOW = 20
+
+
+def bucket_indexes(timestamp):
+    """Fine, day-type and hourly bucket indexes for a timestamp, finest first"""
+    local = time.localtime(timestamp)
+    hour = local.tm_hour
+    weekday = local.tm_wday
+    day_type = 1 if weekday >= 5 else 0
+    return (weekday * HOURS + hour, DAY_TYPE_OFFSET + day_type * HOURS + hour, HOURLY_OFFSET + hour)
+
+
+class DurationProfile:
+    """Dense per-bucket mean durations and sample counts"""
+
+    __slots__ = ('means', 'counts')
+
+    def __init__(self, means=None, counts=None):
+        self.means = means if means is not None else array('f', [0.0] * BUCKETS)
+        self.counts = counts if counts is not None else array('H', [0] * BUCKETS)
+
+    def add(self, timestamp, duration):
+        """Record a duration for the state that started at `timestamp`"""
+        for index in bucket_indexes(timestamp):
+            count = min(self.counts[index] + 1, WINDOW)
+            self.means[index] += (duration - self.means[index]) / count
+            if self.counts[index] < 0xffff:
+                self.counts[index] += 1
+
+    def expected(self, timestamp, min_samples=MIN_SAMPLES):
+        """Mean duration for the finest bucket with enough samples, or None"""
+        for index in bucket_indexes(timestamp):
+            if self.counts[index] >= min_samples:
+                return float(self.means[index])
+        return None
+
+    def to_blob(self):
+        return self.means.tobytes() + self.counts.tobytes()
+
+    @classmethod
+    def from_blob(cls, blob):
+        means = array('f')
+        counts = array('H')
+        split = BUCKETS * means.itemsize
+        means.frombytes(blob[:split])
+        counts.frombytes(blob[split:])
+        return cls(means, counts)
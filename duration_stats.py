@@ -0,0 +1,173 @@
+"""Streaming statistics of state durations with constant memory.
+
+Each (light, previous_state, next_state) transition type keeps a count, the
+Welford running mean and sum of squared deviations, and P² estimators
+(Jain & Chlamtac, 1985) for the 10th, 50th and 90th percentiles. The whole
+state packs into a fixed 140-byte blob, so it can be stored next to the EMA
+in the database and updated in O(1) per transition without reading history.
+"""
+import math
+import struct
+
+QUANTILES = (0.1, 0.5, 0.9)
+
+_HEADER = struct.Struct('<Idd')      # count, mean, m2
+_MARKERS = struct.Struct('<5f5I')    # marker heights, marker positions
+
+
+class P2Quantile:
+    """P² estimator of a single quantile using five markers"""
+
+    __slots__ = ('p', 'heights', 'positions')
+
+    def __init__(self, p, heights=None, positions=None):
+        self.p = p
+        self.heights = heights if heights is not None else []
+        self.positions = positions if positions is not None else [1, 2, 3, 4, 5]
+
+    def _desired(self, count):
+        p = self.p
+        return [1 + (count - 1) * dn for dn in (0.0, p / 2, p, (1 + p) / 2, 1.0)]
+
+    def add(self, x, count):
+        """Add observation x; count is the number of observations including x"""
+        q = self.heights
+        if count <= 5:
+            # Until five observations arrive the markers are the sorted samples
+            q.append(x)
+            q.sort()
+            return
+
+        n = self.positions
+        if x < q[0]:
+            q[0] = x
+            k = 0
+        elif x >= q[4]:
+            q[4] = x
+            k = 3
+        else:
+            k = 0
+            while k < 3 and x >= q[k + 1]:
+                k += 1
+
+        for i in range(k + 1, 5):
+            n[i] += 1
+
+        desired = self._desired(count)
+        for i in (1, 2, 3):
+            d = desired[i] - n[i]
+            if (d >= 1 and n[i + 1] - n[i] > 1) or (d <= -1 and n[i - 1] - n[i] < -1):
+                step = 1 if d > 0 else -1
+                candidate = self._parabolic(i, step)
+                if not q[i - 1] < candidate < q[i + 1]:
+                    candidate = q[i] + step * (q[i + step] - q[i]) / (n[i + step] - n[i])
+                q[i] = candidate
+                n[i] += step
+
+    def _parabolic(self, i, step):
+        q, n = self.heights, self.positions
+        return q[i] + step / (n[i + 1] - n[i - 1]) * (
+            (n[i] - n[i - 1] + step) * (q[i + 1] - q[i]) / (n[i + 1] - n[i])
+            + (n[i + 1] - n[i] - step) * (q[i] - q[i - 1]) / (n[i] - n[i - 1]))
+
+    def value(self):
+        q = self.heights
+        if not q:
+            return None
+        if len(q) < 5:
+            # Nearest-rank estimate from the raw samples
+            return q[min(len(q) - 1, int(self.p * len(q)))]
+        return q[2]
+
+
+class DurationStats:
+    """Count, mean, variance and quantile sketch for one transition type"""
+
+    __slots__ = ('count', 'mean', 'm2', 'quantiles')
+
+    def __init__(self, count=0, mean=0.0, m2=0.0, quantiles=None):
+        self.count = count
+        self.mean = mean
+        self.m2 = m2
+        self.quantiles = quantiles if quantiles is not None else [P2Quantile(p) for p in QUANTILES]
+
+    def add(self, duration):
+        self.count += 1
+        delta = duration - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (duration - self.mean)
+        for estimator in self.quantiles:
+            estimator.add(duration, self.count)
+
+    @property
+    def variance(self):
+        return self.m2 / (self.count - 1) if self.count > 1 else 0.0
+
+    @property
+    def stddev(self):
+        return math.sqrt(self.variance)
+
+    def quantile(self, p):
+        for estimator in self.quantiles:
+            if estimator.p == p:
+                return estimator.value()
+        raise KeyError(f"Quantile {p} is not tracked")
+
+    def interval(self):
+        """(low, high) duration range covering the central 80% of observations"""
+        return self.quantile(QUANTILES[0]), self.quantile(QUANTILES[-1])
+
+    def confidence(self):
+        """Confidence in [0.1, 1.0] from the spread of durations and the sample size.
+
+        A tight distribution (low coefficient of variation) with many samples
+        is trusted; a wide one or a handful of samples is not.
+        """
+        if self.count < 2 or self.mean <= 0:
+            return 0.1
+        spread = min(1.0, self.stddev / self.mean)
+        support = self.count / (self.count + 5)
+        return max(0.1, min(1.0, (1.0 - spread) * support))
+
+    @classmethod
+    def from_summary(cls, count, mean, m2, sorted_durations):
+        """Build stats from exact batch moments and the sorted observations.
+
+        The P² markers are placed at the positions the streaming algorithm
+        would aim for after `count` observations, so later streaming updates
+        continue seamlessly from a batch retrain.
+        """
+        quantiles = []
+        for p in QUANTILES:
+            estimator = P2Quantile(p)
+            if count <= 5:
+                estimator.heights = [float(d) for d in sorted_durations[:count]]
+            else:
+                positions = [int(round(n)) for n in estimator._desired(count)]
+                for i in (1, 2, 3):
+                    positions[i] = max(positions[i], positions[i - 1] + 1)
+                for i in (3, 2, 1):
+                    positions[i] = min(positions[i], positions[i + 1] - 1)
+                estimator.positions = positions
+                estimator.heights = [float(sorted_durations[n - 1]) for n in positions]
+            quantiles.append(estimator)
+        return cls(int(count), float(mean), float(m2), quantiles)
+
+    def to_blob(self):
+        parts = [_HEADER.pack(self.count, self.mean, self.m2)]
+        for estimator in self.quantiles:
+            heights = (estimator.heights + [0.0] * 5)[:5]
+            parts.append(_MARKERS.pack(*heights, *estimator.positions))
+        return b''.join(parts)
+
+    @classmethod
+    def from_blob(cls, blob):
+        count, mean, m2 = _HEADER.unpack_from(blob, 0)
+        quantiles = []
+        offset = _HEADER.size
+        for p in QUANTILES:
+            values = _MARKERS.unpack_from(blob, offset)
+            offset += _MARKERS.size
+            heights = list(values[:min(count, 5)])
+            quantiles.append(P2Quantile(p, heights, list(values[5:])))
+        return cls(count, mean, m2, quantiles)
@@ -0,0 +1,81 @@
+import math
+from collections import defaultdict
+
+EARTH_RADIUS_M = 6371000.0
+METERS_PER_DEGREE_LAT = 111320.0
+
+
+def haversine_m(lat1, lon1, lat2, lon2):
+    """Great-circle distance between two points in meters"""
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    dphi = phi2 - phi1
+    dlambda = math.radians(lon2 - lon1)
+    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlambda / 2) ** 2
+    return 2 * EARTH_RADIUS_M * math.asin(math.sqrt(a))
+
+
+class GridIndex:
+    """Uniform lat/lon grid over traffic light positions.
+
+    Points are bucketed into square cells of ``cell_size`` degrees, so radius
+    and bounding box queries only visit the few cells that overlap the query
+    area instead of every light in the city.
+    """
+
+    def __init__(self, cell_size=0.005):
+        self.cell_size = cell_size
+        self._cells = defaultdict(list)
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def _cell(self, lat, lon):
+        return (math.floor(lat / self.cell_size), math.floor(lon / self.cell_size))
+
+    def build(self, points):
+        """Rebuild the index from (light_id, latitude, longitude) tuples"""
+        self._cells.clear()
+        self._count = 0
+        for light_id, lat, lon in points:
+            if lat is None or lon is None:
+                continue
+            self._cells[self._cell(lat, lon)].append((light_id, lat, lon))
+            self._count += 1
+
+    def _candidates(self, min_lat, min_lon, max_lat, max_lon):
+        min_x, min_y = self._cell(min_lat, min_lon)
+        max_x, max_y = self._cell(max_lat, max_lon)
+
+        # A query spanning more cells than are occupied is cheaper as a scan
+        if (max_x - min_x + 1) * (max_y - min_y + 1) > len(self._cells):
+            for points in self._cells.values():
+                yield from points
+            return
+
+        for x in range(min_x, max_x + 1):
+            for y in range(min_y, max_y + 1):
+                yield from self._cells.get((x, y), ())
+
+    def within_bbox(self, min_lat, min_lon, max_lat, max_lon):
+        """Lights inside the bounding box as (light_id, lat, lon) tuples"""
+        return [
+            (light_id, lat, lon)
+            for light_id, lat, lon in self._candidates(min_lat, min_lon, max_lat, max_lon)
+            if min_lat <= lat <= max_lat and min_lon <= lon <= max_lon
+        ]
+
+    def within_radius(self, lat, lon, radius_m):
+        """Lights within radius_m of a point as (light_id, distance_m), nearest first"""
+        dlat = radius_m / METERS_PER_DEGREE_LAT
+        # Guard against the degenerate longitude span near the poles
+        dlon = radius_m / (METERS_PER_DEGREE_LAT * max(math.cos(math.radians(lat)), 1e-6))
+
+        results = []
+        for light_id, plat, plon in self._candidates(lat - dlat, lon - dlon, lat + dlat, lon + dlon):
+            distance = haversine_m(lat, lon, plat, plon)
+            if distance <= radius_m:
+                results.append((light_id, distance))
+
+        results.sort(key=lambda item: item[1])
+        return results
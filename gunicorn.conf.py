@@ -0,0 +1,52 @@
+"""Gunicorn settings for the production API server.
+
+All values can be overridden through environment variables:
+
+    API_BIND              address to listen on (default 0.0.0.0:6000)
+    API_WORKERS           worker processes (default: number of CPUs)
+    API_THREADS           threads per worker (default 4)
+    API_TIMEOUT           seconds before a silent worker is killed (default 30)
+    API_GRACEFUL_TIMEOUT  seconds to finish in-flight requests on reload/stop (default 30)
+    API_MAX_REQUESTS      recycle a worker after this many requests, 0 disables (default 0)
+
+Send SIGHUP to the master process for a graceful reload: new workers are
+started with freshly imported code before old ones are shut down.
+"""
+import multiprocessing
+import os
+import sys
+
+wsgi_app = "api_server:app"
+chdir = os.path.dirname(os.path.abspath(__file__))
+
+bind = os.environ.get("API_BIND", "0.0.0.0:6000")
+workers = int(os.environ.get("API_WORKERS", multiprocessing.cpu_count()))
+worker_class = "gthread"
+threads = int(os.environ.get("API_THREADS", 4))
+
+timeout = int(os.environ.get("API_TIMEOUT", 30))
+graceful_timeout = int(os.environ.get("API_GRACEFUL_TIMEOUT", 30))
+keepalive = 5
+
+max_requests = int(os.environ.get("API_MAX_REQUESTS", 0))
+max_requests_jitter = max_requests // 10
+
+# The app is imported in each worker, not in the master, so that a graceful
+# reload picks up new code and no DB connection is ever shared across fork.
+preload_app = False
+
+accesslog = "-"
+errorlog = "-"
+
+
+def post_worker_init(worker):
+    """Verify the schema and warm per-worker caches before accepting requests."""
+    import api_server
+    from gunicorn.arbiter import Arbiter
+
+    try:
+        api_server.init_worker()
+    except RuntimeError as e:
+        # A missing schema will not fix itself; stop the master instead of respawning forever
+        worker.log.error("Worker init failed: %s", e)
+        sys.exit(Arbiter.WORKER_BOOT_ERROR)
@@ -0,0 +1,73 @@
+"""Keyset-paginated reads of traffic_light_states.
+
+Rows are returned in (light_id, timestamp, id) order, which is the order of
+the idx_traffic_light_states_light_timestamp index (the rowid is implicitly
+part of every index). Each page continues from an opaque cursor holding the
+last row's key, so every query is an index range scan bounded by LIMIT and
+no request ever scans more than ``limit`` rows plus one per light.
+"""
+import base64
+import binascii
+
+HISTORY_QUERY = """
+    SELECT id, state, timestamp
+    FROM traffic_light_states
+    WHERE light_id = ? AND timestamp >= ? AND timestamp < ?
+    ORDER BY timestamp, id
+    LIMIT ?
+"""
+
+HISTORY_AFTER_QUERY = """
+    SELECT id, state, timestamp
+    FROM traffic_light_states
+    WHERE light_id = ? AND timestamp >= ? AND timestamp < ?
+      AND (timestamp > ? OR id > ?)
+    ORDER BY timestamp, id
+    LIMIT ?
+"""
+
+
+class InvalidCursor(ValueError):
+    """Raised when a pagination cursor cannot be decoded"""
+
+
+def encode_cursor(light_id, timestamp, row_id):
+    raw = f"{light_id}:{timestamp}:{row_id}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Decode a cursor into (light_id, timestamp, row_id)"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        light_id, timestamp, row_id = raw.split(':')
+        return int(light_id), int(timestamp), int(row_id)
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise InvalidCursor(f"Invalid cursor '{cursor}'")
+
+
+def iter_history(conn, light_ids, start, end, limit, cursor=None):
+    """Yield (light_id, row_id, state, timestamp) for start <= timestamp < end.
+
+    At most ``limit`` rows are produced across all lights. ``cursor`` is a
+    decoded (light_id, timestamp, row_id) key; iteration resumes after it.
+    Rows are streamed from the SQLite cursor rather than materialized.
+    """
+    remaining = limit
+    for light_id in sorted(light_ids):
+        if remaining <= 0:
+            return
+
+        if cursor and light_id < cursor[0]:
+            continue
+
+        if cursor and light_id == cursor[0]:
+            _, after_timestamp, after_id = cursor
+            rows = conn.execute(HISTORY_AFTER_QUERY, (
+                light_id, max(start, after_timestamp), end, after_timestamp, after_id, remaining))
+        else:
+            rows = conn.execute(HISTORY_QUERY, (light_id, start, end, remaining))
+
+        for row_id, state, timestamp in rows:
+            remaining -= 1
+            yield light_id, row_id, state, timestamp
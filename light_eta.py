@@ -0,0 +1,120 @@
+"""Precomputed next-change estimate for a light.
+
+The listener builds an estimate whenever a light changes state, from the
+models it already holds in memory (cycle model, time-of-day profile, duration
+statistics, EMA), and stores it in the light_current table. Readers only
+subtract the current time, so serving a prediction costs one primary key
+lookup no matter how many clients poll.
+
+Lights that run past their expected change are handled from the same row: a
+locked cycle model is rolled forward to its next change, otherwise the change
+is reported as imminent with reduced confidence.
+"""
+from cycle_model import CycleModel
+
+# Used when a transition type has no observed durations yet, and stored as its EMA
+# when a duration is out of range
+DEFAULT_DURATIONS = {'RED': 30, 'GREEN': 15}
+DEFAULT_CONFIDENCE = 0.5
+
+# Observed durations outside this range are glitches or data gaps, not signal phases
+MIN_DURATION = 5
+MAX_DURATION = 300
+
+# Weight of a new duration in the EMA of a transition type
+EMA_ALPHA = 0.3
+
+# Remaining time reported once a state has lasted longer than expected
+OVERDUE_REMAINING = 3.0
+
+# States older than this mean the light stopped reporting; assume it just started
+STALE_AFTER = 86400
+
+NEXT_STATE = {'RED': 'GREEN', 'GREEN': 'RED'}
+
+
+def next_ema(existing, duration, alpha=EMA_ALPHA):
+    """EMA of a transition type's durations after a valid `duration`"""
+    return duration if existing is None else alpha * duration + (1 - alpha) * existing
+
+
+class LightEta:
+    __slots__ = ('state', 'state_since', 'next_state', 'expected_duration', 'interval_low',
+                 'interval_high', 'confidence', 'cycle')
+
+    def __init__(self, state, state_since, next_state, expected_duration, interval_low=None,
+                 interval_high=None, confidence=DEFAULT_CONFIDENCE, cycle=None):
+        self.state = state
+        self.state_since = state_since
+        self.next_state = next_state
+        self.expected_duration = expected_duration
+        self.interval_low = interval_low
+        self.interval_high = interval_high
+        self.confidence = confidence
+        self.cycle = cycle
+
+    @classmethod
+    def estimate(cls, state, since, ema_duration=None, profile_duration=None, stats=None, cycle=None):
+        """Estimate when `state`, entered at `since`, ends.
+
+        The profile duration is preferred over the EMA; statistics with at
+        least two samples give the interval and confidence. A cycle model is
+        only kept when it is locked.
+        """
+        duration = profile_duration if profile_duration is not None else ema_duration
+        if duration is None:
+            duration, confidence = DEFAULT_DURATIONS[state], DEFAULT_CONFIDENCE
+        else:
+            confidence = 1.0
+        low = high = None
+        if stats is not None and stats.count >= 2:
+            low, high = stats.interval()
+            confidence = stats.confidence()
+        if cycle is not None and not cycle.is_locked:
+            cycle = None
+        return cls(state, since, NEXT_STATE[state], float(duration), low, high, confidence, cycle)
+
+    @classmethod
+    def from_row(cls, row):
+        """Build from a light_current row without the light_id and updated_at columns"""
+        (state, since, next_state, duration, low, high, confidence,
+         cycle_length, red_duration, phase_anchor, residual, samples) = row
+        cycle = None
+        if cycle_length is not None:
+            cycle = CycleModel(cycle_length, red_duration, phase_anchor, residual, samples)
+        return cls(state, since, next_state, duration, low, high, confidence, cycle)
+
+    def to_row(self):
+        cycle = self.cycle
+        cycle_fields = ((cycle.cycle_length, cycle.red_duration, cycle.phase_anchor, cycle.residual,
+                         cycle.samples) if cycle else (None,) * 5)
+        return (self.state, self.state_since, self.next_state, self.expected_duration,
+                self.interval_low, self.interval_high, self.confidence, *cycle_fields)
+
+    def predict(self, now):
+        """(next_state, time_remaining, confidence, interval) at time `now`.
+
+        interval is a (low, high) range for time_remaining, or None.
+        """
+        cycle = self.cycle
+        if cycle is not None and cycle.state_at(now) == self.state:
+            change_at, next_state = cycle.next_changes(now)[0]
+            remaining = change_at - now
+            return (next_state, remaining, cycle.confidence,
+                    (max(0.0, remaining - cycle.residual), remaining + cycle.residual))
+
+        elapsed = now - self.state_since
+        duration = self.expected_duration
+        has_interval = self.interval_low is not None
+
+        if elapsed > STALE_AFTER:
+            # No transition recorded for a day; assume we're at the start of the state
+            interval = (self.interval_low, self.interval_high) if has_interval else None
+            return (self.next_state, duration * 0.9, min(0.7, self.confidence), interval)
+
+        interval = None
+        if has_interval:
+            interval = (max(0.0, self.interval_low - elapsed), max(0.0, self.interval_high - elapsed))
+        if elapsed >= duration:
+            return (self.next_state, OVERDUE_REMAINING, min(0.8, self.confidence), interval)
+        return (self.next_state, duration - elapsed, self.confidence, interval)
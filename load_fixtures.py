@@ -1,6 +1,8 @@
 import sqlite3
 from datetime import datetime
 
+import schema
+
 DB_PATH = "/data/detectors.db"
 
 def load_fixtures():
@@ -9,33 +11,8 @@ def load_fixtures():
     cursor = conn.cursor()
     
     # Create required tables
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS traffic_lights (
-            light_id INTEGER PRIMARY KEY AUTOINCREMENT,
-            name TEXT UNIQUE NOT NULL,
-            location TEXT NOT NULL,
-            intersection_id TEXT NOT NULL DEFAULT 'UNGROUPED'
-        )
-    """)
-    
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS traffic_light_channels (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            light_id INTEGER NOT NULL,
-            detector_id INTEGER NOT NULL,
-            channel_mask INTEGER NOT NULL,
-            signal_color TEXT CHECK(signal_color IN ('RED', 'GREEN')) NOT NULL,
-            FOREIGN KEY (light_id) REFERENCES traffic_lights(light_id)
-        )
-    """)
-    
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS detectors (
-            name TEXT PRIMARY KEY,
-            password TEXT NOT NULL
-        )
-    """)
-    
+    schema.migrate(conn)
+
     # Create intersection
     intersection_id = "Moscow_Crossing"
     
@@ -79,15 +56,15 @@ def load_fixtures():
             
             # Insert RED channel mapping
             cursor.execute("""
-                INSERT INTO traffic_light_channels (light_id, detector_id, channel_mask, signal_color)
+                INSERT INTO traffic_light_channels (light_id, detector_id, channel, signal_color)
                 VALUES (?, ?, ?, ?)
-            """, (light_id, 1, 1 << light['red_channel'], 'RED'))
+            """, (light_id, 1, light['red_channel'], 'RED'))
             
             # Insert GREEN channel mapping
             cursor.execute("""
-                INSERT INTO traffic_light_channels (light_id, detector_id, channel_mask, signal_color)
+                INSERT INTO traffic_light_channels (light_id, detector_id, channel, signal_color)
                 VALUES (?, ?, ?, ?)
-            """, (light_id, 1, 1 << light['green_channel'], 'GREEN'))
+            """, (light_id, 1, light['green_channel'], 'GREEN'))
         
         conn.commit()
         print(f"Successfully loaded fixtures for detector 1")
@@ -1,6 +1,8 @@
 import sqlite3
 from datetime import datetime
 
+import schema
+
 DB_PATH = "/data/detectors.db"
 
 def load_prod_fixtures():
@@ -9,33 +11,8 @@ def load_prod_fixtures():
     cursor = conn.cursor()
 
     # Create required tables
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS traffic_lights (
-            light_id INTEGER PRIMARY KEY AUTOINCREMENT,
-            name TEXT UNIQUE NOT NULL,
-            location TEXT NOT NULL,
-            intersection_id TEXT NOT NULL DEFAULT 'UNGROUPED'
-        )
-    """)
-    
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS traffic_light_channels (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            light_id INTEGER NOT NULL,
-            detector_id INTEGER NOT NULL,
-            channel_mask INTEGER NOT NULL,
-            signal_color TEXT CHECK(signal_color IN ('RED', 'GREEN')) NOT NULL,
-            FOREIGN KEY (light_id) REFERENCES traffic_lights(light_id)
-        )
-    """)
-    
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS detectors (
-            name TEXT PRIMARY KEY,
-            password TEXT NOT NULL
-        )
-    """)        
-    
+    schema.migrate(conn)
+
     try:
         # Define the intersection and traffic lights
         intersection_id = 'Office'
@@ -77,8 +54,6 @@ def load_prod_fixtures():
                 'green_channel': 13
             }
         ]
-
-        ]
         
         print("Loading production fixtures:")
         
@@ -93,15 +68,15 @@ def load_prod_fixtures():
             
             # Insert RED channel mapping
             cursor.execute("""
-                INSERT INTO traffic_light_channels (light_id, detector_id, channel_mask, signal_color)
+                INSERT INTO traffic_light_channels (light_id, detector_id, channel, signal_color)
                 VALUES (?, ?, ?, ?)
-            """, (light_id, detector_id, 1 << light['red_channel'], 'RED'))
+            """, (light_id, detector_id, light['red_channel'], 'RED'))
             
             # Insert GREEN channel mapping
             cursor.execute("""
-                INSERT INTO traffic_light_channels (light_id, detector_id, channel_mask, signal_color)
+                INSERT INTO traffic_light_channels (light_id, detector_id, channel, signal_color)
                 VALUES (?, ?, ?, ?)
-            """, (light_id, detector_id, 1 << light['green_channel'], 'GREEN'))
+            """, (light_id, detector_id, light['green_channel'], 'GREEN'))
             
             print(f"  Light: {light['name']}")
             print(f"    RED: channel {light['red_channel']}")
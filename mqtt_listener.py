@@ -1,27 +1,111 @@
 import base64
-import sqlite3
+import json
+import os
+import queue
+import signal
+import socket
+import threading
 import time
+import traceback
 from collections import defaultdict
 from datetime import datetime
 
 import paho.mqtt.client as mqtt
 import telemetry_pb2
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
 
+import channel_bits
+import light_eta
 import register_detector
+import signal_filter
+import storage
+from cycle_model import CycleModel
+from detector_health import DetectorHealth
+from duration_profiles import DurationProfile
+from duration_stats import DurationStats
+from light_eta import LightEta
+from signal_filter import SignalFilter
+from spool import Spool
 
 DB_PATH = "/data/detectors.db"
-MQTT_BROKER = "localhost"
-MQTT_PORT = 1883
+MQTT_BROKER = os.environ.get('MQTT_BROKER', "localhost")
+MQTT_PORT = int(os.environ.get('MQTT_PORT', 1883))
 MQTT_TOPIC = "$me/device/state"
 LISTENER_USERNAME = "listener"
 
-# Cache for traffic light states
-intersection_states = defaultdict(dict)
+# Scale-out: instances with the same group share one MQTT v5 shared subscription
+# and the broker spreads frames across them. Empty runs a single instance.
+SHARE_GROUP = os.environ.get('LISTENER_SHARE_GROUP', '')
+# Only one instance of a group should run cleanup and VACUUM
+RUN_MAINTENANCE = os.environ.get('LISTENER_MAINTENANCE', '1') == '1'
+# Cleanup first runs this many seconds after startup, never before frames are flowing
+MAINTENANCE_DELAY = int(os.environ.get('LISTENER_MAINTENANCE_DELAY', 60))
+MAINTENANCE_INTERVAL = 900  # Run cleanup every 15 minutes
+
+# Persistent session: with a stable client ID the broker keeps the subscription and
+# queues QoS 1 frames while the listener is down, redelivering any it never acknowledged.
+# Instances of a share group on one host need distinct IDs.
+CLIENT_ID = os.environ.get('LISTENER_CLIENT_ID', f"tld-listener-{socket.gethostname()}")
+SESSION_EXPIRY = int(os.environ.get('LISTENER_SESSION_EXPIRY', 86400))
+
+# Frames wait here for the writer and are acknowledged once they are durable. The
+# MQTT v5 receive maximum equals the capacity, so the broker never has more
+# unacknowledged frames in flight than the queue holds and keeps the rest itself.
+WRITER_QUEUE_SIZE = min(int(os.environ.get('WRITER_QUEUE_SIZE', 256)), 65535)
+_frames = queue.Queue(maxsize=WRITER_QUEUE_SIZE)
+
+# Frames are spooled to disk before they are committed (see spool.py), so the writer
+# commits once this many are pending or the oldest has waited this many seconds
+WRITER_BATCH_SIZE = int(os.environ.get('WRITER_BATCH_SIZE', 1000))
+WRITER_COMMIT_INTERVAL = float(os.environ.get('WRITER_COMMIT_INTERVAL', 1.0))
+# Seconds a commit waits for the write lock before it is retried later; spooling
+# and acknowledgments stop while it waits
+WRITER_BUSY_TIMEOUT = float(os.environ.get('WRITER_BUSY_TIMEOUT', 1.0))
+
+# Instances sharing a volume need their own spool file
+SPOOL_PATH = os.environ.get('LISTENER_SPOOL', f"/data/{CLIENT_ID}.spool")
+# Seconds between fsyncs of the spool; frames are acknowledged once synced
+SPOOL_SYNC_INTERVAL = float(os.environ.get('SPOOL_SYNC_INTERVAL', 0.1))
+# While the database is down, frames beyond this many wait for it unacknowledged,
+# so the broker holds the rest of the backlog
+SPOOL_MAX_FRAMES = int(os.environ.get('SPOOL_MAX_FRAMES', 50000))
+
+# Light caches are written here at shutdown and restored at the next start, as long
+# as nothing was recorded in between (see save_snapshot)
+SNAPSHOT_PATH = os.environ.get('LISTENER_SNAPSHOT', f"/data/{CLIENT_ID}.snapshot")
+SNAPSHOT_VERSION = 1
+
+# Set by stop() on SIGTERM or SIGINT
+_stopping = threading.Event()
+
+# Storage for everything the listener records, opened in open_database()
+_store = None
 
 # Cache for detector configurations
 _detector_cache = {}
 _last_cache_update = 0
 
+# Cache for per-light cycle models, persisted in cycle_models
+_cycle_models = {}
+
+# Cache for streaming duration statistics, persisted in duration_stats
+_duration_stats = {}
+
+# Cache for time-of-day duration profiles, persisted in duration_profiles
+_duration_profiles = {}
+
+# Per-light debounce state machines, seeded from the last recorded state
+_signal_filters = {}
+SIGNAL_MIN_DWELL = float(os.environ.get('SIGNAL_MIN_DWELL', signal_filter.MIN_DWELL))
+SIGNAL_CONFIRM_FRAMES = int(os.environ.get('SIGNAL_CONFIRM_FRAMES', signal_filter.CONFIRM_FRAMES))
+
+# Per-detector link health, persisted in detector_health every few seconds
+_detector_health = {}
+# (frames, lost, restarts) already merged into the table, for shared subscriptions
+_health_flushed = {}
+HEALTH_FLUSH_INTERVAL = int(os.environ.get('HEALTH_FLUSH_INTERVAL', 10))
+
 def get_traffic_light_config(detector_id):
     """Get traffic light configuration with caching."""
     global _last_cache_update
@@ -31,25 +115,15 @@ def get_traffic_light_config(detector_id):
         _detector_cache.clear()
         
     if detector_id not in _detector_cache:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        
-        cursor.execute("""
-            SELECT tlc.light_id, tlc.channel_mask, tlc.signal_color, 
-                   tl.intersection_id, tl.name, tl.location
-            FROM traffic_light_channels tlc
-            JOIN traffic_lights tl ON tlc.light_id = tl.light_id
-            WHERE tlc.detector_id = ?
-        """, (detector_id,))
-        
-        _detector_cache[detector_id] = cursor.fetchall()
-        conn.close()
+        # Masks are built once here so each frame only needs bitwise ANDs
+        _detector_cache[detector_id] = [(light_id, 1 << channel, *rest)
+                                        for light_id, channel, *rest in _store.detector_channels(detector_id)]
         _last_cache_update = datetime.now().timestamp()
         
     return _detector_cache[detector_id]
 
 def process_traffic_states(detector_id, channels):
-    """Process raw channels into traffic light states with intersection grouping."""
+    """Process a channel bitmap (an int of any width) into traffic light states with intersection grouping."""
     config = get_traffic_light_config(detector_id)
     states = {}
     intersections = defaultdict(dict)
@@ -68,20 +142,14 @@ def process_traffic_states(detector_id, channels):
                 'intersection_id': intersection_id
             }
         
-        # Update signal state with conflict detection
+        # Keep raw lamp states; conflicting frames are resolved by the signal filter
         if signal_color == 'RED':
             states[light_id]['red'] = is_active
-            # Ensure green is off if red is on
-            if is_active:
-                states[light_id]['green'] = False
         elif signal_color == 'GREEN':
             states[light_id]['green'] = is_active
-            # Ensure red is off if green is on
-            if is_active:
-                states[light_id]['red'] = False
             
         # Track state in intersection grouping
-        light_state = 'RED' if states[light_id]['red'] else 'GREEN' if states[light_id]['green'] else 'UNKNOWN'
+        light_state = signal_filter.classify(states[light_id]['red'], states[light_id]['green']) or 'UNKNOWN'
         intersections[intersection_id].setdefault('lights', {})[light_id] = {
             'name': name,
             'state': light_state,
@@ -102,8 +170,101 @@ def process_traffic_states(detector_id, channels):
         'intersections': dict(intersections)
     }
 
+def get_cycle_model(light_id):
+    """Get a light's cycle model from the cache, loading it on first use."""
+    model = _cycle_models.get(light_id)
+    if model is None:
+        model = _store.get_cycle_model(light_id) or CycleModel()
+        _cycle_models[light_id] = model
+    return model
+
+def get_signal_filter(light_id):
+    """Get a light's signal filter, seeding it from the last recorded state on first use."""
+    light_filter = _signal_filters.get(light_id)
+    if light_filter is None:
+        state, since = _store.last_state(light_id) or (None, None)
+        light_filter = SignalFilter(state, since, SIGNAL_MIN_DWELL, SIGNAL_CONFIRM_FRAMES)
+        _signal_filters[light_id] = light_filter
+    return light_filter
+
+def update_cycle_model(light_id, state, timestamp):
+    """Feed a recorded state change into the light's cycle model and persist it."""
+    model = get_cycle_model(light_id)
+    model.update(state, timestamp)
+    _store.put_cycle_model(light_id, model)
+
+def get_duration_stats(key):
+    """Get streaming statistics for a (light_id, prev_state, next_state) key, loading on first use."""
+    stats = _duration_stats.get(key)
+    if stats is None:
+        stats = _store.get_duration_stats(key) or DurationStats()
+        _duration_stats[key] = stats
+    return stats
+
+def update_duration_stats(light_id, prev_state, next_state, duration):
+    """Add an observed state duration to the transition's streaming statistics."""
+    key = (light_id, prev_state, next_state)
+    stats = get_duration_stats(key)
+    stats.add(duration)
+    _store.put_duration_stats(key, stats)
+    return stats
+
+def get_duration_profile(key):
+    """Get the time-of-day profile for a (light_id, prev_state, next_state) key, loading on first use."""
+    profile = _duration_profiles.get(key)
+    if profile is None:
+        profile = _store.get_duration_profile(key) or DurationProfile()
+        _duration_profiles[key] = profile
+    return profile
+
+def update_duration_profile(light_id, prev_state, next_state, started_at, duration):
+    """Add an observed state duration to the transition's time-of-day profile."""
+    key = (light_id, prev_state, next_state)
+    profile = get_duration_profile(key)
+    profile.add(started_at, duration)
+    _store.put_duration_profile(key, profile)
+
+def update_light_current(light_id, state, since):
+    """Precompute when the light's new state is expected to end and store it as its current state."""
+    next_state = 'GREEN' if state == 'RED' else 'RED'
+    key = (light_id, state, next_state)
+    
+    eta = LightEta.estimate(
+        state, since,
+        ema_duration=_store.get_ema_duration(key),
+        profile_duration=get_duration_profile(key).expected(since),
+        stats=get_duration_stats(key),
+        cycle=get_cycle_model(light_id),
+    )
+    _store.put_light_current(light_id, eta)
+    return eta
+
+def forget_light_models(light_id):
+    """Drop a light's cached models so they are reloaded from the database."""
+    _cycle_models.pop(light_id, None)
+    for prev_state, next_state in (('RED', 'GREEN'), ('GREEN', 'RED')):
+        _duration_stats.pop((light_id, prev_state, next_state), None)
+        _duration_profiles.pop((light_id, prev_state, next_state), None)
+
+def claim_transition(light_id, light_filter, prev_state, prev_since):
+    """Compare-and-set for shared subscriptions: record a transition only if light_current
+    still holds the state this instance saw, otherwise adopt the newer state.
+
+    Frames of one light are spread over all instances, so another instance may
+    already have recorded this change. The writer's batches start with BEGIN
+    IMMEDIATE, so the check and the update run under SQLite's write lock.
+    """
+    row = _store.get_light_state(light_id)
+    if row is not None and (row[0], row[1]) != (prev_state, prev_since):
+        light_filter.state, light_filter.since = row
+        light_filter.candidate = None
+        return False
+    # Other instances update the same models; reload them inside this transaction
+    forget_light_models(light_id)
+    return True
+
 def save_telemetry(detector_id, channels, timestamp, counter):
-    """Save telemetry data and process traffic states."""
+    """Save telemetry data and process traffic states in the writer's open transaction."""
     # Process traffic states first to check if any valid states exist
     processed = process_traffic_states(detector_id, channels)
     
@@ -114,279 +275,329 @@ def save_telemetry(detector_id, channels, timestamp, counter):
             has_valid_states = True
             break
     
-    # Always open a connection, but only save telemetry if we have valid states
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
+    # Time columns hold integer epoch seconds
+    current_timestamp = int(timestamp)
     
-    try:
-        # Only save telemetry if we have valid states
-        if has_valid_states:
-            cursor.execute("INSERT INTO telemetry (detector_id, channels, timestamp, counter) VALUES (?, ?, ?, ?)",
-                       (detector_id, channels, timestamp, counter))
+    # Only save telemetry if we have valid states
+    if has_valid_states:
+        _store.add_telemetry(detector_id, channels, current_timestamp, counter)
+    
+    # Save confirmed light state transitions
+    for light_id, state in processed['lights'].items():
+        light_filter = get_signal_filter(light_id)
+        transition = light_filter.update(state['red'], state['green'], current_timestamp)
+        if transition is None:
+            continue
         
-        # Save individual light states
-        for light_id, state in processed['lights'].items():
-            # Only save states that are explicitly RED or GREEN
-            current_state = "UNKNOWN"
-            if state['red']:
-                current_state = 'RED'
-            elif state['green']:
-                current_state = 'GREEN'
+        prev_state, prev_timestamp, current_state, changed_at = transition
+        if SHARE_GROUP and not claim_transition(light_id, light_filter, prev_state, prev_timestamp):
+            continue
+        _store.add_state(light_id, current_state, changed_at)
+        update_cycle_model(light_id, current_state, changed_at)
+        
+        if prev_state is not None:
+            duration = changed_at - prev_timestamp
+            
+            # Check if duration is reasonable (between 5 and 300 seconds)
+            if light_eta.MIN_DURATION <= duration <= light_eta.MAX_DURATION:
+                # Update the average duration using exponential moving average
+                key = (light_id, prev_state, current_state)
+                new_duration = light_eta.next_ema(_store.get_ema_duration(key), duration)
+                _store.put_ema_duration(key, new_duration)
                 
-            # Only proceed if we have a valid state
-            if current_state in ('RED', 'GREEN'):
-                # Get the previous state record for this light
-                prev_state_record = cursor.execute("""
-                    SELECT state, timestamp 
-                    FROM traffic_light_states 
-                    WHERE light_id = ? 
-                    ORDER BY timestamp DESC 
-                    LIMIT 1
-                """, (light_id,)).fetchone()
+                stats = update_duration_stats(light_id, prev_state, current_state, duration)
+                update_duration_profile(light_id, prev_state, current_state, prev_timestamp, duration)
                 
-                # Normalize current timestamp
-                current_timestamp = timestamp
-                if isinstance(current_timestamp, str) and not current_timestamp.isdigit():
-                    try:
-                        current_dt = datetime.fromisoformat(current_timestamp)
-                        current_timestamp = int(current_dt.timestamp())
-                    except ValueError:
-                        current_timestamp = int(time.time())
-                else:
-                    current_timestamp = int(float(current_timestamp))
+                print(f"\n[DEBUG] Recorded state transition for light {light_id}:")
+                print(f"  Previous: {prev_state} (started at {datetime.fromtimestamp(prev_timestamp).isoformat()})")
+                print(f"  Current: {current_state} (changed at {datetime.fromtimestamp(changed_at).isoformat()})")
+                print(f"  Duration: {duration:.2f}s, Stored average: {new_duration:.2f}s")
+                print(f"  Samples: {stats.count}, Std dev: {stats.stddev:.2f}s, P10-P90: {stats.interval()}")
+                print(f"  Recorded at: {datetime.now().isoformat()}")
+            else:
+                print(f"\n[WARNING] Unreasonable duration ({duration:.2f}s) for light {light_id}")
+                print(f"  Previous: {prev_state} at {prev_timestamp}")
+                print(f"  Current: {current_state} at {changed_at}")
+                print(f"  Duration outside valid range (5-300s), using default values")
                 
-                # Only insert a new state record if the state has changed
-                if not prev_state_record or prev_state_record[0] != current_state:
-                    # Get minimum time between state changes (10 seconds)
-                    MIN_STATE_CHANGE_INTERVAL = 10
-                    
-                    # Check if enough time has passed since the last state change
-                    can_change_state = True
-                    if prev_state_record:
-                        prev_timestamp = prev_state_record[1]
-                        
-                        # Normalize previous timestamp
-                        if isinstance(prev_timestamp, str) and not prev_timestamp.isdigit():
-                            try:
-                                prev_dt = datetime.fromisoformat(prev_timestamp)
-                                prev_timestamp = int(prev_dt.timestamp())
-                            except ValueError:
-                                prev_timestamp = current_timestamp - MIN_STATE_CHANGE_INTERVAL - 1
-                        else:
-                            prev_timestamp = int(float(prev_timestamp))
-                        
-                        # Check if enough time has passed
-                        time_since_last_change = current_timestamp - prev_timestamp
-                        if time_since_last_change < MIN_STATE_CHANGE_INTERVAL:
-                            can_change_state = False
-                            print(f"[INFO] Ignoring rapid state change for light {light_id}: {prev_state_record[0]} -> {current_state} (only {time_since_last_change}s elapsed)")
-                    
-                    if can_change_state:
-                        cursor.execute("""
-                            INSERT INTO traffic_light_states (light_id, state, timestamp)
-                            VALUES (?, ?, ?)
-                        """, (light_id, current_state, current_timestamp))
+                # Use default durations based on state
+                default_duration = light_eta.DEFAULT_DURATIONS[prev_state]
                 
-                # Check if this is a state transition
-                if prev_state_record and prev_state_record[0] != current_state and prev_state_record[0] in ('RED', 'GREEN'):
-                    prev_state = prev_state_record[0]
-                    prev_timestamp = prev_state_record[1]
-                    
-                    # Calculate duration - ensure timestamps are numeric
-                    try:
-                        if isinstance(prev_timestamp, str) and not prev_timestamp.isdigit():
-                            # Try to parse ISO format
-                            try:
-                                prev_dt = datetime.fromisoformat(prev_timestamp)
-                                prev_timestamp = int(prev_dt.timestamp())
-                            except ValueError:
-                                prev_timestamp = current_timestamp - 30  # Default to 30 seconds ago if parsing fails
-                        else:
-                            prev_timestamp = int(float(prev_timestamp))
-                            
-                        # Ensure current timestamp is numeric
-                        if isinstance(timestamp, str) and not timestamp.isdigit():
-                            try:
-                                current_dt = datetime.fromisoformat(timestamp)
-                                timestamp = int(current_dt.timestamp())
-                            except ValueError:
-                                timestamp = int(time.time())
-                        else:
-                            timestamp = int(float(timestamp))
-                            
-                        # Calculate duration
-                        duration = timestamp - prev_timestamp
-                        
-                        # For traffic lights, typical durations are 10-120 seconds
-                        # Adjust the range to be more realistic for your specific traffic lights
-                        if duration < 5:
-                            # If duration is too short, use a reasonable default based on the state
-                            if prev_state == 'RED':
-                                duration = 30  # Default RED duration
-                            else:
-                                duration = 15  # Default GREEN duration
-                            print(f"[INFO] Adjusted too short duration for light {light_id} from {timestamp - prev_timestamp}s to {duration}s")
-                            
-                            # Also update the timestamp to make future calculations correct
-                            new_timestamp = prev_timestamp + duration
-                            cursor.execute("""
-                                UPDATE traffic_light_states
-                                SET timestamp = ?
-                                WHERE light_id = ? AND state = ? AND timestamp = ?
-                            """, (new_timestamp, light_id, current_state, timestamp))
-                            print(f"[INFO] Updated timestamp for current state from {timestamp} to {new_timestamp}")
-                            
-                            # Update timestamp for future calculations
-                            timestamp = new_timestamp
+                # Still record the transition with a reasonable duration
+                _store.put_ema_duration((light_id, prev_state, current_state), default_duration)
                 
-                        # Check if duration is reasonable (between 5 and 300 seconds)
-                        if 5 <= duration <= 300:
-                            # Update the average duration using exponential moving average
-                            # Get existing average if any
-                            existing_avg = cursor.execute("""
-                                SELECT duration FROM state_durations
-                                WHERE light_id = ? AND previous_state = ? AND next_state = ?
-                            """, (light_id, prev_state, current_state)).fetchone()
-                            
-                            if existing_avg:
-                                # Use EMA with alpha=0.3 (gives more weight to recent values)
-                                alpha = 0.3
-                                new_duration = (alpha * duration) + ((1 - alpha) * existing_avg[0])
-                            else:
-                                new_duration = duration
-                            
-                            cursor.execute("""
-                                INSERT OR REPLACE INTO state_durations 
-                                (light_id, previous_state, next_state, duration, last_updated)
-                                VALUES (?, ?, ?, ?, ?)
-                            """, (light_id, prev_state, current_state, new_duration, 
-                                 datetime.now().isoformat()))
-                            
-                            print(f"\n[DEBUG] Recorded state transition for light {light_id}:")
-                            print(f"  Previous: {prev_state} (started at {datetime.fromtimestamp(prev_timestamp).isoformat()})")
-                            print(f"  Current: {current_state} (changed at {datetime.fromtimestamp(timestamp).isoformat()})")
-                            print(f"  Duration: {duration:.2f}s, Stored average: {new_duration:.2f}s")
-                            print(f"  Recorded at: {datetime.now().isoformat()}")
-                        else:
-                            print(f"\n[WARNING] Unreasonable duration ({duration:.2f}s) for light {light_id}")
-                            print(f"  Previous: {prev_state} at {prev_timestamp}")
-                            print(f"  Current: {current_state} at {timestamp}")
-                            print(f"  Duration outside valid range (5-300s), using default values")
-                            
-                            # Use default durations based on state
-                            default_duration = 30 if prev_state == 'RED' else 15
-                            
-                            # Still record the transition with a reasonable duration
-                            cursor.execute("""
-                                INSERT OR REPLACE INTO state_durations 
-                                (light_id, previous_state, next_state, duration, last_updated)
-                                VALUES (?, ?, ?, ?, ?)
-                            """, (light_id, prev_state, current_state, default_duration, 
-                                 datetime.now().isoformat()))
-                            
-                            print(f"  Recorded with default duration: {default_duration}s")
-                    except (ValueError, TypeError) as e:
-                        print(f"\n[WARNING] Error calculating duration for light {light_id}: {e}")
-                        print(f"  Previous state: {prev_state} at {prev_timestamp} (type: {type(prev_timestamp).__name__})")
-                        print(f"  Current state: {current_state} at {timestamp} (type: {type(timestamp).__name__})")
-                        
-                        # Try to fix the timestamp issue by creating a new record with current time
-                        try:
-                            current_time = int(time.time())
-                            cursor.execute("""
-                                UPDATE traffic_light_states
-                                SET timestamp = ?
-                                WHERE light_id = ? AND state = ?
-                                ORDER BY rowid DESC
-                                LIMIT 1
-                            """, (current_time, light_id, current_state))
-                            print(f"  Fixed timestamp for latest {current_state} state to {current_time}")
-                        except Exception as fix_error:
-                            print(f"  Failed to fix timestamp: {fix_error}")
-        
-        # Update intersection states cache
-        for intersection_id, data in processed['intersections'].items():
-            intersection_states[intersection_id] = {
-                'overall_state': data['overall_state'],
-                'lights': data['lights'],
-                'timestamp': datetime.now().isoformat()
-            }
+                print(f"  Recorded with default duration: {default_duration}s")
         
-        # Always commit changes
-        conn.commit()
-    
-    except Exception as e:
-        print(f"Error saving telemetry data: {e}")
-        conn.rollback()
-        import traceback
-        traceback.print_exc()
-    
-    finally:
-        # Always close the connection
-        conn.close()
+        # Precompute the next change now that all duration models are updated
+        update_light_current(light_id, current_state, changed_at)
+        _store.update_intersection_current(state['intersection_id'], prev_state, current_state, changed_at)
 
 
 def on_message(client, userdata, msg):
-    """Handle incoming MQTT messages and process traffic states."""
-    try:
-        payload_decoded = base64.b64decode(msg.payload)
-        telemetry = telemetry_pb2.mqtt_msg_t()
-        telemetry.ParseFromString(payload_decoded)
+    """Hand a frame to the writer; it is acknowledged once spooled or committed."""
+    # Blocks only for QoS 0 frames, which the receive maximum does not cover
+    _frames.put((msg.mid, msg.qos, msg.payload, time.time()))
 
-        # Save raw telemetry
-        save_telemetry(telemetry.id, telemetry.channels, time.time(), telemetry.counter)
-        
-        # Process traffic light states
-        states = process_traffic_states(telemetry.id, telemetry.channels)
-        
-        # Update intersection states
-        for light_id, state in states.items():
-            intersection_states[light_id] = {
-                **state,
-                'timestamp': datetime.fromtimestamp(telemetry.timestamp).isoformat()
-            }
-        
-        # Print status
-        print(f"\nNew telemetry received:")
-        print(f"  Detector ID: {telemetry.id}")
-        print(f"  Timestamp: {datetime.fromtimestamp(telemetry.timestamp).isoformat()}")
-        print("  Traffic Light States:")
-        
-        # Check if any valid states exist
-        has_valid_states = False
-        for light_id, light_data in states['lights'].items():
-            status = "RED" if light_data['red'] else "GREEN" if light_data['green'] else "UNKNOWN"
-            print(f"    {light_data['name']} ({light_data['location']}): {status}")
-            if status != "UNKNOWN":
-                has_valid_states = True
-        
-        if not has_valid_states:
-            print("  WARNING: No valid states detected, telemetry not saved")
-            
-            # Debug logging for state determination
-            print(f"      [DEBUG] Detector: {telemetry.id}, Light ID: {light_id}")
-            print(f"      [DEBUG] Red state: {light_data['red']}, Green state: {light_data['green']}")
-            print(f"      [DEBUG] Raw channel mask: 0b{format(telemetry.channels, '032b')}")
-            # Get channel config for this light
-            light_config = get_traffic_light_config(telemetry.id)
-            red_masks = [str(c[1]) for c in light_config if c[0] == light_id and c[2] == 'RED']
-            green_masks = [str(c[1]) for c in light_config if c[0] == light_id and c[2] == 'GREEN']
-            print(f"      [DEBUG] Configured channels - RED: {', '.join(red_masks)}, GREEN: {', '.join(green_masks)}")
+def decode_frame(raw):
+    """Parse a serialized mqtt_msg_t."""
+    telemetry = telemetry_pb2.mqtt_msg_t()
+    telemetry.ParseFromString(raw)
+    return telemetry
+
+def process_frame(telemetry, received_at):
+    """Record a decoded frame in the writer's open transaction and print the light states."""
+    channels = channel_bits.from_message(telemetry)
+
+    # Save raw telemetry
+    save_telemetry(telemetry.id, channels, received_at, telemetry.counter)
+    
+    # Process traffic light states
+    states = process_traffic_states(telemetry.id, channels)
+    
+    # Print status
+    print(f"\nNew telemetry received:")
+    print(f"  Detector ID: {telemetry.id}")
+    print(f"  Timestamp: {datetime.fromtimestamp(telemetry.timestamp).isoformat()}")
+    print("  Traffic Light States:")
+    
+    # Check if any valid states exist
+    has_valid_states = False
+    for light_id, light_data in states['lights'].items():
+        status = "RED" if light_data['red'] else "GREEN" if light_data['green'] else "UNKNOWN"
+        print(f"    {light_data['name']} ({light_data['location']}): {status}")
+        if status != "UNKNOWN":
+            has_valid_states = True
+    
+    if not has_valid_states:
+        print("  WARNING: No valid states detected, telemetry not saved")
         
-        # Print raw channel states for debugging
-        channel_states = ["ON" if (telemetry.channels & (1 << i)) else "OFF" for i in range(32)]
-        print(f"  Raw Channel States: {', '.join(channel_states)}")
+        # Debug logging for state determination
+        print(f"      [DEBUG] Detector: {telemetry.id}, Light ID: {light_id}")
+        print(f"      [DEBUG] Red state: {light_data['red']}, Green state: {light_data['green']}")
+        print(f"      [DEBUG] Raw channel mask: 0b{format(channels, '0%db' % max(32, channels.bit_length()))}")
+        # Get channel config for this light
+        light_config = get_traffic_light_config(telemetry.id)
+        red_masks = [str(c[1].bit_length() - 1) for c in light_config if c[0] == light_id and c[2] == 'RED']
+        green_masks = [str(c[1].bit_length() - 1) for c in light_config if c[0] == light_id and c[2] == 'GREEN']
+        print(f"      [DEBUG] Configured channels - RED: {', '.join(red_masks)}, GREEN: {', '.join(green_masks)}")
     
-    except Exception as e:
-        print(f"Failed to process message: {e}")
-        import traceback
-        traceback.print_exc()
+    # Print raw channel states for debugging
+    active = channel_bits.active_channels(channels)
+    print(f"  Active Channels: {', '.join(map(str, active)) or 'none'}")
+
+def forget_models():
+    """Drop every cached light model so each is reloaded from the database on next use."""
+    _cycle_models.clear()
+    _duration_stats.clear()
+    _duration_profiles.clear()
+
+def forget_light_state():
+    """Drop every cached light model and filter after a rolled-back batch."""
+    _signal_filters.clear()
+    forget_models()
+
+def forget_detector_lights(detector_id):
+    """Drop the cached filters and models of a detector's lights after its frame was rolled back."""
+    # Lights of a detector whose config never loaded were not touched
+    for light_id in {light_id for light_id, *_ in _detector_cache.get(detector_id, ())}:
+        _signal_filters.pop(light_id, None)
+        forget_light_models(light_id)
+
+def write_batch(frames):
+    """Record decoded frames in one transaction; a frame that fails is skipped on its own."""
+    with _store.transaction():
+        # A retrain or another writer may have replaced the models since the last batch;
+        # shared subscriptions already reload them with every claimed transition
+        if _store.changed_elsewhere() and not SHARE_GROUP:
+            forget_models()
+        for telemetry, received_at in frames:
+            try:
+                with _store.savepoint():
+                    process_frame(telemetry, received_at)
+            except storage.OperationalError:
+                # Locked or failing database: the whole batch is retried
+                raise
+            except Exception as e:
+                # Its writes were rolled back; the caches must not keep them either
+                forget_detector_lights(telemetry.id)
+                print(f"Failed to process message: {e}")
+                traceback.print_exc()
+
+def commit_frames(frames):
+    """Commit frames, retrying until the database accepts them."""
+    while True:
+        try:
+            write_batch(frames)
+            return
+        except storage.Error as e:
+            forget_light_state()
+            print(f"[WRITER] Failed to commit {len(frames)} frames, retrying: {e}")
+            time.sleep(1)
+
+def replay_spool(spool):
+    """Commit frames left in the spool by the previous run, in the order they arrived."""
+    frames = []
+    for received_at, raw in spool.replay():
+        try:
+            frames.append((decode_frame(raw), received_at))
+        except Exception as e:
+            print(f"[SPOOL] Skipping unreadable frame: {e}")
+    for start in range(0, len(frames), WRITER_BATCH_SIZE):
+        commit_frames(frames[start:start + WRITER_BATCH_SIZE])
+    spool.truncate()
+    if frames:
+        print(f"[SPOOL] Replayed {len(frames)} frames from {spool.path}")
+
+def writer_loop(client, spool):
+    """Spool queued frames, acknowledge them once synced and commit them in batches.
+
+    Acknowledgments follow the spool's fsync, so a locked or slow database only
+    delays commits: a failed batch stays pending and is retried while new frames
+    keep arriving. Once SPOOL_MAX_FRAMES are pending, acknowledgments wait for the
+    commit instead and the broker holds the backlog. Returns after a final commit
+    once stop() is called.
+    """
+    # SQLite maintenance runs on a thread of its own (see maintenance_loop); the
+    # in-process memory store is not shared across threads, so its cleanup runs here
+    inline_maintenance = RUN_MAINTENANCE and storage.BACKEND != 'sqlite'
+    last_cleanup = time.time() - MAINTENANCE_INTERVAL + MAINTENANCE_DELAY
+    last_health_flush = time.time()
+    last_sync = time.time()
+    retry_at = 0
+    pending = []  # Decoded frames not committed yet
+    unacked = []  # (mid, qos) of frames not durable yet
 
-def cleanup_old_data():
+    while not _stopping.is_set():
+        # Wakes at least once a second to notice stop()
+        timeout = SPOOL_SYNC_INTERVAL if unacked or pending else 1.0
+        batch = []
+        try:
+            batch.append(_frames.get(timeout=timeout))
+            while len(batch) < WRITER_QUEUE_SIZE:
+                batch.append(_frames.get_nowait())
+        except queue.Empty:
+            pass
+
+        if batch and not pending:
+            first_pending_at = time.time()
+        for mid, qos, payload, received_at in batch:
+            unacked.append((mid, qos))
+            try:
+                raw = base64.b64decode(payload)
+                telemetry = decode_frame(raw)
+            except Exception as e:
+                # Acknowledged anyway: redelivery would not make it decode
+                print(f"Failed to decode message: {e}")
+                continue
+            record_frame(telemetry.id, telemetry.counter, telemetry.timestamp, received_at)
+            spool.append(received_at, raw)
+            pending.append((telemetry, received_at))
+
+        current_time = time.time()
+        if unacked and len(pending) <= SPOOL_MAX_FRAMES and (
+                current_time - last_sync >= SPOOL_SYNC_INTERVAL or len(unacked) >= WRITER_QUEUE_SIZE // 2):
+            spool.sync()
+            last_sync = current_time
+            for mid, qos in unacked:
+                client.ack(mid, qos)
+            unacked = []
+
+        if pending and current_time >= retry_at and (
+                len(pending) >= WRITER_BATCH_SIZE or current_time - first_pending_at >= WRITER_COMMIT_INTERVAL
+                or len(pending) > SPOOL_MAX_FRAMES):
+            try:
+                write_batch(pending)
+            except storage.Error as e:
+                forget_light_state()
+                print(f"[WRITER] Failed to commit {len(pending)} frames, keeping them spooled: {e}")
+                retry_at = current_time + 1
+            else:
+                # Everything spooled is committed now
+                spool.truncate()
+                pending = []
+                for mid, qos in unacked:
+                    client.ack(mid, qos)
+                unacked = []
+
+        if current_time - last_health_flush >= HEALTH_FLUSH_INTERVAL:
+            flush_detector_health()
+            last_health_flush = current_time
+
+        if inline_maintenance and current_time - last_cleanup > MAINTENANCE_INTERVAL:
+            cleanup_old_data(_store)
+            last_cleanup = current_time
+
+    # Make everything received durable before leaving the rest to the broker's session
+    if unacked:
+        spool.sync()
+        for mid, qos in unacked:
+            client.ack(mid, qos)
+    if pending:
+        try:
+            write_batch(pending)
+        except storage.Error as e:
+            forget_light_state()
+            print(f"[WRITER] Leaving {len(pending)} frames spooled for the next start: {e}")
+        else:
+            spool.truncate()
+    flush_detector_health()
+
+def stop(signum=None, frame=None):
+    """Signal handler: let the writer finish its batch and return."""
+    _stopping.set()
+
+def maintenance_loop():
+    """Run cleanup MAINTENANCE_DELAY seconds after startup and every MAINTENANCE_INTERVAL after that.
+
+    It uses a connection of its own, so the writer keeps spooling and acknowledging
+    frames while cleanup or VACUUM holds the database; its commits are retried
+    once the lock is released.
+    """
+    store = storage.open_storage(db_path=DB_PATH)
+    delay = MAINTENANCE_DELAY
+    while not _stopping.wait(delay):
+        cleanup_old_data(store)
+        delay = MAINTENANCE_INTERVAL
+    store.close()
+
+def record_frame(detector_id, counter, device_time, now):
+    """Update a detector's link health with a received frame."""
+    health = _detector_health.get(detector_id)
+    if health is None:
+        health = _detector_health[detector_id] = DetectorHealth(detector_id, count_gaps=not SHARE_GROUP)
+    health.update(counter, device_time, now)
+
+def load_detector_health():
+    """Resume health tracking from the last flush, so counters and offsets survive restarts."""
+    for row in _store.load_detector_health():
+        health = _detector_health[row[0]] = DetectorHealth.from_row(row, count_gaps=not SHARE_GROUP)
+        _health_flushed[row[0]] = (health.frames, health.lost, health.restarts)
+
+def flush_detector_health():
+    """Write all detector health trackers in one transaction for the API to read."""
+    if not _detector_health:
+        return
+    trackers = [health for health in _detector_health.values() if health.last_seen is not None]
+    rows = [health.to_row() for health in trackers]
+    if SHARE_GROUP:
+        # Each instance sees part of the frames: flush counts since the last flush to be added up
+        rows = []
+        for health in trackers:
+            frames, lost, restarts = _health_flushed.get(health.detector_id, (0, 0, 0))
+            row = list(health.to_row())
+            row[3:6] = health.frames - frames, health.lost - lost, health.restarts - restarts
+            rows.append(tuple(row))
+    try:
+        with _store.transaction():
+            _store.save_detector_health(rows, merge=bool(SHARE_GROUP))
+    except storage.Error as e:
+        print(f"[HEALTH] Failed to flush detector health: {e}")
+        return
+    for health in trackers:
+        _health_flushed[health.detector_id] = (health.frames, health.lost, health.restarts)
+
+def cleanup_old_data(store):
     """Remove old data to prevent database bloat"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    
     print("[CLEANUP] Starting database maintenance...")
     current_time = int(time.time())
     
@@ -394,215 +605,155 @@ def cleanup_old_data():
         # Keep only the last 1 hour of telemetry data
         retention_hours = 0.1
         cutoff_timestamp = current_time - (retention_hours * 60 * 60)
-        
-        cursor.execute("DELETE FROM telemetry WHERE timestamp < ?", (cutoff_timestamp,))
-        deleted_telemetry = cursor.rowcount
-        
-        # Keep only the last hour of state changes, but preserve the most recent state for each light
-        cursor.execute("""
-            DELETE FROM traffic_light_states 
-            WHERE timestamp < ? AND rowid NOT IN (
-                SELECT MAX(rowid) FROM traffic_light_states GROUP BY light_id, state
-            )
-        """, (cutoff_timestamp,))
-        deleted_states = cursor.rowcount
-        
-        # Fix any timestamps from before 2024 (likely incorrect)
-        year_2024_timestamp = 1704067200  # Jan 1, 2024
-        
-        # First, identify lights with outdated timestamps
-        cursor.execute("""
-            SELECT DISTINCT light_id FROM traffic_light_states
-            WHERE timestamp < ?
-        """, (year_2024_timestamp,))
-        
-        lights_with_old_timestamps = [row[0] for row in cursor.fetchall()]
-        
-        if lights_with_old_timestamps:
-            print(f"[CLEANUP] Found {len(lights_with_old_timestamps)} lights with outdated timestamps")
-            
-            # For each light with outdated timestamps, keep only the most recent state
-            # and update its timestamp to current time
-            for light_id in lights_with_old_timestamps:
-                # Get the most recent state for this light
-                cursor.execute("""
-                    SELECT state FROM traffic_light_states
-                    WHERE light_id = ?
-                    ORDER BY timestamp DESC
-                    LIMIT 1
-                """, (light_id,))
-                
-                result = cursor.fetchone()
-                if result:
-                    current_state = result[0]
-                    
-                    # Delete all outdated records for this light
-                    cursor.execute("""
-                        DELETE FROM traffic_light_states
-                        WHERE light_id = ?
-                    """, (light_id,))
-                    
-                    # Create a new record with current timestamp
-                    cursor.execute("""
-                        INSERT INTO traffic_light_states (light_id, state, timestamp)
-                        VALUES (?, ?, ?)
-                    """, (light_id, current_state, current_time))
-                    
-                    print(f"[CLEANUP] Reset timestamp for light {light_id} to current time with state {current_state}")
-        
-        # Remove any invalid state transitions (involving UNKNOWN states)
-        cursor.execute("""
-            DELETE FROM state_durations
-            WHERE previous_state = 'UNKNOWN' OR next_state = 'UNKNOWN'
-        """)
-        deleted_transitions = cursor.rowcount
-        if deleted_transitions > 0:
-            print(f"[CLEANUP] Removed {deleted_transitions} invalid state transitions")
-        
-        # Update outdated state_durations records
-        cursor.execute("""
-            UPDATE state_durations
-            SET last_updated = ?
-            WHERE last_updated < ?
-        """, (datetime.now().isoformat(), datetime.now().replace(year=datetime.now().year-1).isoformat()))
-        
-        updated_durations = cursor.rowcount
-        if updated_durations > 0:
-            print(f"[CLEANUP] Updated timestamps for {updated_durations} duration records")
-        
-        # Commit changes before vacuum
-        conn.commit()
-        
-        # Vacuum database to reclaim space (only if we deleted a significant amount of data)
-        if deleted_telemetry > 50 or deleted_states > 50 or deleted_transitions > 0 or lights_with_old_timestamps:
-            cursor.execute("VACUUM")
-            print("[CLEANUP] Database vacuumed to reclaim space")
-        
+        deleted_telemetry, deleted_states = store.cleanup(cutoff_timestamp, current_time)
         print(f"[CLEANUP] Maintenance complete: Removed {deleted_telemetry} telemetry records, {deleted_states} state records")
         
     except Exception as e:
         print(f"[CLEANUP] Error during database maintenance: {e}")
-        conn.rollback()
-        import traceback
         traceback.print_exc()
-    
-    finally:
-        conn.close()
 
-def initialize_database():
-    """Initialize all required database tables"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    
-    # Create all necessary tables
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS telemetry (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            detector_id INTEGER NOT NULL,
-            channels INTEGER NOT NULL,
-            timestamp INTEGER NOT NULL,
-            counter INTEGER NOT NULL
-        )
-    """)
-
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS detectors (
-            name TEXT PRIMARY KEY,
-            password TEXT NOT NULL
-        )
-    """)
-    
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS traffic_lights (
-            light_id INTEGER PRIMARY KEY AUTOINCREMENT,
-            name TEXT UNIQUE NOT NULL,
-            location TEXT NOT NULL,
-            intersection_id TEXT NOT NULL DEFAULT 'UNGROUPED'
-        )
-    """)
-    
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS traffic_light_channels (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            light_id INTEGER NOT NULL,
-            detector_id INTEGER NOT NULL,
-            channel_mask INTEGER NOT NULL,
-            signal_color TEXT CHECK(signal_color IN ('RED', 'GREEN')) NOT NULL,
-            FOREIGN KEY (light_id) REFERENCES traffic_lights(light_id)
-        )
-    """)
-    
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS traffic_light_states (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            light_id INTEGER NOT NULL,
-            state TEXT CHECK(state IN ('RED', 'GREEN')) NOT NULL,
-            timestamp DATETIME NOT NULL,
-            FOREIGN KEY (light_id) REFERENCES traffic_lights(light_id)
-        )
-    """)
-    
-    # Create indexes for better query performance
-    cursor.execute("CREATE INDEX IF NOT EXISTS idx_telemetry_timestamp ON telemetry(timestamp)")
-    cursor.execute("CREATE INDEX IF NOT EXISTS idx_traffic_light_states_light_timestamp ON traffic_light_states(light_id, timestamp)")
-    
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS state_durations (
-            light_id INTEGER NOT NULL,
-            previous_state TEXT NOT NULL,
-            next_state TEXT NOT NULL,
-            duration REAL NOT NULL,
-            last_updated DATETIME NOT NULL,
-            PRIMARY KEY (light_id, previous_state, next_state),
-            FOREIGN KEY (light_id) REFERENCES traffic_lights(light_id)
-        )
-    """)
+def save_snapshot():
+    """Write the light caches to SNAPSHOT_PATH, so the next start need not reload them light by light.
+
+    Runs at shutdown after the final commit, when the caches match the store.
+    The store's snapshot marker is saved with them to detect later writes.
+    """
+    snapshot = {
+        'version': SNAPSHOT_VERSION,
+        'marker': _store.snapshot_marker(),
+        'signal_filters': [(light_id, light_filter.state, light_filter.since)
+                           for light_id, light_filter in _signal_filters.items()],
+        'cycle_models': [(light_id, *model.to_row()) for light_id, model in _cycle_models.items()],
+        'duration_stats': [(*key, base64.b64encode(stats.to_blob()).decode())
+                           for key, stats in _duration_stats.items()],
+        'duration_profiles': [(*key, base64.b64encode(profile.to_blob()).decode())
+                              for key, profile in _duration_profiles.items()],
+    }
+    temp_path = f"{SNAPSHOT_PATH}.tmp"
+    with open(temp_path, 'w') as f:
+        json.dump(snapshot, f, separators=(',', ':'))
+    os.replace(temp_path, SNAPSHOT_PATH)
+    return len(_signal_filters)
+
+def load_snapshot():
+    """Restore the light caches from save_snapshot() if nothing was recorded since it was written."""
+    try:
+        with open(SNAPSHOT_PATH) as f:
+            snapshot = json.load(f)
+    except FileNotFoundError:
+        return 0
+    except (OSError, ValueError) as e:
+        print(f"[SNAPSHOT] Ignoring unreadable {SNAPSHOT_PATH}: {e}")
+        return 0
+
+    if snapshot.get('version') != SNAPSHOT_VERSION or \
+            tuple(snapshot.get('marker') or ()) != tuple(_store.snapshot_marker()):
+        print(f"[SNAPSHOT] Ignoring {SNAPSHOT_PATH}: the database changed after it was written")
+        return 0
+
+    try:
+        for light_id, state, since in snapshot['signal_filters']:
+            _signal_filters[light_id] = SignalFilter(state, since, SIGNAL_MIN_DWELL, SIGNAL_CONFIRM_FRAMES)
+        for light_id, *row in snapshot['cycle_models']:
+            _cycle_models[light_id] = CycleModel.from_row(row)
+        for light_id, prev_state, next_state, blob in snapshot['duration_stats']:
+            _duration_stats[(light_id, prev_state, next_state)] = DurationStats.from_blob(base64.b64decode(blob))
+        for light_id, prev_state, next_state, blob in snapshot['duration_profiles']:
+            _duration_profiles[(light_id, prev_state, next_state)] = DurationProfile.from_blob(base64.b64decode(blob))
+    except Exception as e:
+        forget_light_state()
+        print(f"[SNAPSHOT] Ignoring damaged {SNAPSHOT_PATH}: {e}")
+        return 0
+    return len(_signal_filters)
+
+def open_database():
+    """Open the configured storage and bring its schema up to date"""
+    global _store
+    _store = storage.open_storage(db_path=DB_PATH, busy_timeout=WRITER_BUSY_TIMEOUT)
     
-    conn.commit()
-    conn.close()
-    print("Database tables initialized")
+    # Create or upgrade all tables and indexes
+    version = _store.initialize()
+    print(f"Database initialized at schema version {version}")
+
+def prepare_state():
+    """Bring precomputed current state up to date and resume detector health"""
+    with _store.transaction():
+        backfill_light_current()
+        _store.rebuild_intersection_current()
+    load_detector_health()
+
+def backfill_light_current():
+    """Create current state for lights whose latest state predates the light_current table."""
+    rows = _store.lights_without_current()
+    for light_id, state, since in rows:
+        update_light_current(light_id, state, since)
+    if rows:
+        print(f"[STARTUP] Precomputed next changes for {len(rows)} lights")
 
 def main():
-    # Initialize database tables
-    initialize_database()
+    started = time.perf_counter()
     
-    # Run initial cleanup
-    cleanup_old_data()
+    def startup_step(message):
+        print(f"[STARTUP] {message} after {(time.perf_counter() - started) * 1000:.0f} ms")
     
+    # Only what connecting needs runs first: the schema and the listener's credentials
+    open_database()
     username, password = register_detector.get_or_create_user(LISTENER_USERNAME)
-    client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+    client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id=CLIENT_ID,
+                         protocol=mqtt.MQTTv5, manual_ack=True)
     client.username_pw_set(username, password)
     client.on_message = on_message
     
-    # Set up periodic cleanup task
-    cleanup_interval = 900  # Run cleanup every 15 minutes
-    last_cleanup = time.time()
+    topic = f"$share/{SHARE_GROUP}/{MQTT_TOPIC}" if SHARE_GROUP else MQTT_TOPIC
     
     def on_connect(client, userdata, flags, rc, properties=None):
-        print(f"Connected with result code {rc}")
-        client.subscribe(MQTT_TOPIC)
-    
-    def maintenance_loop():
-        nonlocal last_cleanup
-        current_time = time.time()
-        
-        # Run cleanup if it's time
-        if current_time - last_cleanup > cleanup_interval:
-            cleanup_old_data()
-            last_cleanup = current_time
-            
-        # Schedule next check in 5 minutes
-        client.loop_timeout = 300
+        print(f"Connected with result code {rc} as {CLIENT_ID} (session present: {flags.session_present})")
+        client.subscribe(topic, qos=1)
+        print(f"Subscribed to {topic}")
     
     client.on_connect = on_connect
-    client.connect(MQTT_BROKER, MQTT_PORT, 60)
     
+    # Keep the session for SESSION_EXPIRY seconds after a disconnect, and never
+    # take more unacknowledged frames than the writer queue holds
+    properties = Properties(PacketTypes.CONNECT)
+    properties.SessionExpiryInterval = SESSION_EXPIRY
+    properties.ReceiveMaximum = WRITER_QUEUE_SIZE
+    client.connect_async(MQTT_BROKER, MQTT_PORT, 60, clean_start=False, properties=properties)
+    
+    # The network thread only queues frames and sends acknowledgments, and connects
+    # (and reconnects) with the same session whenever the broker is reachable
+    client.loop_start()
+    startup_step(f"Connecting to {MQTT_BROKER}:{MQTT_PORT}")
+    
+    # Frames are queued from here on, and the broker holds the rest, while the
+    # caches are warmed. The snapshot describes the store before the spool's frames.
+    restored = load_snapshot()
+    startup_step(f"Restored caches of {restored} lights from the snapshot")
+    
+    # Commit what the previous run received but did not commit, before anything new
+    spool = Spool(SPOOL_PATH)
+    replay_spool(spool)
+    prepare_state()
+    startup_step("Replayed the spool and precomputed current state")
+    
+    if RUN_MAINTENANCE and storage.BACKEND == 'sqlite':
+        threading.Thread(target=maintenance_loop, name='maintenance', daemon=True).start()
+    
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
     print("MQTT Listener Started...")
     
-    # Main loop with maintenance
-    while True:
-        client.loop(timeout=60.0)
-        maintenance_loop()
+    writer_loop(client, spool)
+    
+    client.disconnect()
+    client.loop_stop()
+    try:
+        saved = save_snapshot()
+        print(f"[SHUTDOWN] Saved caches of {saved} lights to {SNAPSHOT_PATH}")
+    except OSError as e:
+        print(f"[SHUTDOWN] Failed to save the snapshot: {e}")
+    spool.close()
+    _store.close()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+"""Provision many detectors at once from a CSV or JSON manifest.
+
+register_detector.py runs mosquitto_passwd and reloads the broker for every
+detector. This tool reads the whole manifest, hashes credentials in-process
+in Mosquitto's own format, rewrites the password file once, inserts all rows
+in one transaction and reloads the broker once at the end.
+
+Re-running with the same manifest is safe: detectors that already exist keep
+their stored password unless the manifest sets a different one, and the
+broker is not reloaded when the password file did not change.
+
+Manifest formats:
+
+    name,password          # CSV with a header; password column optional
+    detector_001,
+    detector_002,s3cret
+
+    ["detector_001", {"name": "detector_002", "password": "s3cret"}]   # JSON
+
+    python3 provision_detectors.py manifest.csv --output credentials.csv
+"""
+import argparse
+import base64
+import csv
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+
+import schema
+from register_detector import DB_PATH, MOSQUITTO_PASSWD_FILE, generate_password, reload_broker
+
+# Mosquitto 2.x "$7$" hashes: PBKDF2-HMAC-SHA512 with a 12 byte salt
+HASH_ITERATIONS = 101
+SALT_BYTES = 12
+
+
+def hash_password(password, salt=None, iterations=HASH_ITERATIONS):
+    """Hash a password the way `mosquitto_passwd` does"""
+    if salt is None:
+        salt = os.urandom(SALT_BYTES)
+    digest = hashlib.pbkdf2_hmac('sha512', password.encode(), salt, iterations)
+    return f"$7${iterations}${base64.b64encode(salt).decode()}${base64.b64encode(digest).decode()}"
+
+
+def verify_password(password, hashed):
+    """True if `hashed` is a $7$ hash of `password`"""
+    parts = hashed.split('$')
+    if len(parts) != 5 or parts[1] != '7':
+        return False
+    salt = base64.b64decode(parts[3])
+    return hash_password(password, salt, int(parts[2])) == hashed
+
+
+def load_manifest(path):
+    """List of (name, password or None) from a CSV or JSON manifest"""
+    with open(path, newline='') as f:
+        if path.endswith('.json'):
+            entries = json.load(f)
+            if isinstance(entries, dict):
+                entries = entries.get('detectors', [])
+            detectors = [(entry, None) if isinstance(entry, str)
+                         else (entry['name'], entry.get('password')) for entry in entries]
+        else:
+            detectors = [(row['name'], row.get('password')) for row in csv.DictReader(f)]
+
+    seen = set()
+    manifest = []
+    for name, password in detectors:
+        name = (name or '').strip()
+        if not name:
+            continue
+        if ':' in name:
+            raise ValueError(f"Detector name '{name}' contains ':'")
+        if name in seen:
+            raise ValueError(f"Detector '{name}' is listed more than once")
+        seen.add(name)
+        manifest.append((name, password or None))
+    return manifest
+
+
+def read_password_file(path):
+    """Existing entries as an ordered {user: hash} dict"""
+    entries = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                line = line.rstrip('\n')
+                if ':' in line:
+                    user, hashed = line.split(':', 1)
+                    entries[user] = hashed
+    return entries
+
+
+def write_password_file(path, entries):
+    """Replace the password file atomically, keeping it private to the broker"""
+    os.replace(stage_password_file(path, entries), path)
+
+
+def stage_password_file(path, entries):
+    """Write the entries to a synced temporary file next to `path` and return its path"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = f"{path}.tmp"
+    fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w') as f:
+        f.writelines(f"{user}:{hashed}\n" for user, hashed in entries.items())
+        f.flush()
+        os.fsync(f.fileno())
+    if os.path.exists(path):
+        os.chmod(temp_path, os.stat(path).st_mode & 0o777)
+    return temp_path
+
+
+def plan(manifest, stored, password_entries):
+    """Work out (rows to upsert, resulting password entries, credentials issued)"""
+    rows = []
+    credentials = []
+    entries = dict(password_entries)
+    for name, password in manifest:
+        existing = stored.get(name)
+        if password is None:
+            password = existing if existing is not None else generate_password()
+        if password != existing:
+            rows.append((name, password))
+            credentials.append((name, password, 'updated' if existing is not None else 'created'))
+        hashed = entries.get(name)
+        if hashed is None or not verify_password(password, hashed):
+            entries[name] = hash_password(password)
+    return rows, entries, credentials
+
+
+def provision(manifest, db_path=DB_PATH, password_file=MOSQUITTO_PASSWD_FILE, dry_run=False):
+    """Provision all detectors in the manifest, returning the credentials issued.
+
+    A dry run opens the database read-only and never migrates it, so it fails
+    with RuntimeError on a database whose schema is behind.
+    """
+    if dry_run:
+        conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    else:
+        conn = sqlite3.connect(db_path)
+    try:
+        if not dry_run:
+            schema.migrate(conn)
+        elif schema.current_version(conn) < schema.LATEST_VERSION:
+            raise RuntimeError(f"Database schema is at version {schema.current_version(conn)}, expected "
+                               f"{schema.LATEST_VERSION}; run schema.py or provision without --dry-run")
+        stored = dict(conn.execute("SELECT name, password FROM detectors").fetchall())
+        password_entries = read_password_file(password_file)
+        rows, entries, credentials = plan(manifest, stored, password_entries)
+        file_changed = entries != password_entries
+
+        print(f"[PROVISION] {len(manifest)} detectors in manifest: "
+              f"{sum(1 for c in credentials if c[2] == 'created')} new, "
+              f"{sum(1 for c in credentials if c[2] == 'updated')} password changes, "
+              f"{len(manifest) - len(credentials)} unchanged")
+        if dry_run:
+            return credentials
+
+        temp_path = None
+        try:
+            with conn:
+                conn.executemany("""
+                    INSERT INTO detectors (name, password) VALUES (?, ?)
+                    ON CONFLICT(name) DO UPDATE SET password = excluded.password
+                """, rows)
+                # Staged inside the transaction so a failed write leaves the database untouched,
+                # and only swapped in once the commit succeeded
+                if file_changed:
+                    temp_path = stage_password_file(password_file, entries)
+        except BaseException:
+            if temp_path is not None:
+                os.remove(temp_path)
+            raise
+        if temp_path is not None:
+            os.replace(temp_path, password_file)
+    finally:
+        conn.close()
+
+    if file_changed:
+        reload_broker()
+    else:
+        print("[PROVISION] Password file unchanged, broker not reloaded")
+    return credentials
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Provision detectors in bulk from a CSV or JSON manifest.")
+    parser.add_argument("manifest", help="CSV (name[,password] header) or .json manifest")
+    parser.add_argument("--output", "-o", help="Write issued credentials to this CSV file instead of stdout")
+    parser.add_argument("--db", default=DB_PATH, help="Path to SQLite database")
+    parser.add_argument("--password-file", default=MOSQUITTO_PASSWD_FILE, help="Mosquitto password file")
+    parser.add_argument("--dry-run", action="store_true", help="Report what would change without writing")
+    args = parser.parse_args()
+
+    try:
+        manifest = load_manifest(args.manifest)
+    except (OSError, ValueError, KeyError) as e:
+        print(f"Invalid manifest: {e}", file=sys.stderr)
+        sys.exit(1)
+
+    try:
+        credentials = provision(manifest, args.db, args.password_file, args.dry_run)
+    except (RuntimeError, sqlite3.Error) as e:
+        print(f"Cannot provision: {e}", file=sys.stderr)
+        sys.exit(1)
+    if args.dry_run or not credentials:
+        return
+
+    if args.output:
+        fd = os.open(args.output, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        out = os.fdopen(fd, 'w', newline='')
+    else:
+        out = sys.stdout
+    writer = csv.writer(out)
+    writer.writerow(['name', 'password', 'action'])
+    writer.writerows(credentials)
+    if args.output:
+        out.close()
+        print(f"[PROVISION] Credentials for {len(credentials)} detectors written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
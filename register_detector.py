@@ -4,6 +4,8 @@ import os
 import sqlite3
 import subprocess
 
+import schema
+
 DB_PATH = "/data/detectors.db"
 MOSQUITTO_PASSWD_FILE = "/data/passwords"
 
@@ -25,7 +27,10 @@ def create_mqtt_user(name, password):
     cmd = ["mosquitto_passwd", "-b", MOSQUITTO_PASSWD_FILE, name, password]
     subprocess.run(cmd, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
 
-    # Restart Mosquitto to apply the new user credentials
+    reload_broker()
+
+def reload_broker():
+    """Signal Mosquitto to reload its password file."""
     try:
         # Check if mosquitto is actually running first
         subprocess.run(["pgrep", "mosquitto"], check=True)
@@ -38,14 +43,8 @@ def save_to_db(name, password):
     conn = sqlite3.connect(DB_PATH)
     cursor = conn.cursor()
     
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS detectors (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            name TEXT UNIQUE NOT NULL,
-            password TEXT NOT NULL
-        )
-    """)
-    
+    schema.migrate(conn)
+
     cursor.execute("INSERT INTO detectors (name, password) VALUES (?, ?)", (name, password))
     conn.commit()
     conn.close()
@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+"""Batch retraining of duration models from the full state history.
+
+All state records are read in one ordered scan, paired into state durations
+and aggregated per (light, transition) with NumPy group-by operations. The
+results replace state_durations, duration_stats and duration_profiles in a
+single transaction written with executemany. A running listener sees the
+commit and reloads its cached models before its next batch.
+
+    python3 retrain_durations.py --dry-run     # report only
+    python3 retrain_durations.py               # retrain and write
+"""
+import argparse
+import sqlite3
+import time
+from array import array
+
+import numpy as np
+
+import duration_profiles
+from duration_profiles import DurationProfile
+from duration_stats import DurationStats
+# Same validity window the listener applies to live transitions
+from light_eta import MAX_DURATION, MIN_DURATION
+
+DB_PATH = "/data/detectors.db"
+
+TRANSITIONS = (('RED', 'GREEN'), ('GREEN', 'RED'))
+
+
+def load_history(conn, since=None):
+    """Read all RED/GREEN records ordered by light and time into NumPy arrays"""
+    query = """
+        SELECT light_id, state = 'GREEN', timestamp
+        FROM traffic_light_states
+    """
+    params = ()
+    if since is not None:
+        query += " WHERE timestamp >= ?"
+        params = (since,)
+    query += " ORDER BY light_id, timestamp, id"
+
+    rows = conn.execute(query, params).fetchall()
+    if not rows:
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty.astype(np.int8), empty
+
+    data = np.array(rows, dtype=np.int64)
+    return data[:, 0], data[:, 1].astype(np.int8), data[:, 2]
+
+
+def pair_transitions(light_ids, states, timestamps, min_duration, max_duration):
+    """Turn ordered records into (light_id, from_state, start, duration) arrays.
+
+    Repeated records of the same state are collapsed to the first one, so a
+    duration runs from one state change to the next within the same light.
+    """
+    if len(light_ids) == 0:
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty.astype(np.int8), empty, empty
+
+    new_light = np.empty(len(light_ids), dtype=bool)
+    new_light[0] = True
+    new_light[1:] = light_ids[1:] != light_ids[:-1]
+    changed = new_light.copy()
+    changed[1:] |= states[1:] != states[:-1]
+
+    light_ids, states, timestamps, new_light = (
+        light_ids[changed], states[changed], timestamps[changed], new_light[changed])
+
+    # Pair each state change with the next one of the same light
+    same_light = ~new_light[1:]
+    durations = timestamps[1:] - timestamps[:-1]
+    valid = same_light & (durations >= min_duration) & (durations <= max_duration)
+
+    return light_ids[:-1][valid], states[:-1][valid], timestamps[:-1][valid], durations[valid]
+
+
+def local_bucket_indexes(starts):
+    """Vectorized duration_profiles.bucket_indexes for an array of timestamps"""
+    # UTC offsets are looked up once per distinct day, not once per row
+    days = starts // 86400
+    unique_days, inverse = np.unique(days, return_inverse=True)
+    offsets = np.array([time.localtime(int(day) * 86400 + 43200).tm_gmtoff for day in unique_days],
+                       dtype=np.int64)
+    local = starts + offsets[inverse]
+
+    hour = (local // 3600) % 24
+    weekday = (local // 86400 + 3) % 7  # 1970-01-01 was a Thursday; Monday is 0
+    day_type = (weekday >= 5).astype(np.int64)
+    hours = duration_profiles.HOURS
+    return (weekday * hours + hour,
+            duration_profiles.DAY_TYPE_OFFSET + day_type * hours + hour,
+            duration_profiles.HOURLY_OFFSET + hour)
+
+
+def train(light_ids, from_states, starts, durations):
+    """Aggregate per (light, transition) and build stats and profiles.
+
+    Returns a list of (light_id, previous_state, next_state, DurationStats, DurationProfile).
+    """
+    if len(light_ids) == 0:
+        return []
+
+    # Group key: one slot per light and transition direction
+    unique_lights, light_index = np.unique(light_ids, return_inverse=True)
+    keys = light_index * 2 + from_states
+    groups = len(unique_lights) * 2
+    values = durations.astype(np.float64)
+
+    counts = np.bincount(keys, minlength=groups)
+    sums = np.bincount(keys, weights=values, minlength=groups)
+    means = np.divide(sums, counts, out=np.zeros(groups), where=counts > 0)
+    m2 = np.bincount(keys, weights=(values - means[keys]) ** 2, minlength=groups)
+
+    # Sorting by (key, duration) lays each group's durations out contiguously
+    order = np.lexsort((values, keys))
+    sorted_values = values[order]
+    group_starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+
+    # Profile means and counts for every (key, bucket) at all three levels
+    buckets = duration_profiles.BUCKETS
+    profile_counts = np.zeros(groups * buckets, dtype=np.int64)
+    profile_sums = np.zeros(groups * buckets)
+    for bucket in local_bucket_indexes(starts):
+        slots = keys * buckets + bucket
+        profile_counts += np.bincount(slots, minlength=groups * buckets)
+        profile_sums += np.bincount(slots, weights=values, minlength=groups * buckets)
+    profile_means = np.divide(profile_sums, profile_counts, out=np.zeros_like(profile_sums),
+                              where=profile_counts > 0)
+    profile_counts = np.minimum(profile_counts, 0xffff)
+
+    results = []
+    for key in np.nonzero(counts)[0]:
+        light_id = int(unique_lights[key // 2])
+        previous_state, next_state = TRANSITIONS[key % 2]
+        start = group_starts[key]
+        stats = DurationStats.from_summary(counts[key], means[key], m2[key],
+                                           sorted_values[start:start + counts[key]])
+        span = slice(key * buckets, (key + 1) * buckets)
+        profile = DurationProfile(array('f', profile_means[span].tolist()),
+                                  array('H', profile_counts[span].tolist()))
+        results.append((light_id, previous_state, next_state, stats, profile))
+    return results
+
+
+def write_results(conn, results):
+    """Replace the trained rows in one transaction"""
+    now = int(time.time())
+    with conn:
+        conn.executemany("""
+            INSERT OR REPLACE INTO state_durations
+            (light_id, previous_state, next_state, duration, last_updated)
+            VALUES (?, ?, ?, ?, ?)
+        """, [(light_id, prev, nxt, stats.mean, now) for light_id, prev, nxt, stats, _ in results])
+        conn.executemany("""
+            INSERT OR REPLACE INTO duration_stats
+            (light_id, previous_state, next_state, stats, last_updated)
+            VALUES (?, ?, ?, ?, ?)
+        """, [(light_id, prev, nxt, stats.to_blob(), now) for light_id, prev, nxt, stats, _ in results])
+        conn.executemany("""
+            INSERT OR REPLACE INTO duration_profiles
+            (light_id, previous_state, next_state, profile, last_updated)
+            VALUES (?, ?, ?, ?, ?)
+        """, [(light_id, prev, nxt, profile.to_blob(), now) for light_id, prev, nxt, _, profile in results])
+
+
+def print_report(conn, results, record_count, transition_count, elapsed):
+    current = {(row[0], row[1], row[2]): row[3] for row in conn.execute(
+        "SELECT light_id, previous_state, next_state, duration FROM state_durations")}
+
+    print(f"Read {record_count} state records, paired {transition_count} valid transitions "
+          f"in {elapsed:.2f}s")
+    print(f"{'Light':>6}  {'Transition':<12} {'Count':>7} {'Mean':>8} {'Std':>7} "
+          f"{'P10':>7} {'P50':>7} {'P90':>7} {'Current':>8}")
+    for light_id, prev, nxt, stats, _ in results:
+        existing = current.get((light_id, prev, nxt))
+        existing = f"{existing:8.2f}" if existing is not None else f"{'-':>8}"
+        print(f"{light_id:>6}  {prev + '->' + nxt:<12} {stats.count:>7} {stats.mean:>8.2f} "
+              f"{stats.stddev:>7.2f} {stats.quantile(0.1):>7.2f} {stats.quantile(0.5):>7.2f} "
+              f"{stats.quantile(0.9):>7.2f} {existing}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Retrain duration models from the full state history.")
+    parser.add_argument("--db", default=DB_PATH, help=f"Database path (default {DB_PATH})")
+    parser.add_argument("--dry-run", action="store_true", help="Report the retrained values without writing")
+    parser.add_argument("--since", type=int, help="Only use records from this epoch timestamp on")
+    parser.add_argument("--min-duration", type=float, default=MIN_DURATION, help="Shortest valid duration (s)")
+    parser.add_argument("--max-duration", type=float, default=MAX_DURATION, help="Longest valid duration (s)")
+    args = parser.parse_args()
+
+    conn = sqlite3.connect(args.db)
+    try:
+        started = time.perf_counter()
+        light_ids, states, timestamps = load_history(conn, args.since)
+        paired = pair_transitions(light_ids, states, timestamps, args.min_duration, args.max_duration)
+        results = train(*paired)
+        elapsed = time.perf_counter() - started
+
+        print_report(conn, results, len(light_ids), len(paired[0]), elapsed)
+
+        if args.dry_run:
+            print("\nDry run: no changes written")
+        else:
+            write_results(conn, results)
+            print(f"\nWrote {len(results)} transition models")
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,426 @@
+#!/usr/bin/env python3
+"""Database schema as numbered migrations.
+
+Every process that writes to the database calls ensure_schema() (or
+migrate() on an open connection) at startup. Migrations that have not been
+applied yet run in order and are recorded in the schema_version table, so a
+database created by any older version of the services is brought up to date
+and a current one is left untouched.
+
+Migrations are history: never edit one that has shipped, append a new one.
+
+    python3 schema.py            # apply pending migrations
+    python3 schema.py --status   # show applied and pending migrations
+"""
+import argparse
+import sqlite3
+import time
+
+DB_PATH = "/data/detectors.db"
+
+# Rows copied per transaction when a large table is rebuilt
+BATCH_SIZE = 20000
+
+# Table definitions as of migration 1; {table} is the name to create
+BASELINE_TABLES = {
+    'telemetry': """
+        CREATE TABLE IF NOT EXISTS {table} (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            detector_id INTEGER NOT NULL,
+            channels INTEGER NOT NULL,
+            timestamp INTEGER NOT NULL CHECK(typeof(timestamp) = 'integer'),
+            counter INTEGER NOT NULL
+        )
+    """,
+    'detectors': """
+        CREATE TABLE IF NOT EXISTS {table} (
+            name TEXT PRIMARY KEY,
+            password TEXT NOT NULL
+        )
+    """,
+    'traffic_lights': """
+        CREATE TABLE IF NOT EXISTS {table} (
+            light_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT UNIQUE NOT NULL,
+            location TEXT NOT NULL,
+            intersection_id TEXT NOT NULL DEFAULT 'UNGROUPED'
+        )
+    """,
+    'traffic_light_channels': """
+        CREATE TABLE IF NOT EXISTS {table} (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            light_id INTEGER NOT NULL,
+            detector_id INTEGER NOT NULL,
+            channel_mask INTEGER NOT NULL,
+            signal_color TEXT CHECK(signal_color IN ('RED', 'GREEN')) NOT NULL,
+            FOREIGN KEY (light_id) REFERENCES traffic_lights(light_id)
+        )
+    """,
+    'traffic_light_states': """
+        CREATE TABLE IF NOT EXISTS {table} (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            light_id INTEGER NOT NULL,
+            state TEXT CHECK(state IN ('RED', 'GREEN')) NOT NULL,
+            timestamp INTEGER NOT NULL CHECK(typeof(timestamp) = 'integer'),
+            FOREIGN KEY (light_id) REFERENCES traffic_lights(light_id)
+        )
+    """,
+    'state_durations': """
+        CREATE TABLE IF NOT EXISTS {table} (
+            light_id INTEGER NOT NULL,
+            previous_state TEXT NOT NULL,
+            next_state TEXT NOT NULL,
+            duration REAL NOT NULL,
+            last_updated INTEGER NOT NULL CHECK(typeof(last_updated) = 'integer'),
+            PRIMARY KEY (light_id, previous_state, next_state),
+            FOREIGN KEY (light_id) REFERENCES traffic_lights(light_id)
+        )
+    """,
+    'duration_stats': """
+        CREATE TABLE IF NOT EXISTS {table} (
+            light_id INTEGER NOT NULL,
+            previous_state TEXT NOT NULL,
+            next_state TEXT NOT NULL,
+            stats BLOB NOT NULL,
+            last_updated INTEGER NOT NULL,
+            PRIMARY KEY (light_id, previous_state, next_state),
+            FOREIGN KEY (light_id) REFERENCES traffic_lights(light_id)
+        )
+    """,
+    'duration_profiles': """
+        CREATE TABLE IF NOT EXISTS {table} (
+            light_id INTEGER NOT NULL,
+            previous_state TEXT NOT NULL,
+            next_state TEXT NOT NULL,
+            profile BLOB NOT NULL,
+            last_updated INTEGER NOT NULL,
+            PRIMARY KEY (light_id, previous_state, next_state),
+            FOREIGN KEY (light_id) REFERENCES traffic_lights(light_id)
+        )
+    """,
+    'cycle_models': """
+        CREATE TABLE IF NOT EXISTS {table} (
+            light_id INTEGER PRIMARY KEY,
+            cycle_length REAL NOT NULL,
+            red_duration REAL NOT NULL,
+            phase_anchor REAL NOT NULL,
+            residual REAL NOT NULL,
+            samples INTEGER NOT NULL,
+            misses INTEGER NOT NULL,
+            last_red_start INTEGER,
+            updated_at INTEGER NOT NULL,
+            FOREIGN KEY (light_id) REFERENCES traffic_lights(light_id)
+        )
+    """,
+    'light_current': """
+        CREATE TABLE IF NOT EXISTS {table} (
+            light_id INTEGER PRIMARY KEY,
+            state TEXT NOT NULL,
+            state_since INTEGER NOT NULL,
+            next_state TEXT NOT NULL,
+            expected_duration REAL NOT NULL,
+            interval_low REAL,
+            interval_high REAL,
+            confidence REAL NOT NULL,
+            cycle_length REAL,
+            red_duration REAL,
+            phase_anchor REAL,
+            cycle_residual REAL,
+            cycle_samples INTEGER,
+            updated_at INTEGER NOT NULL,
+            FOREIGN KEY (light_id) REFERENCES traffic_lights(light_id)
+        )
+    """,
+}
+
+
+def create_baseline(conn):
+    for table, ddl in BASELINE_TABLES.items():
+        conn.execute(ddl.format(table=table))
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_telemetry_timestamp ON telemetry(timestamp)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_traffic_light_states_light_timestamp "
+                 "ON traffic_light_states(light_id, timestamp)")
+
+
+def _epoch_expression(column):
+    """SQL converting a legacy time value to integer epoch seconds, NULL if unparsable.
+
+    Naive ISO strings were written with datetime.now(), i.e. local time, so
+    they are converted with the 'utc' modifier like datetime.timestamp() does.
+    """
+    return f"""CASE
+        WHEN typeof({column}) = 'integer' THEN {column}
+        WHEN typeof({column}) = 'real' THEN CAST({column} AS INTEGER)
+        WHEN {column} NOT GLOB '*[^0-9.]*' AND {column} GLOB '[0-9]*' THEN CAST(CAST({column} AS REAL) AS INTEGER)
+        ELSE CAST(strftime('%s', {column}, 'utc') AS INTEGER)
+    END"""
+
+
+def _copy_rows(conn, table, target, columns, time_column, after_id=None, limit=None):
+    """Copy converted rows into target, returning (rows read, unparsable rows, last id read)"""
+    select = ', '.join(_epoch_expression(c) if c == time_column else c for c in columns)
+    where = f"WHERE {time_column} IS NOT NULL"
+    params = []
+    if after_id is not None:
+        where += " AND id > ?"
+        params.append(after_id)
+    query = f"SELECT {select} FROM {table} {where}"
+    if limit is not None:
+        query += " ORDER BY id LIMIT ?"
+        params.append(limit)
+
+    rows = conn.execute(query, params).fetchall()
+    time_index = columns.index(time_column)
+    valid = [row for row in rows if row[time_index] is not None]
+    placeholders = ', '.join('?' * len(columns))
+    conn.executemany(f"INSERT INTO {target} ({', '.join(columns)}) VALUES ({placeholders})", valid)
+    last_id = rows[-1][0] if rows and columns[0] == 'id' else after_id
+    return len(rows), len(rows) - len(valid), last_id
+
+
+def _rebuild_with_integer_time(conn, table, columns, time_column, batched):
+    """Rebuild a table with an integer time column while writers keep running.
+
+    Append-only tables are copied in batches by id, each in its own
+    transaction. The final swap copies rows written meanwhile, replaces the
+    table and recreates its indexes in one short transaction.
+    """
+    row = conn.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)).fetchone()
+    if row is None or f"typeof({time_column}) = 'integer'" in row[0]:
+        return
+
+    target = f"{table}_migrating"
+    started = time.perf_counter()
+    indexes = [row[0] for row in conn.execute(
+        "SELECT sql FROM sqlite_master WHERE type = 'index' AND tbl_name = ? AND sql IS NOT NULL", (table,))]
+
+    with conn:
+        conn.execute(f"DROP TABLE IF EXISTS {target}")
+        conn.execute(BASELINE_TABLES[table].format(table=target))
+
+    copied = skipped = 0
+    last_id = 0
+    if batched:
+        while True:
+            with conn:
+                read, invalid, last_id = _copy_rows(conn, table, target, columns, time_column, last_id, BATCH_SIZE)
+            copied += read - invalid
+            skipped += invalid
+            if read < BATCH_SIZE:
+                break
+
+    with conn:
+        conn.execute("BEGIN IMMEDIATE")
+        read, invalid, _ = _copy_rows(conn, table, target, columns, time_column, last_id if batched else None)
+        copied += read - invalid
+        skipped += invalid
+        if batched:
+            # Keep AUTOINCREMENT from reusing ids of rows deleted before the migration
+            conn.execute("""
+                UPDATE sqlite_sequence SET seq = MAX(seq, (SELECT seq FROM sqlite_sequence WHERE name = ?))
+                WHERE name = ?
+            """, (table, target))
+        conn.execute(f"DROP TABLE {table}")
+        conn.execute(f"ALTER TABLE {target} RENAME TO {table}")
+        for sql in indexes:
+            conn.execute(sql)
+
+    print(f"[SCHEMA] {table}.{time_column}: {copied} rows converted to epoch seconds, "
+          f"{skipped} unparsable rows dropped in {time.perf_counter() - started:.2f}s")
+
+
+def integer_timestamps(conn):
+    """Convert legacy DATETIME/ISO time columns to integer epoch seconds"""
+    _rebuild_with_integer_time(conn, 'telemetry', ('id', 'detector_id', 'channels', 'timestamp', 'counter'),
+                               'timestamp', True)
+    _rebuild_with_integer_time(conn, 'traffic_light_states', ('id', 'light_id', 'state', 'timestamp'),
+                               'timestamp', True)
+    _rebuild_with_integer_time(conn, 'state_durations',
+                               ('light_id', 'previous_state', 'next_state', 'duration', 'last_updated'),
+                               'last_updated', False)
+
+
+def unify_detectors(conn):
+    """Drop the surrogate id some tools added to detectors; name is the key"""
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(detectors)")]
+    if 'id' not in columns:
+        return
+    conn.execute(BASELINE_TABLES['detectors'].format(table='detectors_migrating'))
+    conn.execute("INSERT OR IGNORE INTO detectors_migrating (name, password) SELECT name, password FROM detectors "
+                 "ORDER BY id")
+    conn.execute("DROP TABLE detectors")
+    conn.execute("ALTER TABLE detectors_migrating RENAME TO detectors")
+
+
+def workload_indexes(conn):
+    """Indexes for the lookups the listener, API and tools run"""
+    # Listener: channel config per detector on every message
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_traffic_light_channels_detector "
+                 "ON traffic_light_channels(detector_id)")
+    # Joins and deletes of a light's channels
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_traffic_light_channels_light ON traffic_light_channels(light_id)")
+    # API status, history and timeline by intersection; intersection listings
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_traffic_lights_intersection ON traffic_lights(intersection_id)")
+    # Cleanup range deletes of old states
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_traffic_light_states_timestamp ON traffic_light_states(timestamp)")
+    # Cleanup of stale duration records
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_state_durations_last_updated ON state_durations(last_updated)")
+
+
+def intersection_aggregates(conn):
+    """Per-intersection light counts, maintained by the listener with each transition"""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS intersection_current (
+            intersection_id TEXT PRIMARY KEY,
+            overall_state TEXT NOT NULL CHECK(overall_state IN ('RED', 'GREEN', 'UNKNOWN')),
+            red_lights INTEGER NOT NULL,
+            green_lights INTEGER NOT NULL,
+            last_change INTEGER NOT NULL,
+            updated_at INTEGER NOT NULL
+        )
+    """)
+
+
+def channel_indexes(conn):
+    """Store channel indexes instead of single-bit masks so channels can exceed 63.
+
+    A legacy mask with several bits set matched if any of them was lit; it
+    becomes one row per bit, which the listener treats the same way.
+    """
+    conn.execute("""
+        CREATE TABLE traffic_light_channels_migrating (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            light_id INTEGER NOT NULL,
+            detector_id INTEGER NOT NULL,
+            channel INTEGER NOT NULL CHECK(channel >= 0),
+            signal_color TEXT CHECK(signal_color IN ('RED', 'GREEN')) NOT NULL,
+            FOREIGN KEY (light_id) REFERENCES traffic_lights(light_id)
+        )
+    """)
+    rows = conn.execute("SELECT id, light_id, detector_id, channel_mask, signal_color "
+                        "FROM traffic_light_channels ORDER BY id").fetchall()
+    converted = []
+    for row_id, light_id, detector_id, mask, color in rows:
+        channels = [bit for bit in range(mask.bit_length()) if mask >> bit & 1] if mask > 0 else []
+        if not channels:
+            print(f"[SCHEMA] traffic_light_channels row {row_id}: dropped invalid mask {mask}")
+        for i, channel in enumerate(channels):
+            # The first bit keeps the row id so existing references stay valid
+            converted.append((row_id if i == 0 else None, light_id, detector_id, channel, color))
+    conn.executemany("""
+        INSERT INTO traffic_light_channels_migrating (id, light_id, detector_id, channel, signal_color)
+        VALUES (?, ?, ?, ?, ?)
+    """, sorted(converted, key=lambda row: row[0] is None))
+    conn.execute("DROP TABLE traffic_light_channels")
+    conn.execute("ALTER TABLE traffic_light_channels_migrating RENAME TO traffic_light_channels")
+    conn.execute("CREATE INDEX idx_traffic_light_channels_detector ON traffic_light_channels(detector_id)")
+    conn.execute("CREATE INDEX idx_traffic_light_channels_light ON traffic_light_channels(light_id)")
+
+
+def detector_health(conn):
+    """Per-detector liveness and link quality, flushed periodically by the listener"""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS detector_health (
+            detector_id INTEGER PRIMARY KEY,
+            first_seen REAL NOT NULL,
+            last_seen REAL NOT NULL,
+            frames INTEGER NOT NULL,
+            lost INTEGER NOT NULL,
+            restarts INTEGER NOT NULL,
+            last_counter INTEGER,
+            frame_interval REAL,
+            loss_rate REAL NOT NULL,
+            clock_offset REAL,
+            latency REAL,
+            updated_at INTEGER NOT NULL
+        )
+    """)
+
+
+# (version, description, function, runs in one transaction)
+MIGRATIONS = (
+    (1, "baseline tables", create_baseline, True),
+    (2, "integer epoch timestamps", integer_timestamps, False),
+    (3, "detectors keyed by name", unify_detectors, True),
+    (4, "workload indexes", workload_indexes, True),
+    (5, "intersection aggregates", intersection_aggregates, True),
+    (6, "channel indexes", channel_indexes, True),
+    (7, "detector health", detector_health, True),
+)
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def current_version(conn):
+    """Highest applied migration, 0 for a database without schema_version"""
+    exists = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'schema_version'").fetchone()
+    if not exists:
+        return 0
+    return conn.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version").fetchone()[0]
+
+
+def migrate(conn):
+    """Apply pending migrations in order; returns the resulting version"""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            description TEXT NOT NULL,
+            applied_at INTEGER NOT NULL
+        )
+    """)
+    conn.commit()
+
+    for version, description, apply, transactional in MIGRATIONS:
+        if version <= current_version(conn):
+            continue
+        started = time.perf_counter()
+        if transactional:
+            with conn:
+                conn.execute("BEGIN IMMEDIATE")
+                # Another process may have applied it while we waited for the lock
+                if version <= current_version(conn):
+                    continue
+                apply(conn)
+                conn.execute("INSERT INTO schema_version (version, description, applied_at) VALUES (?, ?, ?)",
+                             (version, description, int(time.time())))
+        else:
+            # Long-running migrations commit in batches and are idempotent instead
+            apply(conn)
+            with conn:
+                conn.execute("INSERT OR IGNORE INTO schema_version (version, description, applied_at) "
+                             "VALUES (?, ?, ?)", (version, description, int(time.time())))
+        print(f"[SCHEMA] Applied migration {version} ({description}) in {time.perf_counter() - started:.2f}s")
+
+    return current_version(conn)
+
+
+def ensure_schema(db_path=DB_PATH):
+    """Open the database, apply pending migrations and close it"""
+    conn = sqlite3.connect(db_path)
+    try:
+        return migrate(conn)
+    finally:
+        conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Apply database schema migrations.")
+    parser.add_argument("--db", default=DB_PATH, help=f"Database path (default {DB_PATH})")
+    parser.add_argument("--status", action="store_true", help="Show migration status without applying")
+    args = parser.parse_args()
+
+    if not args.status:
+        ensure_schema(args.db)
+
+    conn = sqlite3.connect(args.db)
+    try:
+        version = current_version(conn)
+    finally:
+        conn.close()
+    for number, description, _, _ in MIGRATIONS:
+        print(f"  {number:>3}  {'applied' if number <= version else 'pending':<8} {description}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""Debounce and glitch filter for a light's RED/GREEN signal.
+
+Detectors report raw lamp channels, which flicker: a lamp can drop out for a
+frame, both lamps can read as lit while the current crosses over, and both
+can be dark between phases. Each light keeps a small state machine in memory
+that turns raw frames into confirmed transitions:
+
+- A frame with exactly one lamp lit is an observation of RED or GREEN.
+- Frames with both lamps lit or both dark are ignored; they neither confirm
+  nor cancel a pending change.
+- A new state becomes a candidate only once the committed state has lasted
+  the minimum dwell time, and is committed after it was observed in
+  `confirm_frames` consecutive frames (hysteresis). A candidate that reverts
+  before that is a glitch and is dropped.
+- A committed transition is timestamped with the candidate's first frame, so
+  confirmation delay does not shift recorded durations.
+"""
+
+# Seconds a committed state must last before a change is considered
+MIN_DWELL = 5
+
+# Consecutive frames a new state must be observed in before it is committed
+CONFIRM_FRAMES = 2
+
+
+def classify(red, green):
+    """RED or GREEN for a frame with exactly one lamp lit, None otherwise"""
+    if red and not green:
+        return 'RED'
+    if green and not red:
+        return 'GREEN'
+    return None
+
+
+class SignalFilter:
+    __slots__ = ('state', 'since', 'candidate', 'candidate_since', 'candidate_frames',
+                 'min_dwell', 'confirm_frames')
+
+    def __init__(self, state=None, since=None, min_dwell=MIN_DWELL, confirm_frames=CONFIRM_FRAMES):
+        self.state = state
+        self.since = since
+        self.candidate = None
+        self.candidate_since = None
+        self.candidate_frames = 0
+        self.min_dwell = min_dwell
+        self.confirm_frames = confirm_frames
+
+    def update(self, red, green, timestamp):
+        """Feed one frame. Returns (previous_state, previous_since, state, since)
+        when a transition is confirmed, otherwise None. previous_state and
+        previous_since are None for the first state of a light.
+        """
+        observed = classify(red, green)
+        if observed is None:
+            return None
+        if self.since is not None and timestamp < self.since:
+            # Late frame from before the committed state began
+            return None
+
+        if observed == self.state:
+            self.candidate = None
+            return None
+
+        if self.state is not None and timestamp - self.since < self.min_dwell:
+            self.candidate = None
+            return None
+
+        if observed != self.candidate:
+            self.candidate = observed
+            self.candidate_since = timestamp
+            self.candidate_frames = 0
+        self.candidate_frames += 1
+        if self.candidate_frames < self.confirm_frames:
+            return None
+
+        previous_state, previous_since = self.state, self.since
+        self.state, self.since = observed, self.candidate_since
+        self.candidate = None
+        return previous_state, previous_since, self.state, self.since
@@ -0,0 +1,79 @@
+"""Append-only spool of received frames, written before they reach the database.
+
+Each record is a fixed header followed by the raw telemetry payload:
+
+    length    uint32   payload bytes
+    crc32     uint32   over received_at and the payload
+    received  float64  server receive time
+    payload   bytes    serialized mqtt_msg_t
+
+The listener appends every frame and fsyncs the file every few hundred
+milliseconds; a frame is acknowledged to the broker once it is synced, so a
+database that is locked or slow only delays the commit. The spool is
+truncated once everything in it is committed, and replayed in order at
+startup. A record cut short or damaged by a crash ends the replay, and the
+file is truncated before it.
+"""
+import os
+import struct
+import zlib
+
+HEADER = struct.Struct('<IId')
+
+# Larger lengths can only come from a damaged header
+MAX_PAYLOAD = 1 << 20
+
+
+class Spool:
+    def __init__(self, path):
+        self.path = path
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o600)
+        # Records appended since the last sync, written with it in one call
+        self._buffer = bytearray()
+
+    def append(self, received_at, payload):
+        received = struct.pack('<d', received_at)
+        self._buffer += HEADER.pack(len(payload), zlib.crc32(payload, zlib.crc32(received)), received_at)
+        self._buffer += payload
+
+    def sync(self):
+        """Write appended records and fsync, making them survive a crash"""
+        if self._buffer:
+            os.write(self._fd, self._buffer)
+            self._buffer.clear()
+        os.fsync(self._fd)
+
+    def truncate(self):
+        """Drop every record, once all of them are committed elsewhere"""
+        self._buffer.clear()
+        os.ftruncate(self._fd, 0)
+        os.fsync(self._fd)
+
+    def size(self):
+        return os.fstat(self._fd).st_size + len(self._buffer)
+
+    def replay(self):
+        """Read the spooled (received_at, payload) records in order, dropping a damaged tail"""
+        with open(self.path, 'rb') as f:
+            data = f.read()
+
+        records = []
+        offset = 0
+        while offset + HEADER.size <= len(data):
+            length, crc, received_at = HEADER.unpack_from(data, offset)
+            start = offset + HEADER.size
+            payload = data[start:start + length]
+            if length > MAX_PAYLOAD or len(payload) < length or \
+                    zlib.crc32(payload, zlib.crc32(data[offset + 8:start])) != crc:
+                break
+            records.append((received_at, payload))
+            offset = start + length
+
+        if offset < len(data):
+            print(f"[SPOOL] Dropping {len(data) - offset} bytes of damaged or incomplete records at the end of {self.path}")
+            os.ftruncate(self._fd, offset)
+            os.fsync(self._fd)
+        return records
+
+    def close(self):
+        os.close(self._fd)
@@ -1,10 +1,33 @@
 #!/bin/sh
 
+# Start the MQTT broker in background
+/usr/sbin/mosquitto -c /mosquitto/config/mosquitto.conf &
+BROKER_PID=$!
+
 # Start MQTT listener in background
 python3 /app/mqtt_listener.py &
+LISTENER_PID=$!
+
+# Start API server in background. Set API_DEV_SERVER=1 to use the Flask
+# development server instead of gunicorn (see gunicorn.conf.py for tuning).
+if [ "$API_DEV_SERVER" = "1" ]; then
+    python3 /app/api_server.py &
+else
+    gunicorn -c /app/gunicorn.conf.py &
+fi
+API_PID=$!
 
-# Start API server in foreground
-python3 /app/api_server.py
+# On docker stop the listener commits, acknowledges and writes its snapshot, and
+# gunicorn finishes in-flight requests. The broker stops last, after it has
+# received the listener's acknowledgments, and saves its sessions.
+stop() {
+    kill -TERM $LISTENER_PID $API_PID 2>/dev/null
+    wait $LISTENER_PID $API_PID
+    kill -TERM $BROKER_PID 2>/dev/null
+    wait $BROKER_PID
+    exit 0
+}
+trap stop TERM INT
 
 # Keep container running
 wait
@@ -0,0 +1,167 @@
+"""Compact binary encodings for status responses.
+
+Two formats are offered in addition to JSON:
+
+* protobuf (``application/x-protobuf``), see ``status_response_t`` in status.proto
+* MessagePack (``application/msgpack``), as positional arrays:
+  ``[intersection_id, timestamp, [light, ...], overall_state, red_lights,
+  green_lights, last_change]`` where each light is
+  ``[light_id, name, latitude, longitude, current_status, predicted_next_status,
+  time_to_next_change_seconds, prediction_confidence, distance_meters,
+  interval_low_seconds, interval_high_seconds, stale]``. The intersection aggregate
+  fields are nil for spatial queries.
+
+Both use integer epoch timestamps and numeric states (0 UNKNOWN, 1 RED,
+2 GREEN). The static part of each light (id, name, coordinates) is encoded
+once and cached, so a response only encodes the few fields that change.
+"""
+import struct
+import time
+
+import status_pb2
+
+try:
+    import msgpack
+except ImportError:  # MessagePack support is optional
+    msgpack = None
+
+JSON_MIMETYPE = 'application/json'
+PROTOBUF_MIMETYPE = 'application/x-protobuf'
+MSGPACK_MIMETYPE = 'application/msgpack'
+
+STATE_CODES = {'UNKNOWN': 0, 'RED': 1, 'GREEN': 2}
+
+# Tag byte of status_response_t.traffic_lights (field 3, length-delimited)
+_LIGHTS_TAG = bytes([(3 << 3) | 2])
+
+
+def available_mimetypes():
+    """Response formats that can be produced, JSON first as the default"""
+    mimetypes = [JSON_MIMETYPE, PROTOBUF_MIMETYPE]
+    if msgpack is not None:
+        mimetypes.append(MSGPACK_MIMETYPE)
+    return mimetypes
+
+
+def _varint(value):
+    out = bytearray()
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def _msgpack_array_header(length):
+    if length < 16:
+        return bytes([0x90 | length])
+    if length < 0x10000:
+        return b'\xdc' + struct.pack('>H', length)
+    return b'\xdd' + struct.pack('>I', length)
+
+
+class StatusEncoder:
+    """Encodes status dicts produced by the API, caching static per-light bytes"""
+
+    def __init__(self):
+        self._static_protobuf = {}
+        self._static_msgpack = {}
+
+    def clear(self):
+        """Drop cached static fields, e.g. after the light topology is reloaded"""
+        self._static_protobuf.clear()
+        self._static_msgpack.clear()
+
+    def _light_static_protobuf(self, light):
+        cached = self._static_protobuf.get(light['light_id'])
+        if cached is None:
+            location = light['location']
+            cached = status_pb2.light_status_t(
+                light_id=light['light_id'],
+                name=light['name'],
+                latitude_e6=round((location['latitude'] or 0.0) * 1e6),
+                longitude_e6=round((location['longitude'] or 0.0) * 1e6),
+            ).SerializeToString()
+            self._static_protobuf[light['light_id']] = cached
+        return cached
+
+    def _light_static_msgpack(self, light):
+        cached = self._static_msgpack.get(light['light_id'])
+        if cached is None:
+            location = light['location']
+            cached = b''.join(msgpack.packb(value) for value in (
+                light['light_id'], light['name'], location['latitude'], location['longitude']))
+            self._static_msgpack[light['light_id']] = cached
+        return cached
+
+    def encode_protobuf(self, status):
+        """Encode a status dict as a serialized status_response_t"""
+        parts = [status_pb2.status_response_t(
+            intersection_id=status.get('intersection_id', ''),
+            timestamp=int(time.time()),
+            overall_state=STATE_CODES.get(status.get('overall_state'), 0),
+            red_lights=status.get('red_lights') or 0,
+            green_lights=status.get('green_lights') or 0,
+            last_change=status.get('last_change') or 0,
+        ).SerializeToString()]
+
+        for light in status['traffic_lights']:
+            interval = light.get('prediction_interval_seconds') or (0.0, 0.0)
+            # Concatenated protobuf messages merge, so static and dynamic
+            # halves can be encoded separately and joined
+            dynamic = status_pb2.light_status_t(
+                current_status=STATE_CODES.get(light['current_status'], 0),
+                predicted_next_status=STATE_CODES.get(light['predicted_next_status'], 0),
+                time_to_next_change_seconds=light['time_to_next_change_seconds'] or 0.0,
+                prediction_confidence=light['prediction_confidence'],
+                distance_meters=round(light.get('distance_meters', 0)),
+                interval_low_seconds=interval[0],
+                interval_high_seconds=interval[1],
+                stale=light.get('stale', False),
+            ).SerializeToString()
+            encoded = self._light_static_protobuf(light) + dynamic
+            parts.append(_LIGHTS_TAG + _varint(len(encoded)) + encoded)
+
+        return b''.join(parts)
+
+    def encode_msgpack(self, status):
+        """Encode a status dict as positional MessagePack arrays"""
+        lights = status['traffic_lights']
+        parts = [
+            _msgpack_array_header(7),
+            msgpack.packb(status.get('intersection_id', '')),
+            msgpack.packb(int(time.time())),
+            _msgpack_array_header(len(lights)),
+        ]
+
+        for light in lights:
+            interval = light.get('prediction_interval_seconds') or (None, None)
+            parts.append(_msgpack_array_header(12))
+            parts.append(self._light_static_msgpack(light))
+            # Drop the packed list's own header so its elements continue the light array
+            parts.append(msgpack.packb([
+                STATE_CODES.get(light['current_status'], 0),
+                STATE_CODES.get(light['predicted_next_status'], 0),
+                light['time_to_next_change_seconds'],
+                light['prediction_confidence'],
+                light.get('distance_meters'),
+                interval[0],
+                interval[1],
+                light.get('stale', False),
+            ], use_single_float=True)[1:])
+
+        overall_state = status.get('overall_state')
+        parts.append(msgpack.packb([
+            STATE_CODES.get(overall_state, 0) if overall_state else None,
+            status.get('red_lights'),
+            status.get('green_lights'),
+            status.get('last_change'),
+        ])[1:])
+        return b''.join(parts)
+
+    def encode(self, status, mimetype):
+        if mimetype == PROTOBUF_MIMETYPE:
+            return self.encode_protobuf(status)
+        if mimetype == MSGPACK_MIMETYPE:
+            return self.encode_msgpack(status)
+        raise ValueError(f"Unsupported response format: {mimetype}")
@@ -0,0 +1,956 @@
+"""Storage backends for the listener and the API.
+
+Every read and write of the light topology, recorded transitions, duration
+models, current state and detector health goes through a Storage, so the
+ingest and prediction logic can run against different stores:
+
+- SQLiteStorage: the production store at DB_PATH. The listener holds one
+  read-write connection and writes in explicit transactions; API workers
+  read through a ReadOnlyPool.
+- MemoryStorage: everything in process memory, with each light's history
+  in arrays, for benchmarks and tests without a disk. It lives in one
+  process, so the listener and the API only share it when they run in the
+  same interpreter.
+
+The backend is chosen with STORAGE_BACKEND ('sqlite' or 'memory'). A memory
+store starts empty; STORAGE_TOPOLOGY names a topology file (see topology.py)
+to load its lights from.
+"""
+import os
+import sqlite3
+import time
+from array import array
+from bisect import bisect_left
+from collections import defaultdict
+from contextlib import contextmanager
+
+import channel_bits
+import detector_health
+import history
+import schema
+from cycle_model import CycleModel
+from db_pool import ReadOnlyPool
+from duration_profiles import DurationProfile
+from duration_stats import DurationStats
+from light_eta import LightEta
+
+DB_PATH = "/data/detectors.db"
+BACKEND = os.environ.get('STORAGE_BACKEND', 'sqlite')
+TOPOLOGY_PATH = os.environ.get('STORAGE_TOPOLOGY', '')
+
+# Errors a caller may retry (locked or unavailable database), and all storage errors
+OperationalError = sqlite3.OperationalError
+Error = sqlite3.Error
+
+# Columns of light_current read by LightEta.from_row
+LIGHT_CURRENT_COLUMNS = """state, state_since, next_state, expected_duration, interval_low, interval_high,
+                   confidence, cycle_length, red_duration, phase_anchor, cycle_residual, cycle_samples"""
+
+STATE_BEFORE_QUERY = """
+    SELECT state
+    FROM traffic_light_states
+    WHERE light_id = ? AND timestamp < ?
+    ORDER BY timestamp DESC
+    LIMIT 1
+"""
+
+TRANSITIONS_QUERY = """
+    SELECT state, timestamp
+    FROM traffic_light_states
+    WHERE light_id = ? AND timestamp >= ? AND timestamp < ?
+    ORDER BY timestamp
+"""
+
+
+class Storage:
+    """Operations the listener and the API need from a store.
+
+    Keys of duration models are (light_id, prev_state, next_state). Writes
+    made inside transaction() are committed together; savepoint() undoes the
+    writes of one frame inside it.
+    """
+
+    # Lifecycle
+    def initialize(self):
+        """Prepare the store for writing and return its schema version"""
+        raise NotImplementedError
+
+    def schema_version(self):
+        raise NotImplementedError
+
+    def transaction(self):
+        raise NotImplementedError
+
+    def savepoint(self):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def pool_stats(self):
+        return {}
+
+    def changed_elsewhere(self):
+        """Whether another process committed to the store since the last call"""
+        return False
+
+    # Topology
+    def detector_channels(self, detector_id):
+        """[(light_id, channel, signal_color, intersection_id, name, location)] of a detector"""
+        raise NotImplementedError
+
+    def lights(self):
+        """[(light_id, name, location, intersection_id)]"""
+        raise NotImplementedError
+
+    def light_detectors(self):
+        """[(light_id, detector_id)] pairs, each once"""
+        raise NotImplementedError
+
+    def intersection_lights(self, intersection_id):
+        """Light ids of an intersection in ascending order"""
+        raise NotImplementedError
+
+    # Telemetry and transitions
+    def add_telemetry(self, detector_id, channels, timestamp, counter):
+        raise NotImplementedError
+
+    def add_state(self, light_id, state, timestamp):
+        raise NotImplementedError
+
+    def last_state(self, light_id):
+        """(state, timestamp) of the latest transition, or None"""
+        raise NotImplementedError
+
+    def state_before(self, light_id, timestamp):
+        """State in effect just before timestamp, or None"""
+        raise NotImplementedError
+
+    def transitions(self, light_id, start, end):
+        """(state, timestamp) for start <= timestamp < end in time order"""
+        raise NotImplementedError
+
+    def history(self, light_ids, start, end, limit, cursor=None):
+        """(light_id, row_id, state, timestamp) pages, as history.iter_history"""
+        raise NotImplementedError
+
+    # Duration models
+    def get_ema_duration(self, key):
+        raise NotImplementedError
+
+    def put_ema_duration(self, key, duration):
+        raise NotImplementedError
+
+    def get_duration_stats(self, key):
+        raise NotImplementedError
+
+    def put_duration_stats(self, key, stats):
+        raise NotImplementedError
+
+    def get_duration_profile(self, key):
+        raise NotImplementedError
+
+    def put_duration_profile(self, key, profile):
+        raise NotImplementedError
+
+    def get_cycle_model(self, light_id):
+        raise NotImplementedError
+
+    def put_cycle_model(self, light_id, model):
+        raise NotImplementedError
+
+    # Current state
+    def get_light_current(self, light_ids):
+        """{light_id: LightEta} for lights that have a current state"""
+        raise NotImplementedError
+
+    def get_light_state(self, light_id):
+        """(state, state_since) from the current state, or None"""
+        raise NotImplementedError
+
+    def put_light_current(self, light_id, eta):
+        raise NotImplementedError
+
+    def lights_without_current(self):
+        """(light_id, state, since) of lights with history but no current state"""
+        raise NotImplementedError
+
+    def update_intersection_current(self, intersection_id, prev_state, state, changed_at):
+        raise NotImplementedError
+
+    def rebuild_intersection_current(self):
+        raise NotImplementedError
+
+    def intersection_current(self, intersection_id):
+        """((overall_state, red_lights, green_lights, last_change), [(light_id, LightEta)]) or None"""
+        raise NotImplementedError
+
+    # Detector health
+    def load_detector_health(self, detector_id=None):
+        """Rows of detector_health.COLUMNS ordered by detector_id"""
+        raise NotImplementedError
+
+    def save_detector_health(self, rows, merge=False):
+        """Store detector_health.COLUMNS rows; merge adds them to other instances' flushes"""
+        raise NotImplementedError
+
+    def detector_last_seen(self):
+        """{detector_id: last_seen}"""
+        raise NotImplementedError
+
+    # Maintenance
+    def cleanup(self, cutoff, now):
+        """Drop old telemetry and superseded states; returns (telemetry, states) removed"""
+        raise NotImplementedError
+
+    def snapshot_marker(self):
+        """Tuple that changes whenever a transition or duration model is written,
+        so a cache snapshot can tell whether it still matches the store"""
+        raise NotImplementedError
+
+
+class SQLiteStorage(Storage):
+    """Storage in the SQLite database at db_path.
+
+    Opened read-write, it switches the database to WAL, keeps one autocommit
+    connection with a larger page cache and statement cache, and
+    transaction() issues BEGIN IMMEDIATE so a batch holds the write lock from
+    its first statement, waiting up to busy_timeout seconds for it. Opened
+    read-only, each call checks out a pooled per-thread connection.
+    """
+
+    def __init__(self, db_path=DB_PATH, readonly=False, pool_size=4, busy_timeout=5.0):
+        self.db_path = db_path
+        self._pool = ReadOnlyPool(db_path, size=pool_size) if readonly else None
+        self._conn = None
+        if not readonly:
+            self._conn = sqlite3.connect(db_path, timeout=busy_timeout, isolation_level=None, cached_statements=256)
+            self._conn.execute("PRAGMA cache_size = -16384")
+            self._conn.execute("PRAGMA temp_store = MEMORY")
+            # Readers see the last commit without holding locks that would block the writer's COMMIT
+            self._conn.execute("PRAGMA journal_mode = WAL")
+            self._data_version = self._conn.execute("PRAGMA data_version").fetchone()[0]
+
+    @contextmanager
+    def _connection(self):
+        if self._pool is None:
+            yield self._conn
+        else:
+            with self._pool.connection() as conn:
+                yield conn
+
+    def initialize(self):
+        # Migrations manage their own transactions on a connection of their own
+        version = schema.ensure_schema(self.db_path)
+        self.changed_elsewhere()
+        return version
+
+    def schema_version(self):
+        with self._connection() as conn:
+            return schema.current_version(conn)
+
+    @contextmanager
+    def transaction(self):
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+            self._conn.execute("COMMIT")
+        except BaseException:
+            # A failed COMMIT leaves the transaction open; end it so the next BEGIN can start
+            if self._conn.in_transaction:
+                self._conn.execute("ROLLBACK")
+            raise
+
+    @contextmanager
+    def savepoint(self):
+        self._conn.execute("SAVEPOINT frame")
+        try:
+            yield
+        except BaseException:
+            self._conn.execute("ROLLBACK TO frame")
+            self._conn.execute("RELEASE frame")
+            raise
+        self._conn.execute("RELEASE frame")
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+
+    def pool_stats(self):
+        return self._pool.stats() if self._pool is not None else {}
+
+    def changed_elsewhere(self):
+        # data_version only moves for commits made on other connections
+        version = self._conn.execute("PRAGMA data_version").fetchone()[0]
+        changed, self._data_version = version != self._data_version, version
+        return changed
+
+    def detector_channels(self, detector_id):
+        with self._connection() as conn:
+            return [tuple(row) for row in conn.execute("""
+                SELECT tlc.light_id, tlc.channel, tlc.signal_color,
+                       tl.intersection_id, tl.name, tl.location
+                FROM traffic_light_channels tlc
+                JOIN traffic_lights tl ON tlc.light_id = tl.light_id
+                WHERE tlc.detector_id = ?
+            """, (detector_id,))]
+
+    def lights(self):
+        with self._connection() as conn:
+            return [tuple(row) for row in conn.execute(
+                "SELECT light_id, name, location, intersection_id FROM traffic_lights")]
+
+    def light_detectors(self):
+        with self._connection() as conn:
+            return [tuple(row) for row in conn.execute(
+                "SELECT DISTINCT light_id, detector_id FROM traffic_light_channels")]
+
+    def intersection_lights(self, intersection_id):
+        with self._connection() as conn:
+            return [row[0] for row in conn.execute(
+                "SELECT light_id FROM traffic_lights WHERE intersection_id = ? ORDER BY light_id",
+                (intersection_id,))]
+
+    def add_telemetry(self, detector_id, channels, timestamp, counter):
+        self._conn.execute("INSERT INTO telemetry (detector_id, channels, timestamp, counter) VALUES (?, ?, ?, ?)",
+                           (detector_id, channel_bits.db_value(channels), timestamp, counter))
+
+    def add_state(self, light_id, state, timestamp):
+        self._conn.execute("""
+            INSERT INTO traffic_light_states (light_id, state, timestamp)
+            VALUES (?, ?, ?)
+        """, (light_id, state, timestamp))
+
+    def last_state(self, light_id):
+        with self._connection() as conn:
+            row = conn.execute("""
+                SELECT state, timestamp
+                FROM traffic_light_states
+                WHERE light_id = ?
+                ORDER BY timestamp DESC, id DESC
+                LIMIT 1
+            """, (light_id,)).fetchone()
+        return tuple(row) if row else None
+
+    def state_before(self, light_id, timestamp):
+        with self._connection() as conn:
+            row = conn.execute(STATE_BEFORE_QUERY, (light_id, timestamp)).fetchone()
+        return row[0] if row else None
+
+    def transitions(self, light_id, start, end):
+        with self._connection() as conn:
+            return [tuple(row) for row in conn.execute(TRANSITIONS_QUERY, (light_id, start, end))]
+
+    def history(self, light_ids, start, end, limit, cursor=None):
+        # Rows are streamed while the connection stays checked out
+        with self._connection() as conn:
+            yield from history.iter_history(conn, light_ids, start, end, limit, cursor)
+
+    def get_ema_duration(self, key):
+        with self._connection() as conn:
+            row = conn.execute("""
+                SELECT duration FROM state_durations
+                WHERE light_id = ? AND previous_state = ? AND next_state = ?
+            """, key).fetchone()
+        return row[0] if row else None
+
+    def put_ema_duration(self, key, duration):
+        self._conn.execute("""
+            INSERT OR REPLACE INTO state_durations
+            (light_id, previous_state, next_state, duration, last_updated)
+            VALUES (?, ?, ?, ?, ?)
+        """, (*key, duration, int(time.time())))
+
+    def get_duration_stats(self, key):
+        with self._connection() as conn:
+            row = conn.execute("""
+                SELECT stats FROM duration_stats
+                WHERE light_id = ? AND previous_state = ? AND next_state = ?
+            """, key).fetchone()
+        return DurationStats.from_blob(row[0]) if row else None
+
+    def put_duration_stats(self, key, stats):
+        self._conn.execute("""
+            INSERT OR REPLACE INTO duration_stats
+            (light_id, previous_state, next_state, stats, last_updated)
+            VALUES (?, ?, ?, ?, ?)
+        """, (*key, stats.to_blob(), int(time.time())))
+
+    def get_duration_profile(self, key):
+        with self._connection() as conn:
+            row = conn.execute("""
+                SELECT profile FROM duration_profiles
+                WHERE light_id = ? AND previous_state = ? AND next_state = ?
+            """, key).fetchone()
+        return DurationProfile.from_blob(row[0]) if row else None
+
+    def put_duration_profile(self, key, profile):
+        self._conn.execute("""
+            INSERT OR REPLACE INTO duration_profiles
+            (light_id, previous_state, next_state, profile, last_updated)
+            VALUES (?, ?, ?, ?, ?)
+        """, (*key, profile.to_blob(), int(time.time())))
+
+    def get_cycle_model(self, light_id):
+        with self._connection() as conn:
+            row = conn.execute("""
+                SELECT cycle_length, red_duration, phase_anchor, residual, samples, misses, last_red_start
+                FROM cycle_models
+                WHERE light_id = ?
+            """, (light_id,)).fetchone()
+        return CycleModel.from_row(tuple(row)) if row else None
+
+    def put_cycle_model(self, light_id, model):
+        self._conn.execute("""
+            INSERT OR REPLACE INTO cycle_models
+            (light_id, cycle_length, red_duration, phase_anchor, residual, samples, misses, last_red_start, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, (light_id, *model.to_row(), int(time.time())))
+
+    def get_light_current(self, light_ids):
+        if not light_ids:
+            return {}
+        placeholders = ','.join('?' * len(light_ids))
+        with self._connection() as conn:
+            rows = conn.execute(f"""
+                SELECT light_id, {LIGHT_CURRENT_COLUMNS}
+                FROM light_current
+                WHERE light_id IN ({placeholders})
+            """, list(light_ids)).fetchall()
+        return {row[0]: LightEta.from_row(tuple(row)[1:]) for row in rows}
+
+    def get_light_state(self, light_id):
+        with self._connection() as conn:
+            row = conn.execute("SELECT state, state_since FROM light_current WHERE light_id = ?",
+                               (light_id,)).fetchone()
+        return tuple(row) if row else None
+
+    def put_light_current(self, light_id, eta):
+        self._conn.execute("""
+            INSERT OR REPLACE INTO light_current
+            (light_id, state, state_since, next_state, expected_duration, interval_low, interval_high, confidence,
+             cycle_length, red_duration, phase_anchor, cycle_residual, cycle_samples, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, (light_id, *eta.to_row(), int(time.time())))
+
+    def lights_without_current(self):
+        with self._connection() as conn:
+            return [tuple(row) for row in conn.execute("""
+                SELECT tl.light_id, latest.state, latest.timestamp
+                FROM traffic_lights tl
+                JOIN traffic_light_states latest ON latest.id = (
+                    SELECT id FROM traffic_light_states
+                    WHERE light_id = tl.light_id
+                    ORDER BY timestamp DESC, id DESC
+                    LIMIT 1
+                )
+                WHERE tl.light_id NOT IN (SELECT light_id FROM light_current)
+            """)]
+
+    def update_intersection_current(self, intersection_id, prev_state, state, changed_at):
+        red_delta = (state == 'RED') - (prev_state == 'RED')
+        green_delta = (state == 'GREEN') - (prev_state == 'GREEN')
+        now = int(time.time())
+        cursor = self._conn.execute("""
+            UPDATE intersection_current SET
+                red_lights = red_lights + ?,
+                green_lights = green_lights + ?,
+                overall_state = CASE WHEN red_lights + ? > 0 THEN 'RED'
+                                     WHEN green_lights + ? > 0 THEN 'GREEN'
+                                     ELSE 'UNKNOWN' END,
+                last_change = MAX(last_change, ?),
+                updated_at = ?
+            WHERE intersection_id = ?
+        """, (red_delta, green_delta, red_delta, green_delta, changed_at, now, intersection_id))
+        if cursor.rowcount == 0:
+            # First light of this intersection to report
+            self._conn.execute("""
+                INSERT INTO intersection_current
+                (intersection_id, overall_state, red_lights, green_lights, last_change, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+            """, (intersection_id, state, int(state == 'RED'), int(state == 'GREEN'), changed_at, now))
+
+    def rebuild_intersection_current(self):
+        self._conn.execute("DELETE FROM intersection_current")
+        self._conn.execute("""
+            INSERT INTO intersection_current
+            (intersection_id, overall_state, red_lights, green_lights, last_change, updated_at)
+            SELECT tl.intersection_id,
+                   CASE WHEN SUM(lc.state = 'RED') > 0 THEN 'RED'
+                        WHEN SUM(lc.state = 'GREEN') > 0 THEN 'GREEN'
+                        ELSE 'UNKNOWN' END,
+                   SUM(lc.state = 'RED'), SUM(lc.state = 'GREEN'), MAX(lc.state_since), ?
+            FROM light_current lc
+            JOIN traffic_lights tl ON tl.light_id = lc.light_id
+            GROUP BY tl.intersection_id
+        """, (int(time.time()),))
+
+    def intersection_current(self, intersection_id):
+        with self._connection() as conn:
+            aggregate = conn.execute("""
+                SELECT overall_state, red_lights, green_lights, last_change
+                FROM intersection_current
+                WHERE intersection_id = ?
+                """, (intersection_id,)).fetchone()
+            if aggregate is None:
+                return None
+            rows = conn.execute(f"""
+                SELECT lc.light_id, {LIGHT_CURRENT_COLUMNS}
+                FROM traffic_lights tl
+                JOIN light_current lc ON lc.light_id = tl.light_id
+                WHERE tl.intersection_id = ?
+                """, (intersection_id,)).fetchall()
+        return tuple(aggregate), [(row[0], LightEta.from_row(tuple(row)[1:])) for row in rows]
+
+    def load_detector_health(self, detector_id=None):
+        columns = ', '.join(detector_health.COLUMNS)
+        with self._connection() as conn:
+            if detector_id is None:
+                rows = conn.execute(f"SELECT {columns} FROM detector_health ORDER BY detector_id")
+            else:
+                rows = conn.execute(f"SELECT {columns} FROM detector_health WHERE detector_id = ?",
+                                    (detector_id,))
+            return [tuple(row) for row in rows]
+
+    def save_detector_health(self, rows, merge=False):
+        columns = ', '.join(detector_health.COLUMNS)
+        placeholders = ', '.join('?' * (len(detector_health.COLUMNS) + 1))
+        now = int(time.time())
+        if not merge:
+            self._conn.executemany(f"""
+                INSERT OR REPLACE INTO detector_health ({columns}, updated_at)
+                VALUES ({placeholders})
+            """, [(*row, now) for row in rows])
+            return
+        # Counts are deltas since the last flush; the frame interval is taken over all instances' frames
+        self._conn.executemany(f"""
+            INSERT INTO detector_health ({columns}, updated_at)
+            VALUES ({placeholders})
+            ON CONFLICT(detector_id) DO UPDATE SET
+                first_seen = MIN(first_seen, excluded.first_seen),
+                last_seen = MAX(last_seen, excluded.last_seen),
+                frames = frames + excluded.frames,
+                lost = lost + excluded.lost,
+                restarts = restarts + excluded.restarts,
+                last_counter = CASE WHEN excluded.last_seen >= last_seen
+                                    THEN excluded.last_counter ELSE last_counter END,
+                frame_interval = (MAX(last_seen, excluded.last_seen) - MIN(first_seen, excluded.first_seen))
+                                 / MAX(1, frames + excluded.frames - 1),
+                loss_rate = excluded.loss_rate,
+                clock_offset = MIN(COALESCE(clock_offset, excluded.clock_offset),
+                                   COALESCE(excluded.clock_offset, clock_offset)),
+                latency = COALESCE(excluded.latency, latency),
+                updated_at = excluded.updated_at
+        """, [(*row, now) for row in rows])
+
+    def detector_last_seen(self):
+        with self._connection() as conn:
+            return dict(tuple(row) for row in conn.execute("SELECT detector_id, last_seen FROM detector_health"))
+
+    def cleanup(self, cutoff, now):
+        with self.transaction():
+            deleted_telemetry = self._conn.execute("DELETE FROM telemetry WHERE timestamp < ?", (cutoff,)).rowcount
+
+            # Keep the most recent row of each state for every light
+            deleted_states = self._conn.execute("""
+                DELETE FROM traffic_light_states AS old
+                WHERE timestamp < ? AND EXISTS (
+                    SELECT 1 FROM traffic_light_states newer
+                    WHERE newer.light_id = old.light_id AND newer.state = old.state
+                      AND newer.timestamp >= old.timestamp AND newer.id > old.id
+                )
+            """, (cutoff,)).rowcount
+
+            # Fix any timestamps from before 2024 (likely incorrect)
+            year_2024_timestamp = 1704067200  # Jan 1, 2024
+            lights_with_old_timestamps = [row[0] for row in self._conn.execute("""
+                SELECT DISTINCT light_id FROM traffic_light_states
+                WHERE timestamp < ?
+            """, (year_2024_timestamp,))]
+
+            if lights_with_old_timestamps:
+                print(f"[CLEANUP] Found {len(lights_with_old_timestamps)} lights with outdated timestamps")
+
+                # Keep only the most recent state of each and move it to the current time
+                for light_id in lights_with_old_timestamps:
+                    result = self._conn.execute("""
+                        SELECT state FROM traffic_light_states
+                        WHERE light_id = ?
+                        ORDER BY timestamp DESC
+                        LIMIT 1
+                    """, (light_id,)).fetchone()
+                    if result:
+                        current_state = result[0]
+                        self._conn.execute("DELETE FROM traffic_light_states WHERE light_id = ?", (light_id,))
+                        self.add_state(light_id, current_state, now)
+                        print(f"[CLEANUP] Reset timestamp for light {light_id} to current time "
+                              f"with state {current_state}")
+
+            # Remove any invalid state transitions (involving UNKNOWN states)
+            deleted_transitions = self._conn.execute("""
+                DELETE FROM state_durations
+                WHERE previous_state = 'UNKNOWN' OR next_state = 'UNKNOWN'
+            """).rowcount
+            if deleted_transitions > 0:
+                print(f"[CLEANUP] Removed {deleted_transitions} invalid state transitions")
+
+            # Update outdated state_durations records
+            updated_durations = self._conn.execute("""
+                UPDATE state_durations
+                SET last_updated = ?
+                WHERE last_updated < ?
+            """, (now, now - 365 * 86400)).rowcount
+            if updated_durations > 0:
+                print(f"[CLEANUP] Updated timestamps for {updated_durations} duration records")
+
+            # Reconcile intersection aggregates with per-light state, e.g. after lights were regrouped
+            self.rebuild_intersection_current()
+
+        # Vacuum database to reclaim space (only if we deleted a significant amount of data)
+        if deleted_telemetry > 50 or deleted_states > 50 or deleted_transitions > 0 or lights_with_old_timestamps:
+            self._conn.execute("VACUUM")
+            print("[CLEANUP] Database vacuumed to reclaim space")
+
+        return deleted_telemetry, deleted_states
+
+    def snapshot_marker(self):
+        with self._connection() as conn:
+            return conn.execute("""
+                SELECT (SELECT MAX(id) FROM traffic_light_states),
+                       (SELECT MAX(last_updated) FROM duration_stats),
+                       (SELECT MAX(last_updated) FROM duration_profiles),
+                       (SELECT MAX(updated_at) FROM cycle_models)
+            """).fetchone()
+
+
+# State codes of MemoryStorage histories
+STATES = ('UNKNOWN', 'RED', 'GREEN')
+_STATE_CODES = {state: code for code, state in enumerate(STATES)}
+
+
+class _LightHistory:
+    """One light's transitions as parallel arrays sorted by (timestamp, id)"""
+    __slots__ = ('ids', 'times', 'states')
+
+    def __init__(self):
+        self.ids = array('q')
+        self.times = array('q')
+        self.states = bytearray()
+
+    def add(self, row_id, state, timestamp):
+        if not self.times or timestamp >= self.times[-1]:
+            self.ids.append(row_id)
+            self.times.append(timestamp)
+            self.states.append(_STATE_CODES[state])
+        else:
+            index = bisect_left(self.times, timestamp + 1)
+            self.ids.insert(index, row_id)
+            self.times.insert(index, timestamp)
+            self.states.insert(index, _STATE_CODES[state])
+
+    def remove(self, row_id):
+        index = self.ids.index(row_id)
+        del self.ids[index]
+        del self.times[index]
+        del self.states[index]
+
+    def keep(self, indexes):
+        self.ids = array('q', (self.ids[i] for i in indexes))
+        self.times = array('q', (self.times[i] for i in indexes))
+        self.states = bytearray(self.states[i] for i in indexes)
+
+
+class MemoryStorage(Storage):
+    """Storage in process memory without any I/O.
+
+    Transitions are kept per light in arrays searched with bisect, telemetry
+    in column arrays and everything else in dicts. Models are stored
+    serialized, as in SQLite, so changes to a caller's copy are not visible
+    until it is put. Inside transaction() every write records how to undo
+    it, and a transaction or savepoint that raises is rolled back like
+    SQLite's.
+    """
+
+    def __init__(self):
+        self._lights = {}
+        self._channels = defaultdict(list)
+        self._next_row_id = 1
+        self._telemetry = {'detector_id': array('q'), 'timestamp': array('d'), 'counter': array('q')}
+        self._telemetry_channels = []
+        self._histories = defaultdict(_LightHistory)
+        self._ema_durations = {}
+        self._duration_stats = {}
+        self._duration_profiles = {}
+        self._cycle_models = {}
+        self._light_current = {}
+        self._intersection_current = {}
+        self._detector_health = {}
+        # Undo actions of the open transaction, None outside of one
+        self._undo = None
+
+    def _set(self, table, key, value):
+        if self._undo is not None:
+            if key in table:
+                old = table[key]
+                self._undo.append(lambda: table.__setitem__(key, old))
+            else:
+                self._undo.append(lambda: table.pop(key, None))
+        table[key] = value
+
+    def _rollback(self, mark):
+        while len(self._undo) > mark:
+            self._undo.pop()()
+
+    def load_topology(self, lights):
+        """Add lights in topology.parse_lights() form, returning {name: light_id}"""
+        ids = {}
+        for name, (intersection_id, location, detector_id, red, green) in lights.items():
+            light_id = len(self._lights) + 1
+            self._lights[light_id] = (name, location, intersection_id)
+            self._channels[detector_id].append((light_id, red, 'RED', intersection_id, name, location))
+            self._channels[detector_id].append((light_id, green, 'GREEN', intersection_id, name, location))
+            ids[name] = light_id
+        return ids
+
+    def initialize(self):
+        return schema.LATEST_VERSION
+
+    def schema_version(self):
+        return schema.LATEST_VERSION
+
+    @contextmanager
+    def transaction(self):
+        self._undo = []
+        try:
+            yield
+        except BaseException:
+            self._rollback(0)
+            raise
+        finally:
+            self._undo = None
+
+    @contextmanager
+    def savepoint(self):
+        if self._undo is None:
+            with self.transaction():
+                yield
+            return
+        mark = len(self._undo)
+        try:
+            yield
+        except BaseException:
+            self._rollback(mark)
+            raise
+
+    def detector_channels(self, detector_id):
+        return list(self._channels.get(detector_id, ()))
+
+    def lights(self):
+        return [(light_id, name, location, intersection_id)
+                for light_id, (name, location, intersection_id) in self._lights.items()]
+
+    def light_detectors(self):
+        return sorted({(channel[0], detector_id)
+                       for detector_id, channels in self._channels.items() for channel in channels})
+
+    def intersection_lights(self, intersection_id):
+        return sorted(light_id for light_id, light in self._lights.items() if light[2] == intersection_id)
+
+    def add_telemetry(self, detector_id, channels, timestamp, counter):
+        self._telemetry['detector_id'].append(detector_id)
+        self._telemetry['timestamp'].append(timestamp)
+        self._telemetry['counter'].append(counter)
+        self._telemetry_channels.append(channels)
+        if self._undo is not None:
+            self._undo.append(self._remove_last_telemetry)
+
+    def _remove_last_telemetry(self):
+        for column in self._telemetry.values():
+            column.pop()
+        self._telemetry_channels.pop()
+
+    def add_state(self, light_id, state, timestamp):
+        row_id = self._next_row_id
+        self._histories[light_id].add(row_id, state, timestamp)
+        self._next_row_id += 1
+        if self._undo is not None:
+            self._undo.append(lambda: self._histories[light_id].remove(row_id))
+
+    def last_state(self, light_id):
+        light = self._histories.get(light_id)
+        if not light or not light.times:
+            return None
+        return STATES[light.states[-1]], light.times[-1]
+
+    def state_before(self, light_id, timestamp):
+        light = self._histories.get(light_id)
+        index = bisect_left(light.times, timestamp) if light else 0
+        return STATES[light.states[index - 1]] if index else None
+
+    def transitions(self, light_id, start, end):
+        light = self._histories.get(light_id)
+        if not light:
+            return []
+        first, last = bisect_left(light.times, start), bisect_left(light.times, end)
+        return [(STATES[light.states[i]], light.times[i]) for i in range(first, last)]
+
+    def history(self, light_ids, start, end, limit, cursor=None):
+        remaining = limit
+        for light_id in sorted(light_ids):
+            if remaining <= 0:
+                return
+            if cursor and light_id < cursor[0]:
+                continue
+            light = self._histories.get(light_id)
+            if not light:
+                continue
+
+            after = cursor[1:] if cursor and light_id == cursor[0] else None
+            index = bisect_left(light.times, max(start, after[0]) if after else start)
+            while index < len(light.times) and remaining > 0:
+                timestamp, row_id = light.times[index], light.ids[index]
+                if timestamp >= end:
+                    break
+                index += 1
+                if after and (timestamp, row_id) <= after:
+                    continue
+                remaining -= 1
+                yield light_id, row_id, STATES[light.states[index - 1]], timestamp
+
+    def get_ema_duration(self, key):
+        return self._ema_durations.get(key)
+
+    def put_ema_duration(self, key, duration):
+        self._set(self._ema_durations, key, duration)
+
+    def get_duration_stats(self, key):
+        blob = self._duration_stats.get(key)
+        return DurationStats.from_blob(blob) if blob is not None else None
+
+    def put_duration_stats(self, key, stats):
+        self._set(self._duration_stats, key, stats.to_blob())
+
+    def get_duration_profile(self, key):
+        blob = self._duration_profiles.get(key)
+        return DurationProfile.from_blob(blob) if blob is not None else None
+
+    def put_duration_profile(self, key, profile):
+        self._set(self._duration_profiles, key, profile.to_blob())
+
+    def get_cycle_model(self, light_id):
+        row = self._cycle_models.get(light_id)
+        return CycleModel.from_row(row) if row is not None else None
+
+    def put_cycle_model(self, light_id, model):
+        self._set(self._cycle_models, light_id, model.to_row())
+
+    def get_light_current(self, light_ids):
+        return {light_id: self._light_current[light_id] for light_id in light_ids if light_id in self._light_current}
+
+    def get_light_state(self, light_id):
+        eta = self._light_current.get(light_id)
+        return (eta.state, eta.state_since) if eta else None
+
+    def put_light_current(self, light_id, eta):
+        self._set(self._light_current, light_id, eta)
+
+    def lights_without_current(self):
+        rows = []
+        for light_id in self._lights:
+            latest = self.last_state(light_id)
+            if latest and light_id not in self._light_current:
+                rows.append((light_id, *latest))
+        return rows
+
+    def update_intersection_current(self, intersection_id, prev_state, state, changed_at):
+        aggregate = self._intersection_current.get(intersection_id)
+        if aggregate is None:
+            self._set(self._intersection_current, intersection_id,
+                      (state, int(state == 'RED'), int(state == 'GREEN'), changed_at))
+            return
+        _, red, green, last_change = aggregate
+        red += (state == 'RED') - (prev_state == 'RED')
+        green += (state == 'GREEN') - (prev_state == 'GREEN')
+        overall_state = 'RED' if red > 0 else 'GREEN' if green > 0 else 'UNKNOWN'
+        self._set(self._intersection_current, intersection_id, (overall_state, red, green, max(last_change, changed_at)))
+
+    def rebuild_intersection_current(self):
+        counts = {}
+        for light_id, eta in self._light_current.items():
+            light = self._lights.get(light_id)
+            if light is None:
+                continue
+            red, green, last_change = counts.get(light[2], (0, 0, None))
+            counts[light[2]] = (red + (eta.state == 'RED'), green + (eta.state == 'GREEN'),
+                                eta.state_since if last_change is None else max(last_change, eta.state_since))
+        if self._undo is not None:
+            old = self._intersection_current
+            self._undo.append(lambda: setattr(self, '_intersection_current', old))
+        self._intersection_current = {
+            intersection_id: ('RED' if red else 'GREEN' if green else 'UNKNOWN', red, green, last_change)
+            for intersection_id, (red, green, last_change) in counts.items()
+        }
+
+    def intersection_current(self, intersection_id):
+        aggregate = self._intersection_current.get(intersection_id)
+        if aggregate is None:
+            return None
+        lights = [(light_id, self._light_current[light_id]) for light_id in self.intersection_lights(intersection_id)
+                  if light_id in self._light_current]
+        return aggregate, lights
+
+    def load_detector_health(self, detector_id=None):
+        if detector_id is not None:
+            row = self._detector_health.get(detector_id)
+            return [row] if row else []
+        return [self._detector_health[key] for key in sorted(self._detector_health)]
+
+    def save_detector_health(self, rows, merge=False):
+        # One process holds the whole store, so there is nothing to merge with
+        for row in rows:
+            self._set(self._detector_health, row[0], tuple(row))
+
+    def detector_last_seen(self):
+        return {detector_id: row[2] for detector_id, row in self._detector_health.items()}
+
+    def cleanup(self, cutoff, now):
+        telemetry_times = self._telemetry['timestamp']
+        deleted_telemetry = bisect_left(telemetry_times, cutoff)
+        for column in self._telemetry.values():
+            del column[:deleted_telemetry]
+        del self._telemetry_channels[:deleted_telemetry]
+
+        # Keep the most recent row of each state for every light
+        deleted_states = 0
+        for light in self._histories.values():
+            last_of_state = {code: index for index, code in enumerate(light.states)}
+            kept = [index for index, timestamp in enumerate(light.times)
+                    if timestamp >= cutoff or last_of_state[light.states[index]] == index]
+            if len(kept) < len(light.times):
+                deleted_states += len(light.times) - len(kept)
+                light.keep(kept)
+        return deleted_telemetry, deleted_states
+
+    def snapshot_marker(self):
+        # Models only change along with a recorded transition
+        return (self._next_row_id,)
+
+
+# Shared by every caller in the process, so an in-process API sees the listener's writes
+_memory_storage = None
+
+
+def open_storage(backend=None, db_path=DB_PATH, readonly=False, pool_size=4, busy_timeout=5.0):
+    """Open the configured backend; readonly SQLite stores read through a connection pool"""
+    global _memory_storage
+    backend = backend or BACKEND
+    if backend == 'sqlite':
+        return SQLiteStorage(db_path, readonly=readonly, pool_size=pool_size, busy_timeout=busy_timeout)
+    if backend == 'memory':
+        if _memory_storage is None:
+            _memory_storage = MemoryStorage()
+            if TOPOLOGY_PATH:
+                import topology
+                _memory_storage.load_topology(topology.parse_lights(topology.read_file(TOPOLOGY_PATH)))
+        return _memory_storage
+    raise ValueError(f"Unknown storage backend '{backend}', expected 'sqlite' or 'memory'")
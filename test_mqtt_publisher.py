@@ -7,6 +7,7 @@ from collections import defaultdict
 import paho.mqtt.client as mqtt
 import telemetry_pb2  # Import generated protobuf module
 
+import channel_bits
 import register_detector  # Import detector registration module
 
 DB_PATH = "/data/detectors.db"
@@ -23,7 +24,7 @@ def get_channel_mappings():
     conn = sqlite3.connect(DB_PATH)
     cursor = conn.cursor()
     cursor.execute("""
-        SELECT tlc.channel_mask, tlc.signal_color, tl.light_id
+        SELECT tlc.channel, tlc.signal_color, tl.light_id
         FROM traffic_light_channels tlc
         JOIN traffic_lights tl ON tlc.light_id = tl.light_id
         WHERE tlc.detector_id = ?
@@ -33,8 +34,8 @@ def get_channel_mappings():
     
     # Organize by light ID and signal color
     config = defaultdict(dict)
-    for channel_mask, signal_color, light_id in mappings:
-        config[light_id][signal_color] = channel_mask
+    for channel, signal_color, light_id in mappings:
+        config[light_id][signal_color] = 1 << channel
     return config
 
 # Track light states and their timing
@@ -74,7 +75,7 @@ def generate_mock_data():
         current_state = light_states[light_id]['state']
         channels |= signals[current_state]
     
-    telemetry.channels = channels
+    channel_bits.to_message(telemetry, channels)
     telemetry.timestamp = int(current_time)
     counter += 1
     telemetry.counter = counter
@@ -87,10 +88,11 @@ def main():
     client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
     client.username_pw_set(USERNAME, PASSWORD)
     client.connect(MQTT_BROKER, MQTT_PORT, 60)
+    client.loop_start()
 
     while True:
         payload = generate_mock_data()
-        client.publish(MQTT_TOPIC, payload)
+        client.publish(MQTT_TOPIC, payload, qos=1)
         print(f"Published mock data: {payload}")
         time.sleep(5)  # Send data every 5 seconds
 
@@ -0,0 +1,219 @@
+"""Integration test for listeners sharing one MQTT v5 subscription.
+
+Starts a private mosquitto on a spare port with its own password file and a
+scratch database, runs several mqtt_listener.py instances in one shared
+subscription group, publishes synthetic frames for a 4-light intersection
+and checks that:
+
+- every frame was processed exactly once across all instances,
+- every instance received frames (the broker spread the load),
+- each light's recorded states alternate, one row per real change,
+- detector health counted every frame.
+
+Needs mosquitto on PATH (it is in the container image):
+
+    docker exec tld_backend python3 /app/test_shared_listeners.py --instances 3
+"""
+import argparse
+import base64
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+import paho.mqtt.client as mqtt
+import telemetry_pb2
+
+import channel_bits
+import provision_detectors
+import schema
+import topology
+
+MQTT_TOPIC = "$me/device/state"
+DETECTOR_ID = 1
+SHARE_GROUP = "ingest"
+
+# Each light toggles every TOGGLE_SECONDS, offset by its index
+TOGGLE_SECONDS = 2.0
+FRAME_INTERVAL = 0.05
+
+LIGHTS = [
+    {'name': f'Shared Test {i}', 'location': '55.75, 37.62', 'detector_id': DETECTOR_ID,
+     'red_channel': 2 * i, 'green_channel': 2 * i + 1, 'intersection_id': 'Shared_Test'}
+    for i in range(4)
+]
+
+# Runs a listener against the scratch database and password file
+LISTENER_BOOTSTRAP = """
+import sys
+import mqtt_listener, register_detector
+register_detector.DB_PATH = mqtt_listener.DB_PATH = sys.argv[1]
+register_detector.MOSQUITTO_PASSWD_FILE = sys.argv[2]
+mqtt_listener.main()
+"""
+
+
+def prepare(workdir, port):
+    """Create the scratch database, credentials and broker config"""
+    db_path = os.path.join(workdir, 'detectors.db')
+    passwd_path = os.path.join(workdir, 'passwords')
+    schema.ensure_schema(db_path)
+
+    conn = sqlite3.connect(db_path)
+    topology.apply(conn, topology.parse_lights(LIGHTS))
+    # Users are written directly: provisioning would reload every mosquitto on the host
+    credentials = {f"detector_{name}": provision_detectors.generate_password()
+                   for name in ('listener', DETECTOR_ID)}
+    with conn:
+        conn.executemany("INSERT INTO detectors (name, password) VALUES (?, ?)", credentials.items())
+    conn.close()
+    provision_detectors.write_password_file(
+        passwd_path, {name: provision_detectors.hash_password(password) for name, password in credentials.items()})
+
+    config_path = os.path.join(workdir, 'mosquitto.conf')
+    with open(config_path, 'w') as f:
+        f.write(f"allow_anonymous false\npassword_file {passwd_path}\nlistener {port} 127.0.0.1\n")
+    return db_path, passwd_path, config_path, credentials[f"detector_{DETECTOR_ID}"]
+
+
+def start_listeners(count, db_path, passwd_path, port, workdir):
+    app_dir = os.path.dirname(os.path.abspath(__file__))
+    listeners = []
+    for i in range(count):
+        env = dict(os.environ, MQTT_BROKER='127.0.0.1', MQTT_PORT=str(port), LISTENER_SHARE_GROUP=SHARE_GROUP,
+                   LISTENER_CLIENT_ID=f'tld-listener-test-{i}',
+                   LISTENER_SPOOL=os.path.join(workdir, f'listener_{i}.spool'),
+                   LISTENER_SNAPSHOT=os.path.join(workdir, f'listener_{i}.snapshot'),
+                   LISTENER_MAINTENANCE='1' if i == 0 else '0', HEALTH_FLUSH_INTERVAL='1',
+                   SIGNAL_MIN_DWELL='1', PYTHONUNBUFFERED='1')
+        log = open(os.path.join(workdir, f'listener_{i}.log'), 'w')
+        process = subprocess.Popen([sys.executable, '-c', LISTENER_BOOTSTRAP, db_path, passwd_path],
+                                   cwd=app_dir, env=env, stdout=log, stderr=subprocess.STDOUT)
+        listeners.append((process, log))
+    return listeners
+
+
+def frame(counter, elapsed):
+    """Telemetry for the lights' states `elapsed` seconds into the run"""
+    channels = 0
+    for i, light in enumerate(LIGHTS):
+        green = int((elapsed + i * 0.5) // TOGGLE_SECONDS) % 2
+        channels |= 1 << (light['green_channel'] if green else light['red_channel'])
+    telemetry = telemetry_pb2.mqtt_msg_t()
+    telemetry.id = DETECTOR_ID
+    telemetry.counter = counter
+    telemetry.timestamp = int(time.time())
+    channel_bits.to_message(telemetry, channels)
+    return base64.b64encode(telemetry.SerializeToString()).decode()
+
+
+def publish(port, password, duration):
+    client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, protocol=mqtt.MQTTv5)
+    client.username_pw_set(f"detector_{DETECTOR_ID}", password)
+    client.connect('127.0.0.1', port, 60)
+    client.loop_start()
+
+    started = time.time()
+    counter = 0
+    while time.time() - started < duration:
+        counter += 1
+        client.publish(MQTT_TOPIC, frame(counter, time.time() - started), qos=1).wait_for_publish()
+        time.sleep(FRAME_INTERVAL)
+
+    client.loop_stop()
+    client.disconnect()
+    return counter, started
+
+
+def check(db_path, workdir, instances, published, started, duration):
+    conn = sqlite3.connect(db_path)
+    failures = []
+
+    telemetry = conn.execute("SELECT COUNT(*), COUNT(DISTINCT counter) FROM telemetry").fetchone()
+    if telemetry != (published, published):
+        failures.append(f"telemetry rows {telemetry[0]} ({telemetry[1]} distinct), expected {published}")
+
+    for i in range(instances):
+        with open(os.path.join(workdir, f'listener_{i}.log')) as f:
+            received = f.read().count("New telemetry received")
+        print(f"  listener {i}: {received} frames")
+        if received == 0:
+            failures.append(f"listener {i} received no frames")
+
+    expected_changes = duration / TOGGLE_SECONDS
+    rows = conn.execute("""
+        SELECT tl.name, tls.state FROM traffic_light_states tls
+        JOIN traffic_lights tl ON tl.light_id = tls.light_id
+        WHERE tls.timestamp >= ? ORDER BY tl.name, tls.timestamp, tls.id
+    """, (int(started),)).fetchall()
+    states = {}
+    for name, state in rows:
+        states.setdefault(name, []).append(state)
+    for light in LIGHTS:
+        recorded = states.get(light['name'], [])
+        print(f"  {light['name']}: {len(recorded)} states recorded")
+        if any(a == b for a, b in zip(recorded, recorded[1:])):
+            failures.append(f"{light['name']}: the same state was recorded twice in a row")
+        if abs(len(recorded) - 1 - expected_changes) > 1.5:
+            failures.append(f"{light['name']}: {len(recorded)} states, expected about {expected_changes + 1:.0f}")
+
+    health = conn.execute("SELECT frames FROM detector_health WHERE detector_id = ?", (DETECTOR_ID,)).fetchone()
+    if health is None or health[0] != published:
+        failures.append(f"detector health counted {health and health[0]} frames, expected {published}")
+
+    conn.close()
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Integration test for shared-subscription listeners.")
+    parser.add_argument("--instances", type=int, default=3, help="Listener instances to run")
+    parser.add_argument("--duration", type=float, default=20.0, help="Seconds to publish for")
+    parser.add_argument("--port", type=int, default=18830, help="Port for the private broker")
+    parser.add_argument("--keep", action="store_true", help="Keep the scratch directory")
+    args = parser.parse_args()
+
+    if shutil.which("mosquitto") is None:
+        print("mosquitto not found on PATH")
+        sys.exit(2)
+
+    workdir = tempfile.mkdtemp(prefix="tld_shared_")
+    db_path, passwd_path, config_path, password = prepare(workdir, args.port)
+    broker = subprocess.Popen(["mosquitto", "-c", config_path], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    listeners = []
+    try:
+        time.sleep(1)
+        listeners = start_listeners(args.instances, db_path, passwd_path, args.port, workdir)
+        time.sleep(3)  # Let every instance connect and subscribe
+
+        print(f"Publishing for {args.duration:.0f}s to {args.instances} listeners...")
+        published, started = publish(args.port, password, args.duration)
+        time.sleep(3)  # Drain and let health flush
+        print(f"Published {published} frames")
+    finally:
+        for process, log in listeners:
+            process.terminate()
+            process.wait()
+            log.close()
+        broker.terminate()
+        broker.wait()
+
+    failures = check(db_path, workdir, args.instances, published, started, args.duration)
+    if not args.keep:
+        shutil.rmtree(workdir)
+    else:
+        print(f"Scratch files kept in {workdir}")
+
+    if failures:
+        print("FAILED:")
+        for failure in failures:
+            print(f"  {failure}")
+        sys.exit(1)
+    print("PASSED")
+
+
+if __name__ == "__main__":
+    main()
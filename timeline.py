@@ -0,0 +1,105 @@
+"""Per-light state occupancy in fixed time buckets for dashboards.
+
+For each bucket the time a light spent RED and GREEN is computed by sweeping
+over its recorded transitions, read from a storage.Storage, starting from the
+state in effect at the beginning of the span. Buckets that are fully in the past are
+immutable, so they are cached per (light, resolution) and later requests
+only sweep the span after the last cached bucket.
+"""
+import threading
+import time
+
+RESOLUTIONS = {
+    'minute': 60,
+    'hour': 3600,
+    'day': 86400,
+}
+
+# Buckets ending more than this many seconds ago are treated as final;
+# the margin covers frames that are committed late by the listener
+FINISHED_MARGIN = 60
+
+# Upper bound on cached buckets per worker before the cache is reset
+MAX_CACHED_BUCKETS = 500000
+
+def align(timestamp, bucket_seconds):
+    """Round a timestamp down to the start of its bucket"""
+    return int(timestamp) - int(timestamp) % bucket_seconds
+
+
+def sweep(store, light_id, start, end, bucket_seconds):
+    """Compute {bucket_start: [red_seconds, green_seconds]} for aligned [start, end)"""
+    buckets = {bucket: [0, 0] for bucket in range(start, end, bucket_seconds)}
+
+    def add(state, t0, t1):
+        index = 0 if state == 'RED' else 1 if state == 'GREEN' else None
+        if index is None:
+            return
+        while t0 < t1:
+            bucket = align(t0, bucket_seconds)
+            segment_end = min(t1, bucket + bucket_seconds)
+            buckets[bucket][index] += segment_end - t0
+            t0 = segment_end
+
+    state = store.state_before(light_id, start)
+    t = start
+
+    for next_state, timestamp in store.transitions(light_id, start, end):
+        timestamp = int(timestamp)
+        add(state, t, timestamp)
+        state, t = next_state, timestamp
+
+    # The last known state holds until the end of the span or now
+    add(state, t, min(end, int(time.time())))
+    return buckets
+
+
+class TimelineCache:
+    """Caches finished buckets per (light_id, bucket_seconds)"""
+
+    def __init__(self, max_buckets=MAX_CACHED_BUCKETS):
+        self.max_buckets = max_buckets
+        self._buckets = {}
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def occupancy(self, store, light_id, start, end, bucket_seconds):
+        """Return [(bucket_start, red_seconds, green_seconds, covered_seconds)] for [start, end).
+
+        covered_seconds is the time the light was in a known state, so a bucket
+        before its first transition or while it was UNKNOWN covers nothing.
+        """
+        start = align(start, bucket_seconds)
+        end = align(end + bucket_seconds - 1, bucket_seconds)
+        now = int(time.time())
+        finished_before = align(now - FINISHED_MARGIN, bucket_seconds)
+
+        with self._lock:
+            cached = self._buckets.setdefault((light_id, bucket_seconds), {})
+
+        # Sweep only from the first bucket missing from the cache
+        first_missing = start
+        while first_missing < end and first_missing in cached:
+            first_missing += bucket_seconds
+        computed = {bucket: cached[bucket] for bucket in range(start, first_missing, bucket_seconds)}
+
+        if first_missing < end:
+            swept = sweep(store, light_id, first_missing, end, bucket_seconds)
+            computed.update(swept)
+            finished = {b: tuple(v) for b, v in swept.items() if b + bucket_seconds <= finished_before}
+            with self._lock:
+                if self._size + len(finished) > self.max_buckets:
+                    self._buckets.clear()
+                    self._size = 0
+                    cached = self._buckets.setdefault((light_id, bucket_seconds), {})
+                before = len(cached)
+                cached.update(finished)
+                self._size += len(cached) - before
+
+        result = []
+        for bucket in range(start, end, bucket_seconds):
+            red, green = computed[bucket]
+            # RED and GREEN are the only known states the sweep counts
+            covered = red + green
+            result.append((bucket, red, green, covered))
+        return result
@@ -0,0 +1,342 @@
+#!/usr/bin/env python3
+"""Declarative import and export of intersection and channel configuration.
+
+The topology is a list of intersections, each with its lights, coordinates
+and the detector channels of their RED and GREEN lamps:
+
+    intersections:
+      - id: Moscow_Crossing
+        lights:
+          - name: Red Square Northbound
+            location: "55.753930, 37.620795"
+            detector_id: 1
+            red_channel: 0
+            green_channel: 1
+
+JSON uses the same structure. CSV has one row per light with the columns
+intersection_id, name, location, detector_id, red_channel, green_channel.
+
+Lights are matched to the database by name. An import validates the whole
+file, diffs it against the database and applies only the differences with
+executemany in one transaction; lights not in the file are kept unless
+--prune is given.
+
+    python3 topology.py export topology.yaml
+    python3 topology.py import topology.yaml --dry-run
+    python3 topology.py import topology.yaml --prune
+"""
+import argparse
+import csv
+import json
+import sqlite3
+import sys
+import time
+from collections import defaultdict
+
+import schema
+
+DB_PATH = "/data/detectors.db"
+
+# Lights listed per kind of change in the import summary
+LIST_LIMIT = 20
+
+CSV_COLUMNS = ('intersection_id', 'name', 'location', 'detector_id', 'red_channel', 'green_channel')
+
+
+class TopologyError(ValueError):
+    pass
+
+
+def _yaml():
+    """PyYAML, imported on first use: it is optional and slow to import"""
+    try:
+        import yaml
+    except ImportError:
+        raise TopologyError("YAML support requires PyYAML (pip install pyyaml)")
+    return yaml
+
+
+def _format(path, requested=None):
+    if requested:
+        return requested
+    if path.endswith(('.yaml', '.yml')):
+        return 'yaml'
+    if path.endswith('.csv'):
+        return 'csv'
+    return 'json'
+
+
+def read_file(path, fmt=None):
+    """Load a topology file into a list of light dicts"""
+    fmt = _format(path, fmt)
+    with open(path, newline='') as f:
+        if fmt == 'csv':
+            return [dict(row) for row in csv.DictReader(f)]
+        if fmt == 'yaml':
+            document = _yaml().safe_load(f)
+        else:
+            document = json.load(f)
+
+    lights = []
+    for intersection in (document or {}).get('intersections') or []:
+        for light in intersection.get('lights') or []:
+            lights.append({**light, 'intersection_id': intersection.get('id')})
+    return lights
+
+
+def parse_lights(entries):
+    """Validate light dicts into {name: (intersection_id, location, detector_id, red, green)}"""
+    lights = {}
+    errors = []
+    for number, entry in enumerate(entries, 1):
+        name = str(entry.get('name') or '').strip()
+        where = f"light '{name}'" if name else f"entry {number}"
+        if not name:
+            errors.append(f"{where}: missing name")
+            continue
+        if name in lights:
+            errors.append(f"{where}: listed more than once")
+            continue
+
+        intersection_id = str(entry.get('intersection_id') or '').strip() or 'UNGROUPED'
+        location = str(entry.get('location') or '').strip()
+        try:
+            latitude, longitude = (float(part) for part in location.split(','))
+        except ValueError:
+            errors.append(f"{where}: location '{location}' is not 'latitude, longitude'")
+            continue
+        if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+            errors.append(f"{where}: location '{location}' is out of range")
+            continue
+
+        try:
+            detector_id = int(entry['detector_id'])
+            red = int(entry['red_channel'])
+            green = int(entry['green_channel'])
+        except (KeyError, TypeError, ValueError):
+            errors.append(f"{where}: detector_id, red_channel and green_channel must be integers")
+            continue
+        if red < 0 or green < 0:
+            errors.append(f"{where}: channels cannot be negative")
+            continue
+        if red == green:
+            errors.append(f"{where}: RED and GREEN cannot use the same channel")
+            continue
+
+        lights[name] = (intersection_id, location, detector_id, red, green)
+
+    if errors:
+        raise TopologyError('\n'.join(errors))
+    return lights
+
+
+def check_collisions(lights):
+    """Raise if two lights map the same detector channel"""
+    owners = defaultdict(list)
+    for name, (_, _, detector_id, red, green) in lights.items():
+        owners[(detector_id, red)].append(f"{name} RED")
+        owners[(detector_id, green)].append(f"{name} GREEN")
+
+    errors = [f"detector {detector_id} channel {channel} is mapped to {', '.join(names)}"
+              for (detector_id, channel), names in sorted(owners.items()) if len(names) > 1]
+    if errors:
+        raise TopologyError('\n'.join(errors))
+
+
+def load_current(conn):
+    """Current topology as ({name: (intersection_id, location, detector_id, red, green)}, {name: light_id})"""
+    rows = conn.execute("""
+        SELECT tl.light_id, tl.name, tl.location, tl.intersection_id,
+               tlc.detector_id, tlc.channel, tlc.signal_color
+        FROM traffic_lights tl
+        LEFT JOIN traffic_light_channels tlc ON tlc.light_id = tl.light_id
+        ORDER BY tl.intersection_id, tl.light_id, tlc.id
+    """).fetchall()
+
+    ids = {}
+    found = {}
+    for light_id, name, location, intersection_id, detector_id, channel, color in rows:
+        ids[name] = light_id
+        light = found.setdefault(name, {'intersection_id': intersection_id, 'location': location,
+                                        'detector_id': detector_id, 'RED': None, 'GREEN': None})
+        if color is not None and light[color] is None:
+            light[color] = channel
+
+    current = {name: (light['intersection_id'], light['location'], light['detector_id'],
+                      light['RED'], light['GREEN'])
+               for name, light in found.items()}
+    return current, ids
+
+
+def diff(current, desired, prune=False):
+    """(added, changed, removed) light names"""
+    added = [name for name in desired if name not in current]
+    changed = [name for name in desired if name in current and current[name] != desired[name]]
+    removed = [name for name in current if name not in desired] if prune else []
+    return added, changed, removed
+
+
+def refresh_intersections(conn, intersection_ids):
+    """Recount intersection_current for these intersections from light_current"""
+    ids = sorted(set(intersection_ids))
+    if not ids:
+        return
+    placeholders = ','.join('?' * len(ids))
+    conn.execute(f"DELETE FROM intersection_current WHERE intersection_id IN ({placeholders})", ids)
+    conn.execute(f"""
+        INSERT INTO intersection_current
+        (intersection_id, overall_state, red_lights, green_lights, last_change, updated_at)
+        SELECT tl.intersection_id,
+               CASE WHEN SUM(lc.state = 'RED') > 0 THEN 'RED'
+                    WHEN SUM(lc.state = 'GREEN') > 0 THEN 'GREEN'
+                    ELSE 'UNKNOWN' END,
+               SUM(lc.state = 'RED'), SUM(lc.state = 'GREEN'), MAX(lc.state_since), ?
+        FROM light_current lc
+        JOIN traffic_lights tl ON tl.light_id = lc.light_id
+        WHERE tl.intersection_id IN ({placeholders})
+        GROUP BY tl.intersection_id
+    """, (int(time.time()), *ids))
+
+
+def apply(conn, desired, prune=False, dry_run=False):
+    """Bring the database in line with the desired topology in one transaction"""
+    current, ids = load_current(conn)
+
+    # Lights kept from the database take part in the collision check too
+    final = dict(desired) if prune else {**current, **desired}
+    check_collisions({name: light for name, light in final.items() if None not in light})
+
+    added, changed, removed = diff(current, desired, prune)
+    print(f"[TOPOLOGY] {len(added)} lights added, {len(changed)} changed, "
+          f"{len(removed)} removed, {len(desired) - len(added) - len(changed)} unchanged")
+    for label, names in (('+', added), ('~', changed), ('-', removed)):
+        for name in names[:LIST_LIMIT]:
+            print(f"  {label} {name}")
+        if len(names) > LIST_LIMIT:
+            print(f"  {label} ... and {len(names) - LIST_LIMIT} more")
+    if dry_run or not (added or changed or removed):
+        return added, changed, removed
+
+    with conn:
+        conn.execute("BEGIN IMMEDIATE")
+        upserts = added + changed
+        conn.executemany("""
+            INSERT INTO traffic_lights (name, location, intersection_id) VALUES (?, ?, ?)
+            ON CONFLICT(name) DO UPDATE SET
+                location = excluded.location,
+                intersection_id = excluded.intersection_id
+        """, [(name, desired[name][1], desired[name][0]) for name in upserts])
+
+        placeholders = ','.join('?' * len(upserts))
+        ids.update(conn.execute(f"SELECT name, light_id FROM traffic_lights WHERE name IN ({placeholders})",
+                                upserts).fetchall() if upserts else [])
+
+        stale = [(ids[name],) for name in changed + removed]
+        conn.executemany("DELETE FROM traffic_light_channels WHERE light_id = ?", stale)
+
+        channels = []
+        for name in upserts:
+            _, _, detector_id, red, green = desired[name]
+            channels.append((ids[name], detector_id, red, 'RED'))
+            channels.append((ids[name], detector_id, green, 'GREEN'))
+        conn.executemany("""
+            INSERT INTO traffic_light_channels (light_id, detector_id, channel, signal_color)
+            VALUES (?, ?, ?, ?)
+        """, channels)
+
+        # Removed lights keep their history; only their live state goes
+        removed_ids = [(ids[name],) for name in removed]
+        conn.executemany("DELETE FROM light_current WHERE light_id = ?", removed_ids)
+        conn.executemany("DELETE FROM traffic_lights WHERE light_id = ?", removed_ids)
+
+        # Recount the old and new intersection of every light added, moved or removed
+        refresh_intersections(conn, [current[name][0] for name in changed + removed] +
+                              [desired[name][0] for name in upserts])
+
+    print("[TOPOLOGY] Changes applied; the listener picks them up on its next config refresh")
+    return added, changed, removed
+
+
+def export(conn, path, fmt=None):
+    """Write the current topology to a file ('-' for stdout), returning the number of lights written.
+
+    Lights missing a channel are left out with a warning, so the file always
+    passes parse_lights().
+    """
+    current, _ = load_current(conn)
+    fmt = _format(path, fmt)
+
+    intersections = defaultdict(list)
+    incomplete = []
+    for name, (intersection_id, location, detector_id, red, green) in current.items():
+        # An import would reject a light without both channels
+        if None in (detector_id, red, green):
+            incomplete.append(name)
+            continue
+        intersections[intersection_id].append({
+            'name': name, 'location': location, 'detector_id': detector_id,
+            'red_channel': red, 'green_channel': green,
+        })
+
+    out = sys.stdout if path == '-' else open(path, 'w', newline='')
+    try:
+        if fmt == 'csv':
+            writer = csv.writer(out)
+            writer.writerow(CSV_COLUMNS)
+            for intersection_id, lights in intersections.items():
+                for light in lights:
+                    writer.writerow([intersection_id] + [light[column] for column in CSV_COLUMNS[1:]])
+        else:
+            document = {'intersections': [{'id': intersection_id, 'lights': lights}
+                                          for intersection_id, lights in intersections.items()]}
+            if fmt == 'yaml':
+                _yaml().safe_dump(document, out, sort_keys=False, allow_unicode=True)
+            else:
+                json.dump(document, out, indent=2, ensure_ascii=False)
+                out.write('\n')
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    if incomplete:
+        print(f"[TOPOLOGY] Skipped {len(incomplete)} lights without both a RED and a GREEN channel "
+              f"(an import with --prune would remove them): {', '.join(incomplete[:LIST_LIMIT])}"
+              f"{' ...' if len(incomplete) > LIST_LIMIT else ''}", file=sys.stderr)
+    return len(current) - len(incomplete)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Import or export intersection and channel configuration.")
+    parser.add_argument("--db", default=DB_PATH, help="Path to SQLite database")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    import_parser = commands.add_parser("import", help="Apply a topology file to the database")
+    import_parser.add_argument("file", help="YAML, JSON or CSV topology file")
+    import_parser.add_argument("--format", choices=("yaml", "json", "csv"), help="Override format detection")
+    import_parser.add_argument("--prune", action="store_true", help="Remove lights that are not in the file")
+    import_parser.add_argument("--dry-run", action="store_true", help="Show the diff without writing")
+
+    export_parser = commands.add_parser("export", help="Write the current topology to a file")
+    export_parser.add_argument("file", nargs="?", default="-", help="Output file, stdout by default")
+    export_parser.add_argument("--format", choices=("yaml", "json", "csv"), help="Override format detection")
+
+    args = parser.parse_args()
+
+    conn = sqlite3.connect(args.db)
+    try:
+        schema.migrate(conn)
+        if args.command == "export":
+            count = export(conn, args.file, args.format)
+            if args.file != '-':
+                print(f"[TOPOLOGY] Exported {count} lights to {args.file}")
+        else:
+            desired = parse_lights(read_file(args.file, args.format))
+            apply(conn, desired, args.prune, args.dry_run)
+    except TopologyError as e:
+        print(f"Invalid topology:\n{e}", file=sys.stderr)
+        sys.exit(1)
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()